@@ -0,0 +1,255 @@
+import json
+import logging
+import os
+import threading
+import time
+import numpy as np
+import pyopencl as cl
+import pyF3D.Profiling as pr
+
+logger = logging.getLogger(__name__)
+
+# JSON file in which tuned launch parameters are kept between processes. None keeps them in memory only
+tuningFile = os.environ.get('PYF3D_TUNING_FILE')
+# runs of each candidate, the fastest is kept
+repeats = 3
+
+localSizeCandidates = [(4, 4), (8, 4), (8, 8), (16, 4), (16, 8), (16, 16), (32, 4), (32, 8), (32, 16), (64, 1),
+                       (64, 4), (128, 1), (256, 1)]
+# fractions of the depth filtered by each work-item
+sliceBlockDivisors = [1, 2, 4, 8, 16]
+
+_entries = None
+_lock = threading.Lock()
+
+def setTuningFile(path=None):
+    """
+    Sets JSON file in which tuned launch parameters are stored, so that a new process does not have to tune kernels
+    again. Can also be set through the PYF3D_TUNING_FILE environment variable
+
+    Parameters
+    ----------
+    path: str, optional
+        Tuning file. Created when the first kernel is tuned. If None, tuned parameters are only kept in memory
+    """
+
+    global tuningFile, _entries
+    with _lock:
+        tuningFile = path
+        _entries = None
+
+def clearTuningCache():
+    """
+    Removes tuned launch parameters from memory. The tuning file is left as is
+    """
+
+    global _entries
+    with _lock:
+        _entries = {}
+
+def tuningKey(device, kernel, width, maskSize, dtype=np.uint8):
+    """
+    Key of the tuned parameters of kernel on device, for slabs of width voxels of dtype and a neighbourhood (radius or
+    structuring element) of maskSize
+    """
+
+    key = "%s|%s|%s/%s/%d/%d" % (device.platform.name.strip(), device.name.strip(), device.driver_version,
+                                 kernel.function_name, width, maskSize)
+    # kernels of other types than np.uint8 have the same name but are different programs
+    if np.dtype(dtype) != np.uint8:
+        key += "/" + np.dtype(dtype).name
+    return key
+
+def _loadEntries():
+    global _entries
+    if _entries is None:
+        _entries = {}
+        if tuningFile is not None and os.path.isfile(tuningFile):
+            try:
+                with open(tuningFile) as f:
+                    _entries = json.load(f)
+            except (IOError, ValueError):
+                logger.warning("Tuning file %s could not be read, kernels will be tuned again", tuningFile)
+    return _entries
+
+def lookup(key):
+    """
+    Returns tuned parameters stored under key, as a dict with 'localSize' (x, y), 'sliceBlock' (slices filtered by
+    each work-item) and 'seconds' items. None if the kernel was not tuned
+    """
+
+    with _lock:
+        return _loadEntries().get(key)
+
+def store(key, entry):
+    with _lock:
+        _loadEntries()[key] = entry
+        if tuningFile is None:
+            return
+        directory = os.path.dirname(os.path.abspath(tuningFile))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # written to a temporary file first, so that other processes never read a partial file
+        tmpFile = tuningFile + '.%d.tmp' % os.getpid()
+        with open(tmpFile, 'w') as f:
+            json.dump(_entries, f, indent=1, sort_keys=True)
+        os.replace(tmpFile, tuningFile)
+
+def launchSizes(clattr, sizes, localSize, sliceBlock):
+    """
+    Three-dimensional local and global sizes over (width, height, depth) sizes, for a (x, y) localSize and blocks of
+    sliceBlock slices
+    """
+
+    blockCount = -(-sizes[2] // max(1, min(sliceBlock, sizes[2])))
+    return ([localSize[0], localSize[1], 1],
+            [clattr.roundUp(localSize[0], sizes[0]), clattr.roundUp(localSize[1], sizes[1]), blockCount])
+
+def candidates(clattr, kernel, sizes, minBlock, localMemory):
+    device = clattr.device
+    maxGroupSize = kernel.get_work_group_info(cl.kernel_work_group_info.WORK_GROUP_SIZE, device)
+    localSizes = []
+    for localSize in localSizeCandidates:
+        if localSize[0]*localSize[1] > maxGroupSize or localSize[0] > device.max_work_item_sizes[0] or \
+                localSize[1] > device.max_work_item_sizes[1]:
+            continue
+        if localMemory is not None and localMemory(localSize) is None:
+            continue
+        localSizes.append(localSize)
+
+    sliceBlocks = []
+    for divisor in sliceBlockDivisors:
+        sliceBlock = -(-sizes[2] // divisor)
+        if (sliceBlock >= minBlock or divisor == 1) and sliceBlock not in sliceBlocks:
+            sliceBlocks.append(sliceBlock)
+    return localSizes, sliceBlocks
+
+def benchmark(clattr, kernel, sizes, localSize, sliceBlock, localMemory):
+    localSize, globalSize = launchSizes(clattr, sizes, localSize, sliceBlock)
+    if localMemory is not None:
+        setLocalMemory(kernel, localMemory(localSize))
+    best = None
+    for i in range(repeats + 1):
+        start = time.time()
+        cl.enqueue_nd_range_kernel(clattr.queue, kernel, globalSize, localSize)
+        clattr.queue.finish()
+        # first run is not timed, it includes lazy compilation on some platforms
+        if i > 0:
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def tune(clattr, kernel, sizes, maskSize=0, minBlock=1, localMemory=None):
+    """
+    Benchmarks candidate work-group sizes, then candidate slices per work-item with the fastest work-group size, and
+    stores the fastest pair. The arguments of kernel must be set; the kernel is run several times, so it must not
+    read its output
+
+    Returns
+    -------
+    dict
+        Tuned parameters, as returned by lookup. None if no candidate could be run
+    """
+
+    localSizes, sliceBlocks = candidates(clattr, kernel, sizes, minBlock, localMemory)
+    best = None
+    for localSize in localSizes:
+        try:
+            seconds = benchmark(clattr, kernel, sizes, localSize, sizes[2], localMemory)
+        except cl.Error:
+            continue
+        if best is None or seconds < best['seconds']:
+            best = {'localSize': list(localSize), 'sliceBlock': sizes[2], 'seconds': seconds}
+    if best is None:
+        return None
+
+    for sliceBlock in sliceBlocks[1:]:
+        try:
+            seconds = benchmark(clattr, kernel, sizes, best['localSize'], sliceBlock, localMemory)
+        except cl.Error:
+            continue
+        if seconds < best['seconds']:
+            best['sliceBlock'] = sliceBlock
+            best['seconds'] = seconds
+
+    store(tuningKey(clattr.device, kernel, sizes[0], maskSize, clattr.dtype), best)
+    return best
+
+def enqueue(clattr, kernel, globalSize, localSize, sizes, maskSize=0, minBlock=1, localMemory=None):
+    """
+    Launches kernel, whose arguments are set, over (width, height, depth) sizes. Uses the parameters tuned for the
+    device, kernel, width and maskSize if any, globalSize and localSize otherwise. Kernels are tuned first when
+    clattr.tuning is True, that is for the jobs of autotune
+
+    Parameters
+    ----------
+    localMemory: function, optional
+        For kernels whose last arguments are local buffers, returns their size in bytes for a (x, y) work-group size
+        (an int for one buffer, a list for several, see setLocalMemory), or None if they do not fit in local memory
+    """
+
+    if clattr.tuning:
+        entry = tune(clattr, kernel, sizes, maskSize, minBlock, localMemory)
+    else:
+        entry = lookup(tuningKey(clattr.device, kernel, sizes[0], maskSize, clattr.dtype))
+    if entry is not None and (localMemory is None or localMemory(entry['localSize']) is not None):
+        localSize, globalSize = launchSizes(clattr, sizes, entry['localSize'], entry['sliceBlock'])
+        if localMemory is not None:
+            setLocalMemory(kernel, localMemory(localSize))
+
+    pr.record(clattr, cl.enqueue_nd_range_kernel(clattr.queue, kernel, globalSize, localSize), kernel.function_name)
+
+def localBuffers(sizes):
+    """
+    Local buffers of sizes bytes: an int for a single buffer, or a list with the size of each buffer
+    """
+
+    sizes = sizes if isinstance(sizes, (list, tuple)) else [sizes]
+    return [cl.LocalMemory(size) for size in sizes]
+
+def setLocalMemory(kernel, sizes):
+    """
+    Sets the local buffers that are the last arguments of kernel, of sizes bytes (see localBuffers)
+    """
+
+    buffers = localBuffers(sizes)
+    for i, buffer in enumerate(buffers):
+        kernel.set_arg(kernel.num_args - len(buffers) + i, buffer)
+
+def autotune(pipeline, shape=(32, 256, 256), platform=None, session=None, dtype=np.uint8):
+    """
+    Tunes the kernels of pipeline for volumes of shape (slices, height, width), by filtering a random volume of that
+    shape. Tuned parameters are used by every later call on volumes of the same width, and saved to the tuning file
+    if set (see setTuningFile)
+
+    Parameters
+    ----------
+    pipeline: list
+        series of filters, as given to run_f3d
+    shape: tuple, optional
+        Shape of the volumes to tune for
+    platform: {pyopencl.Platform, list, dict}, optional
+        Platforms on which kernels are tuned, as in run_f3d
+    session: pyF3D.F3DSession.F3DSession, optional
+        Session whose devices are tuned
+    dtype: np.dtype, optional
+        Type of the volumes to tune for, one of pyF3D.VoxelTypes.voxelTypes
+
+    Returns
+    -------
+    dict
+        Tuned parameters of every kernel, by tuning key
+    """
+
+    from . import FilterManager as fm
+
+    image = np.random.RandomState(0).randint(0, 256, size=shape).astype(dtype)
+    devices = session.devices if session is not None else fm.select_devices(platform, 'opencl')
+    if devices:
+        # only the kernels of these jobs are tuned, other runs going on at the same time are not
+        jobs = fm.createJobs(image, pipeline, np.empty_like(image), devices)
+        for job in jobs:
+            job.tuning = True
+        fm.runJobs(jobs, devices, session=session)
+    with _lock:
+        return dict(_loadEntries())
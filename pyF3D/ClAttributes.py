@@ -3,6 +3,12 @@ import sys
 # from pipeline import msg
 import numpy as np
 import pkg_resources as pkg
+import threading
+import logging
+import pyF3D.MemoryPlanner as mp
+import pyF3D.Profiling as pr
+
+logger = logging.getLogger(__name__)
 
 class ClAttributes(object):
 
@@ -17,22 +23,55 @@ class ClAttributes(object):
         self.outputBuffer = outputBuffer
         self.outputTmpBuffer = outputTmpBuffer
 
-        # multiply by 8 for 8bit images?
-        self.globalMemSize = int(min(self.device.max_mem_alloc_size * 0.3, sys.maxsize >> 1))
-        # self.globalMemSize = int(min(self.device.max_mem_alloc_size * 0.5, sys.maxsize >> 1))
-        #if 'CPU' in self.device.name:
-        #    self.globalMemSize = int(min(self.globalMemSize, 10*1024*1024*8))
+        # device memory budget of the current slabs, see setMaxSliceCount
+        self.memoryBudget = None
+
+        # type of the voxels of the slab buffers, set from the image by initializeData. Filters build their kernels
+        # for it (see pyF3D.VoxelTypes.buildOptions)
+        self.dtype = np.dtype(np.uint8)
 
         self.maxSliceCount = 0
+        # number of slices, including overlap, of the slab currently loaded, and index in the volume of its first slice
+        self.sliceCount = 0
+        self.sliceOffset = 0
+
+        # streaming mode: slab buffers used in rotation and queue used for host<->device transfers
+        self.transferQueue = None
+        self.slots = []
+
+        # (start, end) range of the slab and name of the pipeline stage the work enqueued is attributed to by the
+        # profiler, see pyF3D.Profiling
+        self.profileSlab = None
+        self.profileStage = None
+        # (stage, event) list to which the work enqueued is added while a PipelineExecutor runs
+        self.stageEvents = None
+        # tuning flag of the job being filtered, see pyF3D.Autotuner.enqueue
+        self.tuning = False
+
+        # buffers are taken from and given back to this pool when set (see pyF3D.F3DSession)
+        self.bufferPool = None
+        # free temporary buffers shared by the filters of a pipeline, see acquireTmpBuffer
+        self.tmpBuffers = []
+
+        # slabs are split along z when their columns give less work-items than this per compute unit, see ZBlocking.cl.
+        # False launches over two dimensions only, each work-item filtering the whole depth of its column
+        self.zBlocking = True
+        self.workItemsPerComputeUnit = 2048 if self.device.type & cl.device_type.GPU else 256
 
     def roundUp(self, groupSize, globalSize):
         r = globalSize % groupSize
         return globalSize if r ==0 else globalSize + groupSize - r
 
-    def computeWorkingGroupSize(self, localSize, globalSize, sizes):
+    def computeWorkingGroupSize(self, localSize, globalSize, sizes, minBlock=1):
+        """
+        Sets localSize and globalSize of a launch over (width, height, depth) sizes. With one dimension, one work-item
+        per voxel. With two, one work-item per column. With three, one work-item per column and per block of slices
+        (see sliceBlockCount), the third dimension having one work-item per work-group
+        """
+
         if not localSize or not globalSize or not sizes:
             return False
-        elif len(localSize) <= 0 or len(localSize) > 2 or len(globalSize) <= 0 or len(globalSize) > 2 or len(
+        elif len(localSize) <= 0 or len(localSize) > 3 or len(globalSize) <= 0 or len(globalSize) > 3 or len(
                 sizes) != 3:
             return False
 
@@ -47,22 +86,42 @@ class ClAttributes(object):
 
             localSize[1] = min(int(np.sqrt(self.device.max_work_group_size)), 16)
             globalSize[1] = self.roundUp(localSize[1], sizes[1])
-
+        elif dimensions == 3:
+            localSize[0] = localSize[1] = min(int(np.sqrt(self.device.max_work_group_size)), 16)
+            globalSize[0] = self.roundUp(localSize[0], sizes[0])
+            globalSize[1] = self.roundUp(localSize[1], sizes[1])
+            localSize[2] = 1
+            globalSize[2] = self.sliceBlockCount(sizes, minBlock)
 
         return True
 
-    def setMaxSliceCount(self, image, maxSlice=None):
+    def sliceBlockCount(self, sizes, minBlock=1):
+        """
+        Number of blocks the depth of (width, height, depth) sizes is split into by a three-dimensional launch: enough
+        for the launch to give workItemsPerComputeUnit work-items to each compute unit, without blocks of less than
+        minBlock slices. Kernels that sweep a window along z re-read its halo for each block, and pass its width as
+        minBlock. 1, the two-dimensional behaviour, when zBlocking is False or when the columns fill the device
+        """
 
-        dim = image.shape
-        maxSliceCount = int(self.globalMemSize/(dim[1]*dim[2]*8))
+        if not self.zBlocking:
+            return 1
+        target = self.device.max_compute_units*self.workItemsPerComputeUnit
+        blockCount = -(-target // (sizes[0]*sizes[1]))
+        return int(max(1, min(blockCount, sizes[2] // max(1, minBlock))))
 
+    def setMaxSliceCount(self, image, maxSlice=None, pipeline=None, overlap=0, bufferCount=1):
+        """
+        Sets maxSliceCount to the largest number of slices, including overlap, of slabs of image whose buffers, and
+        those of pipeline, fit in device memory (see MemoryPlanner.planSlab), and at most maxSlice. The budget chosen
+        is kept in memoryBudget
+        """
 
-        if maxSliceCount > dim[0]:
-            maxSliceCount = dim[0]
-        if not maxSlice or maxSlice>maxSliceCount:
-            self.maxSliceCount = maxSliceCount
-        else:
-            self.maxSliceCount = maxSlice
+        dim = image.shape
+        self.memoryBudget = mp.planSlab(self.device, pipeline or [], dim[2], dim[1], image.dtype, overlap, bufferCount,
+                                        maxSlice, dim[0], self.bufferPool)
+        self.maxSliceCount = self.memoryBudget['maxSliceCount']
+        if not self.memoryBudget['fits']:
+            logger.warning("Slabs of %d slices do not fit in the memory of %s", 1 + 2*overlap, self.device.name)
 
     def initializeData(self, image, atts, overlapAmount, maxSliceCount):
         """
@@ -82,16 +141,88 @@ class ClAttributes(object):
         atts.sliceEnd = -1
 
         atts.channels = 1 # for greyscale
+        self.dtype = np.dtype(image.dtype)
 
         if maxSliceCount <= 0:
             return False
 
-        totalSize = (atts.width * atts.height * maxSliceCount)*8
+        # a slab of one slice is loaded with overlapAmount slices on each side
+        sliceCount = min(atts.slices, max(maxSliceCount, 1 + 2*overlapAmount))
+        totalSize = self.slabBytes(atts.width, atts.height, sliceCount)
+
+        # buffers of a previous job are reused if they are large enough
+        if self.inputBuffer is not None and self.inputBuffer.size >= totalSize and \
+                self.outputBuffer.size >= totalSize:
+            return True
+
+        self.releaseBuffers()
+        self.inputBuffer = self.allocateBuffer(totalSize)
+        self.outputBuffer = self.allocateBuffer(totalSize)
+        return True
+
+    def slabBytes(self, width, height, sliceCount, dtype=None):
+        """
+        Size of each of the input and output buffers of slabs of sliceCount slices of dtype voxels (the type of the
+        current image by default)
+        """
+
+        dtype = self.dtype if dtype is None else np.dtype(dtype)
+        return (width * height * sliceCount)*dtype.itemsize
+
+    def allocateBuffer(self, size):
+        """
+        Returns a read/write device buffer of at least size bytes, taken from bufferPool if set
+        """
+
+        if self.bufferPool is not None:
+            return self.bufferPool.acquire(size)
+        return cl.Buffer(self.context, cl.mem_flags.READ_WRITE, size)
+
+    def freeBuffer(self, buffer):
+        """
+        Gives buffer back to bufferPool if set, otherwise releases it
+        """
+
+        if self.bufferPool is not None:
+            self.bufferPool.giveBack(buffer)
+        else:
+            buffer.release()
+
+    def initializeTmpBuffer(self):
+        """
+        Takes the temporary buffer used by multi-pass filters from the temporary buffers, unless the current one is
+        large enough
+        """
 
-        self.inputBuffer = cl.Buffer(self.context, cl.mem_flags.READ_WRITE, totalSize)
-        self.outputBuffer = cl.Buffer(self.context, cl.mem_flags.READ_WRITE, totalSize)
+        size = self.inputBuffer.size
+        if self.outputTmpBuffer is not None and self.outputTmpBuffer.size >= size:
+            return False
+        if self.outputTmpBuffer is not None:
+            self.giveBackTmpBuffer(self.outputTmpBuffer)
+        self.outputTmpBuffer = self.acquireTmpBuffer(size)
         return True
 
+    def acquireTmpBuffer(self, size=None):
+        """
+        Returns a free temporary buffer of at least size bytes (the size of a slab buffer by default), or allocates
+        one. Temporary buffers are kept until releaseBuffers, so the filters of a pipeline and successive slabs reuse
+        the same buffers instead of allocating their own
+        """
+
+        size = self.inputBuffer.size if size is None else size
+        for i, buffer in enumerate(self.tmpBuffers):
+            if buffer.size >= size:
+                return self.tmpBuffers.pop(i)
+        return self.allocateBuffer(size)
+
+    def giveBackTmpBuffer(self, buffer):
+        """
+        Makes a buffer returned by acquireTmpBuffer available to later calls. Work already enqueued on the queue that
+        uses it is not affected, as later work is enqueued in order on the same queue
+        """
+
+        self.tmpBuffers.append(buffer)
+
 
     def loadNextData(self, image, atts, startRange, endRange, overlap):
 
@@ -99,26 +230,252 @@ class ClAttributes(object):
         maxIndex = min(atts.slices, endRange + overlap)
 
         im = image[minIndex:maxIndex, :, :]
+        self.sliceCount = maxIndex - minIndex
+        self.sliceOffset = minIndex
         dim = im.shape
         im = np.reshape(im, dim[0]*dim[1]*dim[2])
-        cl.enqueue_copy(self.queue, self.inputBuffer, im)
+        pr.record(self, cl.enqueue_copy(self.queue, self.inputBuffer, im), 'upload', 'upload')
         return True
 
-    def writeNextData(self, atts, startRange, endRange, overlap):
-        startIndex = 0 if startRange==0 else overlap
+    def writeNextData(self, atts, startRange, endRange, overlap, output=None):
+        """
+        Reads filtered slab from output buffer. If output volume is given, slab is copied directly into its z-range
+        [startRange, endRange)
+        """
+
+        # slabs starting within overlap of the first slice have fewer slices loaded before them
+        startIndex = min(startRange, overlap)
         length = endRange - startRange
-        output = np.empty((length + startIndex+overlap)*atts.width*atts.height).astype(np.uint8)
-        cl.enqueue_copy(self.queue, output, self.outputBuffer)
-        output = output.reshape((startIndex+length+overlap), atts.height, atts.width)
+        if output is not None:
+            dest = output[startRange:endRange]
+            pr.record(self, cl.enqueue_copy(self.queue, dest, self.outputBuffer,
+                                            src_offset=startIndex*atts.width*atts.height*dest.itemsize),
+                      'download', 'download')
+            return dest
+
+        output = np.empty(self.sliceCount*atts.width*atts.height, dtype=self.dtype)
+        pr.record(self, cl.enqueue_copy(self.queue, output, self.outputBuffer), 'download', 'download')
+        output = output.reshape(self.sliceCount, atts.height, atts.width)
         output = output[startIndex:startIndex+length]
         return output
 
+    def initializeStreaming(self, bufferCount):
+        """
+        Allocates bufferCount sets of input/output slab buffers and a separate transfer queue, so that the upload of
+        the next slab and the download of the previous slab overlap with filtering of the current slab.
+        initializeData must be called first; its buffers are used as the first slot. Slots of a previous job are
+        reused if they are large enough
+        """
+
+        if bufferCount < 2 or self.inputBuffer is None:
+            return False
+
+        if self.transferQueue is None:
+            self.transferQueue = pr.createQueue(self.context, self.device)
+
+        size = self.inputBuffer.size
+        if len(self.slots) == bufferCount and all(slot.inputBuffer.size >= size and slot.outputBuffer.size >= size
+                                                  for slot in self.slots):
+            return True
+
+        current = (self.inputBuffer, self.outputBuffer)
+        for slot in self.slots:
+            for buffer in (slot.inputBuffer, slot.outputBuffer):
+                if not any(buffer is b for b in current):
+                    self.freeBuffer(buffer)
+        self.slots = [StreamSlot(self.inputBuffer, self.outputBuffer)]
+        for i in range(bufferCount - 1):
+            self.slots.append(StreamSlot(self.allocateBuffer(self.inputBuffer.size),
+                                         self.allocateBuffer(self.outputBuffer.size)))
+        return True
+
+    def loadNextDataAsync(self, slot, image, atts, startRange, endRange, overlap):
+        """
+        Non-blocking version of loadNextData: uploads slab into slot's input buffer on the transfer queue, once the
+        previous download from the slot has finished
+        """
+
+        minIndex = max(0, startRange - overlap)
+        maxIndex = min(atts.slices, endRange + overlap)
+
+        # host array must stay alive until the copy has completed
+        slot.uploadData = np.ascontiguousarray(image[minIndex:maxIndex, :, :]).reshape(-1)
+        waitFor = [slot.downloadEvent] if slot.downloadEvent is not None else None
+        slot.uploadEvent = cl.enqueue_copy(self.transferQueue, slot.inputBuffer, slot.uploadData, is_blocking=False,
+                                           wait_for=waitFor)
+        pr.record(self, slot.uploadEvent, 'upload', 'upload', (startRange, endRange))
+        slot.startRange = startRange
+        slot.endRange = endRange
+        slot.sliceCount = maxIndex - minIndex
+        slot.sliceOffset = minIndex
+        return True
+
+    def useSlot(self, slot):
+        """
+        Makes slot's buffers the current input/output buffers. Work enqueued afterwards on the compute queue waits
+        for the slot's upload
+        """
+
+        self.inputBuffer = slot.inputBuffer
+        self.outputBuffer = slot.outputBuffer
+        self.sliceCount = slot.sliceCount
+        self.sliceOffset = slot.sliceOffset
+        if slot.uploadEvent is not None:
+            cl.enqueue_barrier(self.queue, wait_for=[slot.uploadEvent])
+
+    def writeNextDataAsync(self, slot, atts, overlap, output=None):
+        """
+        Non-blocking version of writeNextData: enqueues download of current output buffer on the transfer queue once
+        all filters enqueued on the compute queue have finished. Result is available from finishNextData
+        """
+
+        # filters may have swapped buffers, keep track of which buffers now belong to the slot
+        slot.inputBuffer = self.inputBuffer
+        slot.outputBuffer = self.outputBuffer
+
+        startIndex = min(slot.startRange, overlap)
+        computeDone = cl.enqueue_marker(self.queue)
+        if output is not None:
+            slot.downloadData = output[slot.startRange:slot.endRange]
+            slot.downloadEvent = cl.enqueue_copy(self.transferQueue, slot.downloadData, slot.outputBuffer,
+                                                 src_offset=startIndex*atts.width*atts.height*output.itemsize,
+                                                 is_blocking=False, wait_for=[computeDone])
+            startIndex = 0
+        else:
+            slot.downloadData = np.empty(slot.sliceCount*atts.width*atts.height, dtype=self.dtype)
+            slot.downloadEvent = cl.enqueue_copy(self.transferQueue, slot.downloadData, slot.outputBuffer,
+                                                 is_blocking=False, wait_for=[computeDone])
+        pr.record(self, slot.downloadEvent, 'download', 'download', (slot.startRange, slot.endRange))
+        slot.downloadRange = (slot.startRange, slot.endRange, startIndex)
+        slot.uploadEvent = None
+        slot.uploadData = None
+        return True
+
+    def finishNextData(self, slot, atts):
+        """
+        Waits for slot's download and returns the filtered slab without overlap, along with its range
+        """
+
+        slot.downloadEvent.wait()
+        startRange, endRange, startIndex = slot.downloadRange
+        output = slot.downloadData.reshape(-1, atts.height, atts.width)
+        output = output[startIndex:startIndex+endRange-startRange]
+        slot.downloadData = None
+        slot.downloadEvent = None
+        return startRange, endRange, output
+
+    def releaseBuffers(self):
+        """
+        Releases input, output and temporary buffers along with the buffers of all streaming slots
+        """
+
+        buffers = [self.inputBuffer, self.outputBuffer, self.outputTmpBuffer] + self.tmpBuffers
+        for slot in self.slots:
+            buffers += [slot.inputBuffer, slot.outputBuffer]
+
+        # filters swap buffers, so the same buffer can be referenced several times
+        released = []
+        for buffer in buffers:
+            if buffer is not None and not any(buffer is b for b in released):
+                self.freeBuffer(buffer)
+                released.append(buffer)
+
+        self.slots = []
+        self.tmpBuffers = []
+        self.inputBuffer = None
+        self.outputBuffer = None
+        self.outputTmpBuffer = None
+
     def swapBuffers(self):
 
         tmpBuffer = self.inputBuffer
         self.inputBuffer = self.outputBuffer
         self.outputBuffer = tmpBuffer
 
+class StreamSlot(object):
+    """
+    Set of slab buffers used in streaming mode, along with the events of its pending transfers
+    """
+
+    def __init__(self, inputBuffer, outputBuffer):
+        self.inputBuffer = inputBuffer
+        self.outputBuffer = outputBuffer
+        self.uploadEvent = None
+        self.downloadEvent = None
+        self.uploadData = None
+        self.downloadData = None
+        self.startRange = 0
+        self.endRange = 0
+        self.sliceCount = 0
+        self.sliceOffset = 0
+        self.downloadRange = None
+
+class BufferPool(object):
+    """
+    Device buffers of one context kept for reuse. Requested sizes are rounded up to a power of two (or to
+    maxSize), so that slabs of slightly different sizes share the same buffers
+
+    Parameters
+    ----------
+    context: pyopencl.Context
+        Context in which buffers are allocated
+    maxSize: int, optional
+        Largest buffer that can be allocated, usually device.max_mem_alloc_size
+    """
+
+    def __init__(self, context, maxSize=None):
+        self.context = context
+        self.maxSize = maxSize
+        self.free = {}
+        self.lock = threading.Lock()
+
+    def bucketSize(self, size):
+        bucket = 1
+        while bucket < size:
+            bucket *= 2
+        if self.maxSize is not None and bucket > self.maxSize >= size:
+            return self.maxSize
+        return bucket
+
+    def acquire(self, size):
+        """
+        Returns a free buffer of the bucket of size, or allocates one
+        """
+
+        bucket = self.bucketSize(size)
+        with self.lock:
+            buffers = self.free.get(bucket)
+            if buffers:
+                return buffers.pop()
+        return cl.Buffer(self.context, cl.mem_flags.READ_WRITE, bucket)
+
+    def giveBack(self, buffer):
+        """
+        Makes buffer available to later calls of acquire
+        """
+
+        with self.lock:
+            self.free.setdefault(buffer.size, []).append(buffer)
+
+    def freeSize(self):
+        """
+        Number of bytes held by free buffers
+        """
+
+        with self.lock:
+            return sum(size*len(buffers) for size, buffers in self.free.items())
+
+    def clear(self):
+        """
+        Releases all free buffers
+        """
+
+        with self.lock:
+            for buffers in self.free.values():
+                for buffer in buffers:
+                    buffer.release()
+            self.free = {}
+
 def create_cl_attributes():
     """
     Creates a OpenCL context, along with its corresponding  device and  commandqueue
@@ -132,7 +489,7 @@ def create_cl_attributes():
 
     context = cl.create_some_context()
     device = context.devices[0]
-    queue = cl.CommandQueue(context, device)
+    queue = pr.createQueue(context, device)
 
     return context, device, queue
 
@@ -0,0 +1,314 @@
+import numpy as np
+import pyF3D.VoxelTypes as vt
+
+def shiftedViews(data, offsets, padValue):
+    """
+    Yields views of data shifted by each (dz, dy, dx) offset. Voxels shifted in from outside of data are set to
+    padValue
+    """
+
+    offsets = list(offsets)
+    pad = [max(abs(o[axis]) for o in offsets) for axis in range(3)]
+    padded = np.pad(data, [(p, p) for p in pad], mode='constant', constant_values=padValue)
+    depth, height, width = data.shape
+    for dz, dy, dx in offsets:
+        yield padded[pad[0] + dz:pad[0] + dz + depth,
+                     pad[1] + dy:pad[1] + dy + height,
+                     pad[2] + dx:pad[2] + dx + width]
+
+def maskOffsets(mask):
+    """
+    Returns (dz, dy, dx) offsets of nonzero elements of a structuring element, relative to its center
+    """
+
+    center = [s // 2 for s in mask.shape]
+    return [(z - center[0], y - center[1], x - center[2]) for z, y, x in zip(*np.nonzero(mask))]
+
+def median3D(data, radius=1):
+    """
+    Median filter over (2*radius + 1)^3 windows returning, as the OpenCL kernels, the max(1, n/2)-th smallest of the
+    n neighbours of each voxel inside of the volume and not NaN. Full windows are partitioned, the windows of voxels
+    near the borders sorted. Windows are gathered one slice at a time
+    """
+
+    width = 2*radius + 1
+    windowSize = width**3
+    kth = windowSize//2 - 1
+    # integer volumes are filtered as float32, which holds all of their values, so that the padding is NaN
+    values = data if vt.isFloat(data.dtype) else data.astype(np.float32)
+    padded = np.pad(values, radius, mode='constant', constant_values=np.nan)
+    windows = np.lib.stride_tricks.as_strided(padded, shape=data.shape + (width, width, width),
+                                              strides=padded.strides*2, writeable=False)
+    output = np.empty_like(data)
+    for z in range(data.shape[0]):
+        neighbours = windows[z].reshape(data.shape[1:] + (-1,))
+        counts = windowSize - np.isnan(neighbours).sum(axis=-1)
+        medians = np.partition(neighbours, kth, axis=-1)[..., kth]
+        partial = counts < windowSize
+        if partial.any():
+            ordered = np.sort(neighbours[partial], axis=-1)
+            ranks = np.maximum(1, counts[partial]//2) - 1
+            medians[partial] = ordered[np.arange(len(ranks)), ranks]
+        output[z] = medians
+    return output
+
+def dilate3D(data, masks):
+    """
+    Grey-level dilation: maximum over the nonzero elements of each structuring element, then maximum over all
+    structuring elements
+    """
+
+    output = np.full_like(data, vt.lowest(data.dtype))
+    for mask in masks:
+        offsets = maskOffsets(mask)
+        if not offsets:
+            continue
+        for view in shiftedViews(data, offsets, vt.lowest(data.dtype)):
+            np.maximum(output, view, out=output)
+    return output
+
+def erode3D(data, masks):
+    """
+    Grey-level erosion: minimum over the nonzero elements of each structuring element, then minimum over all
+    structuring elements. Out-of-bounds voxels are ignored
+    """
+
+    output = np.full_like(data, vt.highest(data.dtype))
+    for mask in masks:
+        offsets = maskOffsets(mask)
+        if not offsets:
+            continue
+        for view in shiftedViews(data, offsets, vt.highest(data.dtype)):
+            np.minimum(output, view, out=output)
+    return output
+
+def gaussianWeights(radius):
+    """
+    Normalized weights of the spatial and range kernels of the bilateral filter for a given radius. Only the first
+    2*radius + 1 weights, centered on index radius, are used
+    """
+
+    radius = radius + 1
+    size = radius**2 - 1
+    x = (np.arange(size, dtype=np.float32) + 1 - radius) / (radius * 2) / np.float32(0.2)
+    weights = np.exp(-0.5 * x * x).astype(np.float32)
+    total = weights.sum(dtype=np.float32)
+    return weights / total if total > 0 else np.full(size, 1.0 / size, dtype=np.float32)
+
+def bilateralValues(data):
+    """
+    data as the tile values of the bilateral kernels (see Voxel.cl), padded with VALUE_NONE: -1 for integer types,
+    NaN for np.float32
+    """
+
+    if vt.isFloat(data.dtype):
+        return data.astype(np.float32), np.nan
+    return data.astype(vt.tileTypes[vt.voxelType(data.dtype)]), -1
+
+# largest radius, in entries, of the range kernels of the bilateral filter. Integer range radii of integer volumes up
+# to it get one weight per grey level, larger radii and those of float volumes are sampled
+maxRangeTableRadius = 1024
+
+def rangeTable(rangeRadius, dtype):
+    """
+    Range kernel of the bilateral filter for a range radius in grey levels of dtype, computed on the host: 2*r + 1
+    weights centered on index r, and the scale converting a difference of grey levels to an offset from the center. The
+    weights are those of gaussianWeights for integer range radii up to maxRangeTableRadius (scale 1), and otherwise a
+    gaussian of radius maxRangeTableRadius, not normalized as this cancels out in value/total
+    """
+
+    if rangeRadius <= 0:
+        return np.ones(1, dtype=np.float32), np.float32(1.0)
+    if not vt.isFloat(dtype) and rangeRadius == int(rangeRadius) and rangeRadius <= maxRangeTableRadius:
+        radius = int(rangeRadius)
+        return gaussianWeights(radius)[:2 * radius + 1], np.float32(1.0)
+    radius = maxRangeTableRadius
+    x = np.arange(-radius, radius + 1, dtype=np.float32) / np.float32(0.4 * (radius + 1))
+    return np.exp(np.float32(-0.5) * x * x).astype(np.float32), np.float32(radius / float(rangeRadius))
+
+def bilateralWeights(view, diff, rangeRadius, rangeKernel, rangeScale):
+    """
+    Validity and range weight of neighbours view differing by diff from the center, as rangeWeight in
+    BilateralFiltering.cl, from the kernel and scale of rangeTable
+    """
+
+    rangeRadius = np.float32(rangeRadius)
+    if vt.isFloat(view.dtype):
+        valid = ~np.isnan(diff) & (np.abs(diff) <= rangeRadius)
+    else:
+        valid = (view >= 0) & (np.abs(diff) <= rangeRadius)
+    offset = np.rint(np.where(valid, diff, 0).astype(np.float32) * rangeScale).astype(np.intp)
+    return valid, rangeKernel[offset + len(rangeKernel) // 2]
+
+def bilateral3D(data, spatialRadius, rangeRadius):
+    """
+    Bilateral filter over a (2*spatialRadius+1)^3 neighbourhood. Neighbours whose value differs from the center by
+    more than rangeRadius are ignored. As in the OpenCL kernel, the spatial weight only depends on the x and y offsets
+    """
+
+    spatialKernel = gaussianWeights(spatialRadius)
+    rangeKernel, rangeScale = rangeTable(rangeRadius, data.dtype)
+    sc = spatialRadius
+
+    center, none = bilateralValues(data)
+    value = np.zeros(data.shape, dtype=np.float32)
+    total = np.zeros(data.shape, dtype=np.float32)
+    offsets = [(dz, dy, dx) for dz in range(-sc, sc + 1) for dy in range(-sc, sc + 1) for dx in range(-sc, sc + 1)]
+    for (dz, dy, dx), view in zip(offsets, shiftedViews(center, offsets, none)):
+        valid, rangeWeight = bilateralWeights(view, view - center, rangeRadius, rangeKernel, rangeScale)
+        w = np.where(valid, spatialKernel[dy + sc] * spatialKernel[dx + sc] * rangeWeight, np.float32(0))
+        value += np.where(valid, view, 0).astype(np.float32) * w
+        total += w
+    return vt.toVoxel(value / total, data.dtype)
+
+def bilateralLine3D(data, axis, spatialRadius, rangeRadius, rounding=0.0):
+    """
+    One-dimensional bilateral filter along axis (0 for z, 1 for y, 2 for x), as the BilateralFilterLine kernel.
+    rounding is added before conversion to the type of data
+    """
+
+    spatialKernel = gaussianWeights(spatialRadius)
+    rangeKernel, rangeScale = rangeTable(rangeRadius, data.dtype)
+    sc = spatialRadius
+
+    center, none = bilateralValues(data)
+    value = np.zeros(data.shape, dtype=np.float32)
+    total = np.zeros(data.shape, dtype=np.float32)
+    offsets = [tuple(k if i == axis else 0 for i in range(3)) for k in range(-sc, sc + 1)]
+    for k, view in zip(range(-sc, sc + 1), shiftedViews(center, offsets, none)):
+        valid, rangeWeight = bilateralWeights(view, view - center, rangeRadius, rangeKernel, rangeScale)
+        w = np.where(valid, spatialKernel[k + sc] * rangeWeight, np.float32(0))
+        value += np.where(valid, view, 0).astype(np.float32) * w
+        total += w
+    return vt.toVoxel(value / total + np.float32(rounding), data.dtype)
+
+def bilateralSeparable3D(data, spatialRadius, rangeRadius):
+    """
+    Separable approximation of the bilateral filter: one-dimensional bilateral filters along x, y then z, the first
+    two rounded to the nearest value for integer types
+    """
+
+    rounding = 0.0 if vt.isFloat(data.dtype) else 0.5
+    data = bilateralLine3D(data, 2, spatialRadius, rangeRadius, rounding)
+    data = bilateralLine3D(data, 1, spatialRadius, rangeRadius, rounding)
+    return bilateralLine3D(data, 0, spatialRadius, rangeRadius)
+
+def mask3D(data, mask):
+    """
+    Multiplies data by binary mask scaled to [0, 1]
+    """
+
+    return vt.toVoxel(data * (mask.astype(np.float32) / np.float32(255.0)), data.dtype)
+
+def reflectIndices(length, n):
+    """
+    Indices of the voxels read for an axis of n voxels padded by reflection to length, as reflectIndex in
+    FFTFilter.cl
+    """
+
+    i = np.arange(length)
+    if n == 1:
+        return np.zeros(length, dtype=np.intp)
+    period = 2 * (n - 1)
+    i = i % period
+    return np.where(i < n, i, period - i)
+
+def butterworth(f, cutoff, order):
+    return np.float32(1.0) / (np.float32(1.0) + (f / np.float32(cutoff)) ** (2 * order))
+
+def fftGain(shape, axes, mode, cutoff, lowCutoff, highCutoff, order, sigma, stripeAxis):
+    """
+    Transfer function of FFTFilterSpectrum for a spectrum of (slices, height, width) shape transformed along axes (0
+    for x, 1 for y, 2 for z)
+    """
+
+    squared = np.zeros((1, 1, 1), dtype=np.float32)
+    otherSquared = np.zeros((1, 1, 1), dtype=np.float32)
+    stripeFrequency = np.zeros((1, 1, 1), dtype=np.float32)
+    for axis in axes:
+        n = shape[2 - axis]
+        f = np.fft.fftfreq(n).astype(np.float32).reshape([n if i == 2 - axis else 1 for i in range(3)])
+        squared = squared + f * f
+        if axis == stripeAxis:
+            stripeFrequency = f
+        else:
+            otherSquared = otherSquared + f * f
+    f = np.sqrt(squared)
+
+    if mode == 'lowpass':
+        return butterworth(f, cutoff, order)
+    if mode == 'highpass':
+        return np.where(f == 0, np.float32(1.0), 1 - butterworth(f, cutoff, order))
+    if mode == 'bandpass':
+        gain = butterworth(f, highCutoff, order) * (1 - butterworth(f, lowCutoff, order))
+        return np.where(f == 0, np.float32(1.0), gain)
+    band = np.exp(-stripeFrequency * stripeFrequency / np.float32(2 * sigma * sigma)) * \
+        (1 - butterworth(np.sqrt(otherSquared), cutoff, order))
+    return 1 - band if mode == 'stripes' else band
+
+def fftFilter3D(data, paddedShape, axes, mode, cutoff, lowCutoff, highCutoff, order, sigma, stripeAxis):
+    """
+    Frequency-domain filter of data padded by reflection to paddedShape, along axes (0 for x, 1 for y, 2 for z). See
+    pyF3D.filters.FFTFilter.FFTFilter for the modes and parameters
+    """
+
+    index = np.ix_(*[reflectIndices(m, n) for m, n in zip(paddedShape, data.shape)])
+    volume = data[index].astype(np.float32)
+    numpyAxes = tuple(2 - axis for axis in axes)
+    spectrum = np.fft.fftn(volume, axes=numpyAxes)
+    spectrum *= fftGain(volume.shape, axes, mode, cutoff, lowCutoff, highCutoff, order, sigma, stripeAxis)
+    result = np.fft.ifftn(spectrum, axes=numpyAxes).real
+    return vt.toVoxel(result[:data.shape[0], :data.shape[1], :data.shape[2]], data.dtype, True)
+
+def sampleSlices(data, x, y):
+    """
+    Bilinear interpolation of every slice of data at positions (x, y), clamped to the slices, as sampleSlice in
+    FFTFilter.cl
+    """
+
+    height, width = data.shape[1:]
+    x = np.clip(x, 0, width - 1)
+    y = np.clip(y, 0, height - 1)
+    x0 = np.minimum(x.astype(np.intp), max(width - 2, 0))
+    y0 = np.minimum(y.astype(np.intp), max(height - 2, 0))
+    x1 = np.minimum(x0 + 1, width - 1)
+    y1 = np.minimum(y0 + 1, height - 1)
+    fx = (x - x0).astype(np.float32)
+    fy = (y - y0).astype(np.float32)
+    top = data[:, y0, x0] * (1 - fx) + data[:, y0, x1] * fx
+    bottom = data[:, y1, x0] * (1 - fx) + data[:, y1, x1] * fx
+    return top * (1 - fy) + bottom * fy
+
+def removeRings3D(data, angles, radii, samples, centerX, centerY, cutoff, order, sigma):
+    """
+    Ring artifact suppression of each slice: the slice is resampled on a polar grid of angles x radii centered on
+    (centerX, centerY), rings are estimated as the components of the grid constant along angles, above cutoff along
+    radii, and subtracted. Mirrors FFTToPolar, FFTFilterSpectrum and FFTRemoveRings
+    """
+
+    angle = np.float32(2 * np.pi) * np.arange(angles, dtype=np.float32) / np.float32(angles)
+    radius = reflectIndices(radii, samples).astype(np.float32)
+    x = np.float32(centerX) + radius[:, None] * np.cos(angle)[None, :]
+    y = np.float32(centerY) + radius[:, None] * np.sin(angle)[None, :]
+    polar = sampleSlices(data.astype(np.float32), x, y)
+
+    spectrum = np.fft.fft2(polar, axes=(1, 2))
+    spectrum *= fftGain(polar.shape, [0, 1], 'rings', cutoff, 0, 0, order, sigma, 0)
+    rings = np.fft.ifft2(spectrum, axes=(1, 2)).real.astype(np.float32)
+
+    height, width = data.shape[1:]
+    dy, dx = np.mgrid[0:height, 0:width].astype(np.float32)
+    dx -= np.float32(centerX)
+    dy -= np.float32(centerY)
+    r = np.minimum(np.sqrt(dx * dx + dy * dy), np.float32(samples - 1))
+    a = np.arctan2(dy, dx) / np.float32(2 * np.pi) * np.float32(angles)
+    a[a < 0] += angles
+    a0 = a.astype(np.intp) % angles
+    a1 = (a0 + 1) % angles
+    r0 = np.minimum(r.astype(np.intp), max(samples - 2, 0))
+    r1 = np.minimum(r0 + 1, samples - 1)
+    fa = a - a.astype(np.intp)
+    fr = r - r0
+    inner = rings[:, r0, a0] * (1 - fa) + rings[:, r0, a1] * fa
+    outer = rings[:, r1, a0] * (1 - fa) + rings[:, r1, a1] * fa
+    return vt.toVoxel(data - (inner * (1 - fr) + outer * fr), data.dtype, True)
@@ -0,0 +1,83 @@
+import pyopencl as cl
+from . import ClAttributes
+from . import FilterManager as fm
+from . import Profiling as pr
+from . import ProgramCache as pc
+
+class DeviceContext(object):
+    """
+    OpenCL context, command queues and buffer pool of one device, kept alive by a F3DSession
+    """
+
+    def __init__(self, device, maxSliceCount=None):
+        self.device = device
+        self.maxSliceCount = maxSliceCount
+        self.context = cl.Context([device])
+        self.queue = pr.createQueue(self.context, device)
+        # second in-order queue on which slabs are uploaded and downloaded while the other queue runs kernels
+        self.transferQueue = pr.createQueue(self.context, device)
+        self.bufferPool = ClAttributes.BufferPool(self.context, maxSize=device.max_mem_alloc_size)
+
+    def newClAttributes(self):
+        """
+        Returns ClAttributes that use the context, queues and buffer pool of the device
+        """
+
+        clattr = ClAttributes.ClAttributes(self.context, self.device, self.queue, None, None, None)
+        clattr.bufferPool = self.bufferPool
+        clattr.transferQueue = self.transferQueue
+        return clattr
+
+class F3DSession(object):
+    """
+    Set of OpenCL devices whose contexts, command queues, compiled programs and device buffers are kept between
+    calls. Creating contexts, building programs and allocating buffers is done once per session instead of once
+    per call, which matters when filtering many small volumes. Can be used as a context manager, in which case
+    buffers are released on exit
+
+    Parameters
+    ----------
+    platform: {pyopencl.Platform, list, dict}, optional
+        Platforms on which calculations are performed, as in run_f3d
+    backend: str, optional
+        Either 'opencl', 'cpu' or 'auto' (default), as in run_f3d. With 'cpu', or with 'auto' when no OpenCL device
+        is found, the session holds no device and the NumPy implementation is used
+    """
+
+    def __init__(self, platform=None, backend='auto'):
+        self.backend = backend
+        self.deviceContexts = {}
+        for device, maxSliceCount in fm.select_devices(platform, backend).items():
+            self.deviceContexts[device] = DeviceContext(device, maxSliceCount)
+
+    @property
+    def devices(self):
+        """
+        pyopencl.Device and maximum slice count (or None) key/value pairs, as returned by get_devices
+        """
+        return dict((d, dc.maxSliceCount) for d, dc in self.deviceContexts.items())
+
+    def deviceContext(self, device):
+        return self.deviceContexts[device]
+
+    def pooledSize(self):
+        """
+        Number of bytes of device memory held by free pooled buffers
+        """
+        return sum(dc.bufferPool.freeSize() for dc in self.deviceContexts.values())
+
+    def close(self):
+        """
+        Releases pooled buffers, and the programs and constant buffers cached for the contexts of the session. The
+        session can still be used afterwards, buffers are then allocated and programs built again
+        """
+
+        for dc in self.deviceContexts.values():
+            dc.bufferPool.clear()
+            pc.clearProgramCache(dc.context)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,181 @@
+import numpy as np
+import pyopencl as cl
+import pyF3D.ProgramCache as pc
+import pyF3D.VoxelTypes as vt
+import pyF3D.Profiling as pr
+
+# largest factor of the lengths transformed on OpenCL devices, MAX_RADIX in FFTFilter.cl. Factors are transformed by
+# O(radix^2) butterflies, so lengths with a larger prime factor are transformed with NumPy (see fft3D) or padded (see
+# fastLength)
+maxRadix = 16
+# radices tried in order when factoring a length, 4 first to halve the passes over powers of two
+radices = [4, 2, 3, 5, 7, 11, 13]
+# factors of the lengths returned by fastLength
+fastRadices = [2, 3, 5, 7]
+
+axisNames = 'xyz'
+
+def factorize(n, radixList=None):
+    """
+    Radices of the passes of a transform of length n, or None if n has a prime factor not in radixList (radices by
+    default)
+    """
+
+    radixList = radices if radixList is None else radixList
+    factors = []
+    for radix in radixList:
+        while n % radix == 0 and n > 1:
+            factors.append(radix)
+            n //= radix
+    return factors if n == 1 else None
+
+def fastLength(n):
+    """
+    Smallest length of at least n whose only prime factors are 2, 3, 5 and 7
+    """
+
+    n = max(1, int(n))
+    while factorize(n, fastRadices) is None:
+        n += 1
+    return n
+
+def parseAxes(axes):
+    """
+    Indices (0 for x, 1 for y, 2 for z) of the axes of a string such as 'xy'
+    """
+
+    indices = []
+    for name in axes:
+        if name not in axisNames:
+            raise ValueError("axes must only contain 'x', 'y' and 'z'")
+        if axisNames.index(name) not in indices:
+            indices.append(axisNames.index(name))
+    return indices
+
+class FFTEngine(object):
+    """
+    Mixed-radix FFT of complex float2 volumes along one axis at a time on the device of clattr, by the Stockham passes
+    of FFTFilter.cl. Each pass reads one buffer and writes the other, so transforms need a scratch buffer of the same
+    size as the data
+
+    Parameters
+    ----------
+    clattr: pyF3D.ClAttributes.ClAttributes
+        Context, device and queue on which transforms run. The load and store kernels of the program are built for
+        slabs of clattr.dtype voxels
+    """
+
+    def __init__(self, clattr):
+        self.clattr = clattr
+        self.program = pc.getProgram(clattr.context, "FFTFilter.cl", options=["-D", "MAX_RADIX=%d" % maxRadix] +
+                                      vt.buildOptions(clattr.dtype))
+        # passes of radices with a kernel of their own
+        self.stageKernels = {2: cl.Kernel(self.program, "FFTStage2"), 4: cl.Kernel(self.program, "FFTStage4")}
+        self.stageKernel = cl.Kernel(self.program, "FFTStage")
+
+    def launch(self, kernel, count):
+        """
+        Launches kernel, whose arguments are set, with at least count work-items over one dimension
+        """
+
+        globalSize = [0]
+        localSize = [0]
+        self.clattr.computeWorkingGroupSize(localSize, globalSize, [count, 1, 1])
+        groupSize = kernel.get_work_group_info(cl.kernel_work_group_info.WORK_GROUP_SIZE, self.clattr.device)
+        if localSize[0] > groupSize:
+            localSize[0] = groupSize
+            globalSize[0] = self.clattr.roundUp(groupSize, count)
+        pr.record(self.clattr, cl.enqueue_nd_range_kernel(self.clattr.queue, kernel, globalSize, localSize),
+                  kernel.function_name)
+
+    def transform(self, buffer, scratch, sizes, axis, inverse=False):
+        """
+        Transforms the complex volume of (width, height, depth) sizes in buffer along axis (0 for x, 1 for y, 2 for
+        z). Inverse transforms are scaled by 1/n, as numpy.fft.ifft
+
+        Returns
+        -------
+        pyopencl.Buffer
+            buffer or scratch, whichever holds the result. The other one is overwritten
+        """
+
+        n = sizes[axis]
+        factors = factorize(n)
+        if factors is None:
+            raise ValueError('length %d has a prime factor larger than %d' % (n, maxRadix))
+
+        sign = 1.0 if inverse else -1.0
+        count = sizes[0]*sizes[1]*sizes[2]
+        stride = 1
+        for i, radix in enumerate(factors):
+            scale = 1.0/n if inverse and i == len(factors) - 1 else 1.0
+            kernel = self.stageKernels.get(radix, self.stageKernel)
+            kernel.set_args(buffer, scratch, np.int32(sizes[0]), np.int32(sizes[1]), np.int32(sizes[2]), np.int32(axis),
+                            np.int32(radix), np.int32(stride), np.float32(sign), np.float32(scale))
+            self.launch(kernel, count // radix)
+            buffer, scratch = scratch, buffer
+            stride *= radix
+        return buffer
+
+def fft3D(data, axes='xyz', inverse=False, platform=None, backend='auto'):
+    """
+    Discrete Fourier transform of a volume along some of its axes, as numpy.fft.fftn
+
+    Parameters
+    ----------
+    data: ndarray
+        3D data of shape (slices, height, width). Transformed as np.complex64
+    axes: str, optional
+        Axes along which data is transformed, among 'x', 'y' and 'z'
+    inverse: bool, optional
+        Inverse transform, scaled by 1/n along each axis, if True
+    platform: {pyopencl.Platform, list, dict}, optional
+        Platforms, as accepted by runPipeline. The first device found is used
+    backend: str, optional
+        Either 'opencl', 'cpu' or 'auto' (default), as in runPipeline. Axes whose length has a prime factor larger
+        than maxRadix are transformed with NumPy on any backend
+
+    Returns
+    -------
+    ndarray
+        np.complex64 transform of data
+    """
+
+    from . import FilterManager as fm
+    from . import ClAttributes
+
+    data = np.array(data, dtype=np.complex64, order='C')
+    if data.ndim != 3:
+        raise ValueError('data must be 3D')
+    indices = parseAxes(axes)
+
+    devices = fm.select_devices(platform, backend)
+    sizes = [data.shape[2], data.shape[1], data.shape[0]]
+    deviceAxes = [axis for axis in indices if factorize(sizes[axis]) is not None]
+    hostAxes = [axis for axis in indices if axis not in deviceAxes]
+
+    if devices and deviceAxes:
+        device, context, queue = fm.setup_cl_prereqs(list(devices.keys())[0])
+        clattr = ClAttributes.ClAttributes(context, device, queue, None, None, None)
+        engine = FFTEngine(clattr)
+        buffer = clattr.allocateBuffer(data.nbytes)
+        scratch = clattr.allocateBuffer(data.nbytes)
+        pr.record(clattr, cl.enqueue_copy(queue, buffer, data), 'upload', 'upload')
+        for axis in deviceAxes:
+            result = engine.transform(buffer, scratch, sizes, axis, inverse)
+            if result is not buffer:
+                buffer, scratch = scratch, buffer
+        pr.record(clattr, cl.enqueue_copy(queue, data, buffer), 'download', 'download')
+        queue.finish()
+        buffer.release()
+        scratch.release()
+        pc.clearProgramCache(context)
+    else:
+        hostAxes = indices
+
+    # numpy axes are in (z, y, x) order
+    numpyAxes = tuple(2 - axis for axis in hostAxes)
+    if numpyAxes:
+        transform = np.fft.ifftn if inverse else np.fft.fftn
+        data = transform(data, axes=numpyAxes).astype(np.complex64)
+    return data
@@ -1,6 +1,9 @@
 import numpy as np
 import pyopencl as cl
 import re
+import logging
+
+logger = logging.getLogger(__name__)
 
 class FilteringAttributes:
 
@@ -18,6 +21,8 @@ class FilteringAttributes:
         self.inputDeviceLength = 1
 
         self.MAX_STRUCTELEM_SIZE = 21*21*21
+        # cost of a running max/min pass along lines, in voxels read by a direct pass
+        self.LINE_PASS_COST = 8
         self.internalImages = ["StructuredElementL", "Diagonal3x3x3", "Diagonal10x10x4", "Diagonal10x10x10"]
 
     def getMaskImages(self, maskImage, maskL):
@@ -129,7 +134,7 @@ class FilteringAttributes:
     # test if mask is valid
     def isValidStructElement(self, image):
         if image.shape[0]*image.shape[1]*image.shape[2] >= self.MAX_STRUCTELEM_SIZE:
-            print("Structure Element is not valid!")
+            logger.error("Structure element is not valid")
             return False
         return True
 
@@ -142,11 +147,174 @@ class FilteringAttributes:
         size[1] = stack.shape[1]
         size[0] = stack.shape[2]
 
-        if overrideSize >= np.product(size):
-            structElem = cl.Buffer(context, cl.mem_flags.READ_WRITE, overrideSize*8)
+        if overrideSize >= np.prod(size):
+            structElem = cl.Buffer(context, cl.mem_flags.READ_WRITE, overrideSize*stack.itemsize)
         else:
-            structElem = cl.Buffer(context, cl.mem_flags.READ_WRITE, np.product(size)*8)
+            structElem = cl.Buffer(context, cl.mem_flags.READ_WRITE, np.prod(size)*stack.itemsize)
 
         cl.enqueue_copy(queue, structElem, stack)
         return structElem
 
+
+    def getPackedStructElements(self, stacks):
+        """
+        Packs the nonzero voxels of all structuring elements into a single table of (x, y, z, 0) offsets relative to
+        the element centers, along with a (start, count) entry per element into that table
+
+        Returns
+        -------
+        offsets: ndarray
+            np.int32 array of shape (n, 4)
+        elements: ndarray
+            np.int32 array of shape (len(stacks), 2)
+        """
+
+        offsets = []
+        elements = np.zeros((len(stacks), 2), dtype=np.int32)
+        for i, stack in enumerate(stacks):
+            center = [s // 2 for s in stack.shape]
+            z, y, x = np.nonzero(stack)
+            elements[i] = (len(offsets), len(z))
+            offsets += zip(x - center[2], y - center[1], z - center[0], [0]*len(z))
+
+        # OpenCL does not allow empty buffers
+        if not offsets:
+            offsets = [(0, 0, 0, 0)]
+        return np.array(offsets, dtype=np.int32).reshape(-1, 4), elements
+
+    def getStructElementRadius(self, stacks):
+        """
+        Largest offset, along any axis, of the nonzero voxels of the structuring elements from their centers
+        """
+
+        offsets, elements = self.getPackedStructElements(stacks)
+        return int(np.abs(offsets[:, :3]).max())
+
+    def getStructElementHalo(self, stacks):
+        """
+        Number of voxels (x, y, z) the structuring elements reach from their centers along each axis, including their
+        zero voxels, as the morphology kernels read the whole element
+        """
+
+        halo = [0, 0, 0]
+        for stack in stacks:
+            for axis in range(3):
+                halo[axis] = max(halo[axis], stack.shape[2 - axis] // 2)
+        return tuple(halo)
+
+    def getStructElementBuffers(self, stacks):
+        """
+        Number of temporary slab buffers and bytes of structuring element buffers used by dilation or erosion by
+        stacks: the temporary buffer of the kernels, the two scratch buffers of line passes when elements are
+        decomposed into several lines, and the largest of one element buffer or the packed elements
+        """
+
+        tmpBufferCount = 1
+        decomposition = self.decomposeStructElements(stacks)
+        if decomposition is not None and self.useLineKernels(decomposition, stacks) and \
+                max(len(segments) for segments in decomposition) > 1:
+            tmpBufferCount += 2
+        offsets, elements = self.getPackedStructElements(stacks)
+        return tmpBufferCount, max(max(stack.nbytes for stack in stacks), offsets.nbytes + elements.nbytes)
+
+    def getPackedStructBuffers(self, context, device, stacks):
+        """
+        Uploads the packed structuring elements of getPackedStructElements as two read-only buffers, to be passed as
+        constant arguments. Returns None if they do not fit in the constant memory of device
+        """
+
+        offsets, elements = self.getPackedStructElements(stacks)
+        if device.max_constant_args < 2 or offsets.nbytes + elements.nbytes > device.max_constant_buffer_size:
+            return None
+
+        flags = cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR
+        return (cl.Buffer(context, flags, hostbuf=offsets), cl.Buffer(context, flags, hostbuf=elements),
+                len(elements))
+
+    def decomposeStructElements(self, stacks):
+        """
+        Decomposes each structuring element into straight line segments, so that dilation or erosion by the element
+        is a sequence of running max/min passes along these lines (see MMline3D.cl). Lines have directions whose
+        components are -1, 0 or 1; boxes, rectangles and lines extruded along an axis are decomposed as well.
+        Empty elements are skipped
+
+        Returns
+        -------
+        list
+            for each non-empty element, list of (direction, origin, length) segments, where direction and origin
+            are (x, y, z) tuples and origin is relative to the center of the element. None if an element can not be
+            decomposed or all elements are empty
+        """
+
+        decomposition = []
+        for stack in stacks:
+            center = [s // 2 for s in stack.shape]
+            z, y, x = np.nonzero(stack)
+            if len(z) == 0:
+                continue
+            points = set(zip((x - center[2]).tolist(), (y - center[1]).tolist(), (z - center[0]).tolist()))
+            segments = self.decomposeOffsets(points)
+            if segments is None:
+                return None
+            decomposition.append(segments)
+        return decomposition if decomposition else None
+
+    def decomposeOffsets(self, points):
+
+        line = self.asLineSegment(points)
+        if line is not None:
+            return [line]
+
+        # points extruded along an axis: a plane of points, shifted by low..high voxels along that axis. The plane is
+        # moved to 0 along the axis, so that each pass only reads slices that the next pass needs
+        for axis in range(3):
+            coords = [p[axis] for p in points]
+            low, high = min(coords), max(coords)
+            n = high - low + 1
+            base = set(tuple(0 if i == axis else p[i] for i in range(3)) for p in points if p[axis] == low)
+            if n == 1 or len(points) != len(base)*n:
+                continue
+
+            step = tuple(1 if i == axis else 0 for i in range(3))
+            if all(tuple(b[i] + (low + k)*step[i] for i in range(3)) in points for b in base for k in range(n)):
+                segments = self.decomposeOffsets(base)
+                if segments is not None:
+                    return segments + [(step, tuple(low*s for s in step), n)]
+        return None
+
+    def asLineSegment(self, points):
+
+        points = sorted(points)
+        if len(points) == 1:
+            return (1, 0, 0), points[0], 1
+
+        direction = tuple(points[1][i] - points[0][i] for i in range(3))
+        if max(abs(d) for d in direction) > 1:
+            return None
+        for k, p in enumerate(points):
+            if any(p[i] != points[0][i] + k*direction[i] for i in range(3)):
+                return None
+        return direction, points[0], len(points)
+
+    def getLineCount(self, direction, sizes):
+        """
+        Number of lines parallel to direction in a volume of (width, height, depth) sizes, as enumerated by
+        MMline3D.cl
+        """
+
+        first = [i for i in range(3) if direction[i] != 0][0]
+        count = 1
+        for i in range(3):
+            if i != first:
+                count *= sizes[i] if direction[i] == 0 else sizes[first] + sizes[i] - 1
+        return count
+
+    def useLineKernels(self, decomposition, stacks):
+        """
+        Whether the line passes of decomposition are expected to be faster than a single pass reading every nonzero
+        voxel of the structuring elements
+        """
+
+        passCount = sum(len(segments) for segments in decomposition)
+        offsetCount = sum(int(np.count_nonzero(stack)) for stack in stacks)
+        return offsetCount > self.LINE_PASS_COST*passCount
@@ -139,10 +139,10 @@ class FilteringAttributes:
         size[1] = stack.shape[1]
         size[0] = stack.shape[2]
 
-        if overrideSize >= np.product(size):
-            structElem = cl.Buffer(context, cl.mem_flags.READ_WRITE, overrideSize*8)
+        if overrideSize >= np.prod(size):
+            structElem = cl.Buffer(context, cl.mem_flags.READ_WRITE, overrideSize*stack.itemsize)
         else:
-            structElem = cl.Buffer(context, cl.mem_flags.READ_WRITE, np.product(size)*8)
+            structElem = cl.Buffer(context, cl.mem_flags.READ_WRITE, np.prod(size)*stack.itemsize)
 
         cl.enqueue_copy(queue, structElem, stack)
         return structElem
@@ -180,3 +180,13 @@ class FilterInfo(object):
         self.memtype = bytes
         # self.memtype = POCLFilter.Type.Byte
         self.useTempBuffer = False
+        # filters needing the whole depth of the volume (ex.: transforms along z) are run on the whole volume at once
+        # instead of on slabs
+        self.fullDepth = False
+        # filters needing whole slices (ex.: transforms along x or y, masks) are not run on xy bricks
+        self.fullPlane = False
+        # device memory used besides the slab buffers, see MemoryPlanner: temporary buffers of the size of a slab
+        # buffer, bytes of other buffers per voxel of the slab, and bytes of buffers not depending on the slab
+        self.tmpBufferCount = 0
+        self.voxelBytes = 0
+        self.fixedBytes = 0
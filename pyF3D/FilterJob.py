@@ -0,0 +1,73 @@
+import threading
+from . import FilterClasses as fc
+from . import SlabScheduler as ss
+from . import HaloPlanner as hp
+
+class FilterJob(object):
+    """
+    State of the filtering of one volume: input and output volumes, pipeline, slab scheduler and records of the
+    filtered slabs. Nothing is shared between jobs, so several volumes can be filtered at the same time
+
+    Parameters
+    ----------
+    image: ndarray
+        3D image data
+    pipeline: list
+        series of functions to be performed on image
+    output: ndarray
+        Volume into which results are written
+    deviceCount: int, optional
+        Number of devices that filter the volume
+    """
+
+    def __init__(self, image, pipeline, output, deviceCount=1):
+        self.image = image
+        self.pipeline = pipeline
+        self.output = output
+
+        # slabs are extended by the sum of the halos of the filters, see HaloPlan
+        self.haloPlan = hp.HaloPlan(pipeline)
+        self.overlap = self.haloPlan.total[2]
+        self.fullDepth = False
+        for filter in pipeline:
+            self.fullDepth = self.fullDepth or filter.getInfo().fullDepth
+
+        self.scheduler = ss.SlabScheduler(image.shape[0], self.overlap, deviceCount=deviceCount)
+        self.stacks = []
+        self.lock = threading.Lock()
+        self.claimed = False
+        # when True, kernels are tuned before they are run, see pyF3D.Autotuner.autotune
+        self.tuning = False
+
+    def useTempBuffer(self):
+        for filter in self.pipeline:
+            if filter.getInfo().useTempBuffer:
+                return True
+        return False
+
+    def claimWholeVolume(self):
+        """
+        Returns True to the first device only. Jobs whose pipeline needs the whole depth of the volume are filtered by
+        that device, at once
+        """
+
+        with self.lock:
+            claimed = self.claimed
+            self.claimed = True
+        return not claimed
+
+    def addResultStack(self, device, startRange, endRange, output, name, pipelineTime):
+        """
+        Records a filtered slab, and the time taken by device to filter it
+        """
+
+        with self.lock:
+            sr = fc.StackRange()
+            sr.startRange = startRange
+            sr.endRange = endRange
+            sr.stack = output
+            sr.time = pipelineTime
+            sr.name = name
+
+            self.stacks.append(sr)
+        self.scheduler.recordTime(device, endRange - startRange, pipelineTime)
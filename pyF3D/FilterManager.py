@@ -2,6 +2,8 @@ import pyopencl as cl
 import time
 
 import concurrent.futures as cf
+import logging
+import multiprocessing
 import numpy as np
 
 from . import ClAttributes
@@ -15,18 +17,34 @@ from .filters import MMFilterEro as mmero
 from .filters import MMFilterClo as mmclo
 from .filters import MMFilterOpe as mmope
 from . import FilterClasses as fc
-import threading
-
-startIndex = 0
-
-def run_f3d(image, pipeline, platform=None):
+from . import VolumeIO as vio
+from . import FilterJob as fj
+from . import TiledStencil as ts
+from . import PipelineExecutor as pe
+from . import HaloPlanner as hp
+from . import MemoryPlanner as mp
+from . import VoxelTypes as vt
+from . import Profiling as pr
+from . import ProgramCache as pc
+
+logger = logging.getLogger(__name__)
+
+def run_f3d(image, pipeline, platform=None, bufferCount=1, output=None, shape=None, dtype=np.uint8, backend='auto',
+            session=None):
     """
-    Perform F3D filtering on image with specified pipeline
+    Perform F3D filtering on image with specified pipeline. Only the slabs being filtered are read from image, so
+    volumes larger than host memory can be filtered when image and output are on disk. np.uint8, np.uint16 and
+    np.float32 volumes are filtered as they are (see pyF3D.VoxelTypes), volumes of other types are scaled to np.uint8
 
     Parameters
     ----------
-    image: ndarray
-        3D image data
+    image: {ndarray, np.memmap, str}
+        3D image data. Can either be:
+
+        1). An ndarray or np.memmap
+        2). Path to a directory of 2D TIFF slices
+        3). Path to a .npy file
+        4). Path to a raw binary file, in which case shape (and dtype if not np.uint8) must be given
     pipeline: list
         series of functions to be performed on image
     platform: {pyopencl.Platform, list, dict}, optional
@@ -37,26 +55,57 @@ def run_f3d(image, pipeline, platform=None):
         3). A dictionary of pyopencl.Platform and int key/value pairs. The int values specify the maximum number of
             slices to be placed on the platform at any time (ex.: {platform1: 100} will assign a maximum of 100 slices to
             platform1)
+    bufferCount: int, optional
+        Number of slab buffers per device. With 1 (default), transfers and filtering are done one after the other.
+        With 2 or 3, slabs are streamed: the next slab is uploaded and the previous slab downloaded while the current
+        slab is filtered
+    output: {ndarray, np.memmap, str}, optional
+        Where results are written. Can either be:
+
+        1). A preallocated volume (ex.: np.memmap) of the same shape and type as the filtered image
+        2). Path to a directory (existing, or without extension), to which one TIFF file per slice is written
+        3). Path to a .npy or raw binary file, created as a np.memmap
+    shape: tuple, optional
+        Shape (slices, height, width) of raw image file
+    dtype: np.dtype, optional
+        Type of raw image file
+    backend: str, optional
+        Either 'opencl', 'cpu' or 'auto' (default). 'opencl' runs on OpenCL devices (GPUs if any, otherwise any OpenCL
+        device), 'cpu' runs the NumPy implementation of the filters on a pool of threads. 'auto' uses OpenCL when a
+        device is available and the NumPy implementation otherwise
+    session: pyF3D.F3DSession.F3DSession, optional
+        Session whose devices, contexts, compiled programs and buffers are reused. platform and backend are ignored
+        when given
 
     Returns
     -------
-    ndarray
+    {ndarray, np.memmap, pyF3D.VolumeIO.TiffSliceVolume}
         Filtered 3D object
     """
 
-    image = scale_to_uint8(image)
-    stacks = runPipeline(image, pipeline, platform=platform)
-    return reconstruct_final_image(stacks)
+    image = vio.open_volume(image, shape=shape, dtype=dtype)
+    if not vt.isSupported(image.dtype):
+        # scaled slab by slab as slabs are loaded, instead of copying the whole volume
+        image = vio.ScaledVolume(image)
+    output = vio.open_output(output, image.shape, image.dtype)
 
-def runPipeline(image, pipeline, platform=None):
+    output = runPipeline(image, pipeline, platform=platform, bufferCount=bufferCount, output=output, backend=backend,
+                         session=session)
+    if isinstance(output, vio.TiffSliceWriter):
+        return output.toVolume()
+    return output
+
+def runPipeline(image, pipeline, platform=None, bufferCount=1, output=None, backend='auto', session=None):
     """
 
-    Performs filters contained in pipeline on input image. Creates one thread per OpenCL platform
+    Performs filters contained in pipeline on input image. Creates one thread per OpenCL device. Each thread writes
+    its filtered slabs directly into the output volume. All state of the run is held by a pyF3D.FilterJob.FilterJob,
+    so runPipeline can be called from several threads at the same time
 
     Parameters
     ----------
     image: ndarray
-        3D image data
+        3D image data of type np.uint8, np.uint16 or np.float32
     pipeline: list
         series of functions to be performed on image
     platform: {pyopencl.Platform, list, dict}, optional
@@ -67,130 +116,535 @@ def runPipeline(image, pipeline, platform=None):
         3). A dictionary of pyopencl.Platform and int key/value pairs. The int values specify the maximum number of
             slices to be placed on the platform at any time (ex.: {platform1: 100} will assign a maximum of 100 slices to
             platform1)
+    bufferCount: int, optional
+        Number of slab buffers per device. With 1 (default), transfers and filtering are done one after the other.
+        With 2 or 3, slabs are streamed: the next slab is uploaded and the previous slab downloaded while the current
+        slab is filtered
+    output: {ndarray, pyF3D.VolumeIO.TiffSliceWriter}, optional
+        Preallocated volume (ex.: np.memmap) of the same shape and type as image, into which results are written.
+        Allocated if not given
+    backend: str, optional
+        Either 'opencl', 'cpu' or 'auto' (default). 'opencl' runs on OpenCL devices (GPUs if any, otherwise any OpenCL
+        device), 'cpu' runs the NumPy implementation of the filters on a pool of threads. 'auto' uses OpenCL when a
+        device is available and the NumPy implementation otherwise
+    session: pyF3D.F3DSession.F3DSession, optional
+        Session whose devices, contexts, compiled programs and buffers are reused. platform and backend are ignored
+        when given
+
+    Returns
+    -------
+    ndarray
+        Filtered 3D object
+    """
+    output = allocate_output(image, output)
+    devices = session.devices if session is not None else select_devices(platform, backend)
+    if not devices:
+        return runPipelineCPU(image, pipeline, output)
 
+    logger.info("Devices: %s", devices)
+    runJobs(createJobs(image, pipeline, output, devices, bufferCount), devices, bufferCount, session)
+    return output
+
+def run_f3d_batch(images, pipeline, platform=None, bufferCount=1, outputs=None, backend='auto', session=None):
+    """
+    Perform F3D filtering on several images with specified pipeline. Images are queued and filtered by all devices:
+    a device with no slab left on an image moves on to the next image. Device contexts and buffers are kept
+    between images
+
+    Parameters
+    ----------
+    images: list
+        3D images, of any type accepted by run_f3d
+    pipeline: list
+        series of functions to be performed on each image
+    platform: {pyopencl.Platform, list, dict}, optional
+        Platforms on which calculations are performed, as in run_f3d
+    bufferCount: int, optional
+        Number of slab buffers per device, as in run_f3d
+    outputs: list, optional
+        One output per image, of any type accepted by run_f3d
+    backend: str, optional
+        Either 'opencl', 'cpu' or 'auto' (default), as in run_f3d
+    session: pyF3D.F3DSession.F3DSession, optional
+        Session whose devices, contexts, compiled programs and buffers are reused. platform and backend are ignored
+        when given
 
     Returns
     -------
     list
-        portions of filtered data. Must be sorted.
+        Filtered 3D objects
     """
-    global startIndex
-    startIndex = 0
-    stacks = []
-    platform = check_if_valid_platform(platform)
-    devices = {}
-    for p in list(platform.keys()):
-        for d in p.get_devices(device_type=cl.device_type.GPU):
-            devices[d] = platform[p]
-        
-    print("Devices: ",devices)
-
-    atts = FilterAttributes.FilteringAttributes()
-#    atts.overlap = [0]*len(platform)
-    atts.overlap = [0]*len(devices)
-    print("Atts overlap: ", atts.overlap)
+
+    if outputs is None:
+        outputs = [None]*len(images)
+    if len(outputs) != len(images):
+        raise ValueError('There must be one output per image')
+
+    volumes = []
+    for image, output in zip(images, outputs):
+        image = vio.open_volume(image)
+        if not vt.isSupported(image.dtype):
+            image = vio.ScaledVolume(image)
+        volumes.append((image, vio.open_output(output, image.shape, image.dtype)))
+
+    results = runBatch([v[0] for v in volumes], pipeline, platform=platform, bufferCount=bufferCount,
+                       outputs=[v[1] for v in volumes], backend=backend, session=session)
+    return [r.toVolume() if isinstance(r, vio.TiffSliceWriter) else r for r in results]
+
+def runBatch(images, pipeline, platform=None, bufferCount=1, outputs=None, backend='auto', session=None):
+    """
+    Performs filters contained in pipeline on several images. Creates one thread per OpenCL device, which keeps its
+    context and buffers while going through the queue of images
+
+    Parameters
+    ----------
+    images: list
+        3D image data
+    pipeline: list
+        series of functions to be performed on each image
+    platform: {pyopencl.Platform, list, dict}, optional
+        Platforms on which calculations are performed, as in runPipeline
+    bufferCount: int, optional
+        Number of slab buffers per device, as in runPipeline
+    outputs: list, optional
+        One preallocated output volume (or None) per image
+    backend: str, optional
+        Either 'opencl', 'cpu' or 'auto' (default), as in runPipeline
+    session: pyF3D.F3DSession.F3DSession, optional
+        Session whose devices, contexts, compiled programs and buffers are reused. platform and backend are ignored
+        when given
+
+    Returns
+    -------
+    list
+        Filtered 3D objects
+    """
+
+    if outputs is None:
+        outputs = [None]*len(images)
+    outputs = [allocate_output(image, output) for image, output in zip(images, outputs)]
+
+    devices = session.devices if session is not None else select_devices(platform, backend)
+    if not devices:
+        return [runPipelineCPU(image, pipeline, output) for image, output in zip(images, outputs)]
+
     jobs = []
+    for image, output in zip(images, outputs):
+        jobs += createJobs(image, pipeline, output, devices, bufferCount)
+    runJobs(jobs, devices, bufferCount, session)
+    return outputs
+
+def createJobs(image, pipeline, output, devices, bufferCount=1):
+    """
+    Creates the jobs filtering image on devices. Slices too large for slabs of several slices to fit in the memory
+    of the devices are split into xy-bricks (see HaloPlan.bricks), each filtered by a job of its own, unless a filter
+    of the pipeline needs whole slices or output cannot be written by bricks. The maximum slice counts of devices
+    limit the slices of every slab, bricks included
+
+    Parameters
+    ----------
+    image: ndarray
+        3D image data
+    pipeline: list
+        series of functions to be performed on image
+    output: {ndarray, pyF3D.VolumeIO.TiffSliceWriter}
+        Volume into which results are written
+    devices: dict
+        pyopencl.Device and maximum slice count (or None) key/value pairs
+    bufferCount: int, optional
+        Number of slab buffers per device
+
+    Returns
+    -------
+    list
+        pyF3D.FilterJob.FilterJob objects
+    """
+
+    job = fj.FilterJob(image, pipeline, output, deviceCount=len(devices))
+    if job.fullDepth or any(filter.getInfo().fullPlane for filter in pipeline) or \
+            not isinstance(output, np.ndarray):
+        return [job]
+
+    # voxels of a slab on the device with the least memory, and fewest slices allowed on a device
+    capacity = min(mp.slabCapacity(device, pipeline, image.dtype, bufferCount) for device in devices)
+    limits = [maxSliceCount for maxSliceCount in devices.values() if maxSliceCount]
+    bricks = job.haloPlan.bricks(image.shape, capacity, min(limits) if limits else None)
+    if len(bricks) == 1:
+        return [job]
+
+    logger.info("Bricks: %d", len(bricks))
+    jobs = []
+    for innerRange, outerRange in bricks:
+        brick = vio.BrickVolume(image, *outerRange)
+        jobs.append(fj.FilterJob(brick, pipeline, vio.BrickOutput(output, innerRange, outerRange),
+                                 deviceCount=len(devices)))
+    return jobs
+
+def runJobs(jobs, devices, bufferCount=1, session=None):
+    """
+    Runs jobs on devices, with one thread per device. Each device goes through the jobs in order
+
+    Parameters
+    ----------
+    jobs: list
+        pyF3D.FilterJob.FilterJob objects
+    devices: dict
+        pyopencl.Device and maximum slice count (or None) key/value pairs
+    bufferCount: int, optional
+        Number of slab buffers per device
+    session: pyF3D.F3DSession.F3DSession, optional
+        Session holding the contexts and buffers of devices
+    """
+
+    futures = []
     with cf.ThreadPoolExecutor(len(devices)) as e:
-        for i in range(len(devices)):
-            index = i
-            if type(platform) is list:
-                p = platform[i]
-                maxSliceCount = None
-            else:
-                #p = list(platform.keys())[i]
-                d = list(devices.keys())[i]
-                #maxSliceCount = list(platform.values())[i]
-                maxSliceCount = list(devices.values())[i]
-                print("MaxSliceCount: ",maxSliceCount)
-            #kwargs = {'image': image, 'pipeline': pipeline, 'attr': atts, 'platform': p,
-            #          'sliceCount': maxSliceCount, 'index': index, 'stacks': stacks}
-            kwargs = {'image': image, 'pipeline': pipeline, 'attr': atts, 'device': d,
-                      'sliceCount': maxSliceCount, 'index': index, 'stacks': stacks}
-            jobs.append(e.submit(doFilter, **kwargs))
-            # e.submit(doFilter, **kwargs)
-            # doFilter(**kwargs) #debug
+        for index, (d, maxSliceCount) in enumerate(devices.items()):
+            logger.debug("MaxSliceCount: %s", maxSliceCount)
+            futures.append(e.submit(doFilter, jobs, d, maxSliceCount, index, bufferCount, session))
+    for future in futures:
+        future.result()
+
+def select_devices(platform=None, backend='auto'):
+    """
+    Returns OpenCL devices to use for backend, or an empty dict if the NumPy implementation must be used
+    """
+
+    if backend not in ['opencl', 'cpu', 'auto']:
+        raise ValueError("'backend' parameter must be either 'opencl', 'cpu' or 'auto'")
+
+    devices = {}
+    if backend != 'cpu':
+        try:
+            devices = get_devices(platform)
+        except cl.Error:
+            if backend == 'opencl':
+                raise
+    if not devices and backend == 'opencl':
+        raise RuntimeError('No OpenCL device found')
+    return devices
+
+def runPipelineCPU(image, pipeline, output, sliceCount=None, threadCount=None):
+    """
+    Performs filters contained in pipeline on input image with the NumPy implementation of the filters. The image is
+    split into z-slabs, which are filtered in parallel by a pool of threads
+
+    Parameters
+    ----------
+    image: ndarray
+        3D image data
+    pipeline: list
+        series of functions to be performed on image
+    output: ndarray
+        Volume into which results are written
+    sliceCount: int, optional
+        Number of slices per slab, without overlap
+    threadCount: int, optional
+        Number of threads. Defaults to number of CPUs
+
+    Returns
+    -------
+    ndarray
+        Filtered 3D object
+    """
+
+    segments = pipelineSegments(pipeline)
+    if len(segments) > 1:
+        source = image
+        for i, segment in enumerate(segments):
+            target = output if i == len(segments) - 1 else np.empty(image.shape, dtype=image.dtype)
+            runPipelineCPU(source, segment, target, sliceCount, threadCount)
+            source = target
+        return output
+
+    depth = image.shape[0]
+    if pipeline and pipeline[0].getInfo().fullDepth:
+        output[0:depth] = pipeline[0].runCPU(np.asarray(image[0:depth]), 0)
+        return output
+
+    # halos of the filters add up, see HaloPlan
+    maxOverlap = hp.HaloPlan(pipeline).total[2]
+
+    if not sliceCount:
+        sliceCount = max(vio.chunkSliceCount(image, 4*1024*1024), maxOverlap)
+    if not threadCount:
+        threadCount = multiprocessing.cpu_count()
+
+    def filterSlab(startRange, endRange):
+        minIndex = max(0, startRange - maxOverlap)
+        maxIndex = min(depth, endRange + maxOverlap)
+        data = np.asarray(image[minIndex:maxIndex])
+        for filter in pipeline:
+            data = filter.runCPU(data, minIndex)
+        output[startRange:endRange] = data[startRange - minIndex:endRange - minIndex]
+
+    with cf.ThreadPoolExecutor(threadCount) as e:
+        jobs = [e.submit(filterSlab, start, min(start + sliceCount, depth)) for start in range(0, depth, sliceCount)]
     for job in jobs:
         job.result()
-    return stacks
+    return output
 
-#def doFilter(image, pipeline, attr, platform, sliceCount, index, stacks):
-def doFilter(image, pipeline, attr, device, sliceCount, index, stacks):
+def pipelineSegments(pipeline):
+    """
+    Splits pipeline into series of filters that can be run on slabs, and filters needing the whole depth of the
+    volume (see FilterInfo.fullDepth), each alone in its series
+    """
 
-    global startIndex
+    segments = []
+    for filter in pipeline:
+        if filter.getInfo().fullDepth or not segments or segments[-1][0].getInfo().fullDepth:
+            segments.append([filter])
+        else:
+            segments[-1].append(filter)
+    return segments
 
-    #device = platform.get_devices()[0]
-    device, context, queue = setup_cl_prereqs(device)
-    clattr = ClAttributes.ClAttributes(context, device, queue, None, None, None)
-    clattr.setMaxSliceCount(image, sliceCount)
+def get_devices(platform=None):
+    """
+    Returns OpenCL devices of the platforms. GPUs are used if any, otherwise every device of the platforms
 
+    Parameters
+    ----------
+    platform: {pyopencl.Platform, list, dict}, optional
+        Platforms, as accepted by runPipeline
 
-    maxOverlap = 0
-    for filter in pipeline:
-        maxOverlap = max(maxOverlap, filter.getInfo().overlapZ)
+    Returns
+    -------
+    dict
+        pyopencl.Device and maximum slice count (or None) key/value pairs
+    """
 
-    maxSliceCount = clattr.maxSliceCount
-    clattr.initializeData(image, attr, maxOverlap, maxSliceCount)
-    
-    print("maxSliceCount: ", index, maxSliceCount)
-    print("maxOverlap: ", index, maxOverlap)
-    print("Device:  ", index, device)
+    platform = check_if_valid_platform(platform)
+    if type(platform) is list:
+        platform = dict.fromkeys(platform)
+
+    for deviceType in [cl.device_type.GPU, cl.device_type.ALL]:
+        devices = {}
+        for p in list(platform.keys()):
+            try:
+                for d in p.get_devices(device_type=deviceType):
+                    devices[d] = platform[p]
+            except cl.Error:
+                # no device of this type on platform
+                continue
+        if devices:
+            return devices
+    return {}
+
+def allocate_output(image, output=None):
+    """
+    Checks that output volume matches image, or allocates it if output is None
 
-    for filter in pipeline:
-        if filter.getInfo().useTempBuffer:
-            clattr.outputTmpBuffer = cl.Buffer(clattr.context, cl.mem_flags.READ_WRITE, clattr.inputBuffer.size)
-            break
-    stackRange = [0, 0]
-    while True:
+    Parameters
+    ----------
+    image: ndarray
+        3D image data
+    output: {ndarray, pyF3D.VolumeIO.TiffSliceWriter}, optional
+        Volume the filtered slabs are written into (ex.: preallocated np.ndarray or np.memmap). Must have the same
+        shape and type as image and, if an ndarray, be C-contiguous
 
-        if startIndex >= image.shape[0]:
-            break
-        getNextRange(image, stackRange, maxSliceCount, maxOverlap)
-        attr.sliceStart = stackRange[0]
-        attr.sliceEnd = stackRange[1]
-        print("Slice start: ", index, attr.sliceStart)
-        print("Slice end: ", index, attr.sliceEnd)
-        clattr.loadNextData(image, attr, stackRange[0], stackRange[1], maxOverlap)
-        attr.overlap[index] = maxOverlap
-        pipelineTime = 0
-        for i in range(len(pipeline)):
+    Returns
+    -------
+    ndarray
+        output volume
+    """
 
-            filter = pipeline[i].clone()
-            filter.setAttributes(clattr, attr, index)
+    # raises TypeError for types without kernels, which run_f3d scales to np.uint8
+    vt.voxelType(image.dtype)
+    if output is None:
+        return np.empty(image.shape, dtype=image.dtype)
 
-            if not filter.loadKernel():
-                raise Exception
+    if tuple(output.shape) != tuple(image.shape):
+        raise ValueError('output shape {} does not match image shape {}'.format(output.shape, image.shape))
+    if output.dtype != image.dtype:
+        raise TypeError('output must be of type {}, as image'.format(image.dtype))
+    if isinstance(output, np.ndarray) and not output.flags.c_contiguous:
+        raise ValueError('output must be C-contiguous')
+    return output
 
-            filterTime = time.time()
+def doFilter(jobs, device, sliceCount, index, bufferCount=1, session=None):
+    """
+    Filters jobs one after the other on device. The context and buffers of the device are reused by all jobs. With
+    a session, the session's context is used and buffers are given back to its pool at the end. Without one, the
+    programs and constant buffers cached for the context are removed at the end, as the context is not used again
+    """
+
+    if session is None:
+        device, context, queue = setup_cl_prereqs(device)
+        clattr = ClAttributes.ClAttributes(context, device, queue, None, None, None)
+    else:
+        clattr = session.deviceContext(device).newClAttributes()
+    logger.info("Device: %d %s", index, device)
+
+    try:
+        for job in jobs:
+            clattr.tuning = job.tuning
+            if job.fullDepth:
+                filterWholeVolume(job, clattr, index)
+            else:
+                filterJob(job, clattr, sliceCount, index, bufferCount)
+    finally:
+        clattr.releaseBuffers()
+        if session is None:
+            pc.clearProgramCache(clattr.context)
+
+def filterJob(job, clattr, sliceCount, index, bufferCount=1):
+    """
+    Filters slabs of job on the device of clattr until the job's scheduler has no slab left
+    """
+
+    image = job.image
+    pipeline = job.pipeline
+    output = job.output
+
+    attr = FilterAttributes.FilteringAttributes()
+    attr.overlap = [0]*job.scheduler.deviceCount
+    clattr.setMaxSliceCount(image, sliceCount, pipeline, job.overlap, bufferCount)
+
+    maxOverlap = job.overlap
+    maxSliceCount = clattr.maxSliceCount
+    clattr.initializeData(image, attr, maxOverlap, maxSliceCount)
+    job.scheduler.register(index, maxSliceCount)
+    
+    logger.info("maxSliceCount: %d %d", index, maxSliceCount)
+    logger.info("maxOverlap: %d %d", index, maxOverlap)
+    logger.debug("Memory budget: %d %s", index, clattr.memoryBudget)
 
-            if not filter.runFilter():
-                raise Exception
+    if job.useTempBuffer():
+        clattr.initializeTmpBuffer()
 
-            filterTime = time.time() - filterTime
-            pipelineTime += filterTime
+    if bufferCount > 1:
+        streamFilter(job, clattr, attr, index, bufferCount)
+    else:
+        stackRange = [0, 0]
+        while job.scheduler.getNextRange(index, stackRange):
+            attr.sliceStart = stackRange[0]
+            attr.sliceEnd = stackRange[1]
+            logger.debug("Slices: %d %d-%d", index, attr.sliceStart, attr.sliceEnd)
+            clattr.profileSlab = (stackRange[0], stackRange[1])
+            clattr.loadNextData(image, attr, stackRange[0], stackRange[1], maxOverlap)
+            attr.overlap[index] = maxOverlap
+            executor = runFilters(pipeline, clattr, attr, index, job.haloPlan)
+
+            if isinstance(output, np.ndarray):
+                result = clattr.writeNextData(attr, stackRange[0], stackRange[1], maxOverlap, output)
+            else:
+                result = clattr.writeNextData(attr, stackRange[0], stackRange[1], maxOverlap)
+                output[stackRange[0]:stackRange[1]] = result
+            job.addResultStack(index, stackRange[0], stackRange[1], result, clattr.device.name, executor.elapsed())
 
-            if i < len(pipeline) - 1:
-                clattr.swapBuffers()
+def filterWholeVolume(job, clattr, index):
+    """
+    Filters the whole volume of a job whose pipeline needs the whole depth of the volume, at once, on the device of
+    clattr. The volume is filtered with NumPy if it does not fit in device memory. Only the first device to call it
+    filters the job
+    """
 
-        result = clattr.writeNextData(attr, stackRange[0], stackRange[1], maxOverlap)
-        addResultStack(stacks, stackRange[0], stackRange[1], result, clattr.device.name, pipelineTime)
-        
+    if not job.claimWholeVolume():
+        return
+
+    image = job.image
+    pipeline = job.pipeline
+    output = job.output
+    depth, height, width = image.shape
+    job.scheduler.register(index, depth)
+
+    clattr.setMaxSliceCount(image, None, pipeline)
+    if clattr.maxSliceCount < depth:
+        logger.warning("Volume too large for %s, filtering with NumPy", clattr.device.name)
+        pipelineTime = time.time()
+        runPipelineCPU(image, pipeline, output)
+        job.addResultStack(index, 0, depth, output, 'NumPy', time.time() - pipelineTime)
+        return
+
+    attr = FilterAttributes.FilteringAttributes()
+    attr.overlap = [0]*job.scheduler.deviceCount
+    clattr.initializeData(image, attr, 0, depth)
+    if job.useTempBuffer():
+        clattr.initializeTmpBuffer()
+
+    attr.sliceStart = 0
+    attr.sliceEnd = depth
+    clattr.profileSlab = (0, depth)
+    clattr.loadNextData(image, attr, 0, depth, 0)
+    executor = runFilters(pipeline, clattr, attr, index, job.haloPlan)
+
+    if isinstance(output, np.ndarray):
+        result = clattr.writeNextData(attr, 0, depth, 0, output)
+    else:
+        result = clattr.writeNextData(attr, 0, depth, 0)
+        output[0:depth] = result
+    job.addResultStack(index, 0, depth, result, clattr.device.name, executor.elapsed())
 
+def streamFilter(job, clattr, attr, index, bufferCount):
+    """
+    Filters slabs with bufferCount sets of device buffers used in rotation. While slab N is filtered on the compute
+    queue, slab N+1 is uploaded and slab N-1 is downloaded on the transfer queue
+    """
 
-    clattr.inputBuffer.release()
-    clattr.outputBuffer.release()
-    if clattr.outputTmpBuffer is not None:
-        clattr.outputTmpBuffer.release()
+    image = job.image
+    pipeline = job.pipeline
+    output = job.output
+
+    clattr.initializeStreaming(bufferCount)
+    slots = clattr.slots
+    maxOverlap = job.overlap
+    attr.overlap[index] = maxOverlap
+
+    def loadNext(slot):
+        stackRange = [0, 0]
+        if not job.scheduler.getNextRange(index, stackRange):
+            return False
+        clattr.loadNextDataAsync(slot, image, attr, stackRange[0], stackRange[1], maxOverlap)
+        return True
+
+    def finish(slot, executor):
+        startRange, endRange, result = clattr.finishNextData(slot, attr)
+        if not isinstance(output, np.ndarray):
+            output[startRange:endRange] = result
+        job.addResultStack(index, startRange, endRange, result, clattr.device.name, executor.elapsed())
+
+    hasNext = loadNext(slots[0])
+    pending = None
+    current = 0
+    while hasNext:
+        slot = slots[current % len(slots)]
+        hasNext = loadNext(slots[(current + 1) % len(slots)])
+
+        attr.sliceStart = slot.startRange
+        attr.sliceEnd = slot.endRange
+        logger.debug("Slices: %d %d-%d", index, attr.sliceStart, attr.sliceEnd)
+        clattr.profileSlab = (slot.startRange, slot.endRange)
+        clattr.useSlot(slot)
+        executor = runFilters(pipeline, clattr, attr, index, job.haloPlan)
+        clattr.writeNextDataAsync(slot, attr, maxOverlap, output if isinstance(output, np.ndarray) else None)
+
+        if pending is not None:
+            finish(*pending)
+        pending = (slot, executor)
+        current += 1
+
+    if pending is not None:
+        finish(*pending)
+
+def runFilters(pipeline, clattr, attr, index, plan=None):
+    """
+    Runs every filter of the pipeline on the slab currently loaded in clattr.inputBuffer, leaving the result in
+    clattr.outputBuffer without copies between filters, each filter only over the slices still needed (see
+    PipelineExecutor). Returns the PipelineExecutor, whose elapsed gives the time taken by the filters once the
+    result is read
+    """
 
-    return stacks
+    return pe.PipelineExecutor(pipeline, clattr, attr, index, plan).run()
 
-def run_MedianFilter(image, platform=None):
+def run_MedianFilter(image, radius=1, platform=None, session=None):
     """
-    Performs median filter (radius = 3) on image
+    Performs median filter on image
 
     Parameters
     ----------
     image: ndarray
         3D image data
+    radius: int, optional
+        Radius of the (2*radius + 1)^3 window
     platform: {pyopencl.Platform, list, dict}, optional
         Platforms on which calculations are performed. Can either specify:
 
@@ -199,7 +653,8 @@ def run_MedianFilter(image, platform=None):
         3). A dictionary of pyopencl.Platform and int key/value pairs. The int values specify the maximum number of
             slices to be placed on the platform at any time (ex.: {platform1: 100} will assign a maximum of 100 slices to
             platform1)
-
+    session: pyF3D.F3DSession.F3DSession, optional
+        Session whose devices, contexts, compiled programs and buffers are reused. platform is ignored when given
 
     Returns
     -------
@@ -207,21 +662,34 @@ def run_MedianFilter(image, platform=None):
         3D image after median filtering
     """
 
-    pipeline = [mf.MedianFilter()]
-    stacks = runPipeline(image, pipeline, platform=platform)
-    return reconstruct_final_image(stacks)
+    pipeline = [mf.MedianFilter(radius=radius)]
+    return runPipeline(image, pipeline, platform=platform, session=session)
 
 
-def run_FFTFilter(image, FFTChoice='Forward', platform=None):
+def run_FFTFilter(image, mode='lowpass', axes='xy', cutoff=0.1, lowCutoff=0.05, highCutoff=0.25, order=2, sigma=0.01,
+                  stripeAxis='y', center=None, platform=None, session=None, FFTChoice=None):
     """
-    Performs FFT filter on image
+    Performs frequency-domain filter on image
 
     Parameters
     ----------
     image: ndarray
         3D image data
-    FFTChoice: str, optional
-        Either 'Forward' or 'Inverse'
+    mode: str, optional
+        One of 'lowpass' (default), 'highpass', 'bandpass', 'stripes' or 'rings', see
+        pyF3D.filters.FFTFilter.FFTFilter
+    axes: str, optional
+        Axes along which image is transformed, among 'x', 'y' and 'z'. With 'z', the whole volume is filtered at once
+    cutoff, lowCutoff, highCutoff: float, optional
+        Cutoff frequencies, in cycles per voxel
+    order: int, optional
+        Order of the Butterworth filters
+    sigma: float, optional
+        Width of the band of stripes or rings
+    stripeAxis: str, optional
+        Axis along which stripes are constant
+    center: tuple, optional
+        (x, y) center of the rings
     platform: {pyopencl.Platform, list, dict}, optional
         Platforms on which calculations are performed. Can either specify:
 
@@ -230,6 +698,10 @@ def run_FFTFilter(image, FFTChoice='Forward', platform=None):
         3). A dictionary of pyopencl.Platform and int key/value pairs. The int values specify the maximum number of
             slices to be placed on the platform at any time (ex.: {platform1: 100} will assign a maximum of 100 slices to
             platform1)
+    session: pyF3D.F3DSession.F3DSession, optional
+        Session whose devices, contexts, compiled programs and buffers are reused. platform is ignored when given
+    FFTChoice: str, optional
+        Removed, raises a ValueError. See pyF3D.filters.FFTFilter.FFTFilter
 
     Returns
     -------
@@ -237,11 +709,11 @@ def run_FFTFilter(image, FFTChoice='Forward', platform=None):
         3D image after FFT filtering
     """
 
-    pipeline = [fft.FFTFilter(FFTChoice=FFTChoice)]
-    stacks = runPipeline(image, pipeline, platform=platform)
-    return reconstruct_final_image(stacks)
+    pipeline = [fft.FFTFilter(mode=mode, axes=axes, cutoff=cutoff, lowCutoff=lowCutoff, highCutoff=highCutoff,
+                              order=order, sigma=sigma, stripeAxis=stripeAxis, center=center, FFTChoice=FFTChoice)]
+    return runPipeline(image, pipeline, platform=platform, session=session)
 
-def run_BilateralFilter(image, spatialRadius=3, rangeRadius=30, platform=None):
+def run_BilateralFilter(image, spatialRadius=3, rangeRadius=None, platform=None, session=None, mode='exact'):
     """
     Performs bilateral filter on image
 
@@ -251,8 +723,9 @@ def run_BilateralFilter(image, spatialRadius=3, rangeRadius=30, platform=None):
         3D image data
     spatialRadius: int, optional
         Specifies spatial radius
-    rangeRadius: int, optional
-        Specifies range radius
+    rangeRadius: float, optional
+        Specifies range radius, in grey levels of image. Defaults to 30 grey levels of np.uint8 scaled to the type of
+        image, see pyF3D.filters.BilateralFilter.BilateralFilter
     platform: {pyopencl.Platform, list, dict}, optional
         Platforms on which calculations are performed. Can either specify:
 
@@ -261,7 +734,10 @@ def run_BilateralFilter(image, spatialRadius=3, rangeRadius=30, platform=None):
         3). A dictionary of pyopencl.Platform and int key/value pairs. The int values specify the maximum number of
             slices to be placed on the platform at any time (ex.: {platform1: 100} will assign a maximum of 100 slices to
             platform1)
-
+    session: pyF3D.F3DSession.F3DSession, optional
+        Session whose devices, contexts, compiled programs and buffers are reused. platform is ignored when given
+    mode: str, optional
+        Either 'exact' (default) or 'fast', see pyF3D.filters.BilateralFilter.BilateralFilter
 
     Returns
     -------
@@ -269,12 +745,72 @@ def run_BilateralFilter(image, spatialRadius=3, rangeRadius=30, platform=None):
         3D image after bilateral filtering
     """
 
-    pipeline = [bf.BilateralFilter(spatialRadius=spatialRadius, rangeRadius=rangeRadius)]
-    stacks = runPipeline(image, pipeline, platform=platform)
-    return reconstruct_final_image(stacks)
+    pipeline = [bf.BilateralFilter(spatialRadius=spatialRadius, rangeRadius=rangeRadius, mode=mode)]
+    return runPipeline(image, pipeline, platform=platform, session=session)
 
+def compare_bilateral_modes(image, spatialRadius=3, rangeRadius=None, platform=None, backend='auto', session=None):
+    """
+    Filters image with the 'exact' and 'fast' modes of BilateralFilter, and reports the error of 'fast' against
+    'exact' along with the time taken by each
 
-def run_MaskFilter(image, maskChoice='mask3D', mask='StructuredElementL', L=3, platform=None):
+    Parameters
+    ----------
+    image: ndarray
+        3D image data
+    spatialRadius: int, optional
+        Specifies spatial radius
+    rangeRadius: float, optional
+        Specifies range radius, in grey levels of image. Defaults to 30 grey levels of np.uint8 scaled to the type of
+        image, see pyF3D.filters.BilateralFilter.BilateralFilter
+    platform: {pyopencl.Platform, list, dict}, optional
+        Platforms on which calculations are performed, as in run_f3d
+    backend: str, optional
+        Either 'opencl', 'cpu' or 'auto' (default), as in run_f3d
+    session: pyF3D.F3DSession.F3DSession, optional
+        Session whose devices, contexts, compiled programs and buffers are reused
+
+    Returns
+    -------
+    dict
+        'maxError', 'meanError' (mean absolute error), 'rmse' and 'psnr' (in dB) of the fast mode, 'exactSeconds',
+        'fastSeconds' and 'speedup'. Errors are in units of the type of image. The peak of the PSNR is the range of
+        the type for integer volumes, and the range of the values filtered in 'exact' mode for float volumes
+    """
+
+    results = {}
+    for mode in bf.BilateralFilter.modes:
+        pipeline = [bf.BilateralFilter(spatialRadius=spatialRadius, rangeRadius=rangeRadius, mode=mode)]
+        start = time.time()
+        results[mode] = runPipeline(image, pipeline, platform=platform, backend=backend, session=session)
+        results[mode + 'Seconds'] = time.time() - start
+
+    # slice by slice, so that the differences of large volumes are not held in memory at once. Differences are taken
+    # in float64, so that they neither wrap around for integer types nor are truncated for float32
+    maxError = 0.0
+    absoluteSum = 0.0
+    squareSum = 0.0
+    low = high = None
+    for exact, fast in zip(results['exact'], results['fast']):
+        difference = np.abs(exact.astype(np.float64) - fast)
+        maxError = max(maxError, float(difference.max()))
+        absoluteSum += float(difference.sum())
+        squareSum += float(np.square(difference).sum())
+        low = float(exact.min()) if low is None else min(low, float(exact.min()))
+        high = float(exact.max()) if high is None else max(high, float(exact.max()))
+
+    # peak of the PSNR: range of the type of integer volumes, range of the data of float volumes
+    dtype = results['exact'].dtype
+    peak = float(np.iinfo(dtype).max - np.iinfo(dtype).min) if np.issubdtype(dtype, np.integer) else high - low
+
+    size = float(np.prod(image.shape))
+    rmse = np.sqrt(squareSum/size)
+    return {'maxError': maxError, 'meanError': absoluteSum/size, 'rmse': rmse,
+            'psnr': 20*np.log10(peak/rmse) if rmse > 0 and peak > 0 else float('inf'),
+            'exactSeconds': results['exactSeconds'], 'fastSeconds': results['fastSeconds'],
+            'speedup': results['exactSeconds']/results['fastSeconds']}
+
+
+def run_MaskFilter(image, maskChoice='mask3D', mask='StructuredElementL', L=3, platform=None, session=None):
 
     """
     Performs mask filter on image
@@ -304,14 +840,15 @@ def run_MaskFilter(image, maskChoice='mask3D', mask='StructuredElementL', L=3, p
         3). A dictionary of pyopencl.Platform and int key/value pairs. The int values specify the maximum number of
             slices to be placed on the platform at any time (ex.: {platform1: 100} will assign a maximum of 100 slices to
             platform1)
+    session: pyF3D.F3DSession.F3DSession, optional
+        Session whose devices, contexts, compiled programs and buffers are reused. platform is ignored when given
 
     """
     pipeline = [mskf.MaskFilter(maskChoice=maskChoice, mask=mask, L=L)]
-    stacks = runPipeline(image, pipeline, platform=platform)
-    return reconstruct_final_image(stacks)
+    return runPipeline(image, pipeline, platform=platform, session=session)
 
 
-def run_MMFilterDil(image, mask='StructuredElementL', L=3, platform=None):
+def run_MMFilterDil(image, mask='StructuredElementL', L=3, platform=None, session=None):
     """
     Performs dilation filter on image
 
@@ -338,7 +875,8 @@ def run_MMFilterDil(image, mask='StructuredElementL', L=3, platform=None):
         3). A dictionary of pyopencl.Platform and int key/value pairs. The int values specify the maximum number of
             slices to be placed on the platform at any time (ex.: {platform1: 100} will assign a maximum of 100 slices to
             platform1)
-
+    session: pyF3D.F3DSession.F3DSession, optional
+        Session whose devices, contexts, compiled programs and buffers are reused. platform is ignored when given
 
     Returns
     -------
@@ -346,14 +884,13 @@ def run_MMFilterDil(image, mask='StructuredElementL', L=3, platform=None):
         3D image after dilation filtering
     """
 
-    print("Image shape inside run_dil: ",image.shape)
-    print("Mask shape: ",mask.shape)
+    logger.debug("Image shape inside run_dil: %s", image.shape)
+    logger.debug("Mask: %s", getattr(mask, "shape", mask))
     pipeline = [mmdil.MMFilterDil(mask=mask, L=L)]
-    stacks = runPipeline(image, pipeline, platform=platform)
-    return reconstruct_final_image(stacks)
+    return runPipeline(image, pipeline, platform=platform, session=session)
 
 
-def run_MMFilterEro(image, mask="StructuredElementL", L=3, platform=None):
+def run_MMFilterEro(image, mask="StructuredElementL", L=3, platform=None, session=None):
     """
     Performs erosion filter on image
 
@@ -380,7 +917,8 @@ def run_MMFilterEro(image, mask="StructuredElementL", L=3, platform=None):
         3). A dictionary of pyopencl.Platform and int key/value pairs. The int values specify the maximum number of
             slices to be placed on the platform at any time (ex.: {platform1: 100} will assign a maximum of 100 slices to
             platform1)
-
+    session: pyF3D.F3DSession.F3DSession, optional
+        Session whose devices, contexts, compiled programs and buffers are reused. platform is ignored when given
 
     Returns
     -------
@@ -389,11 +927,10 @@ def run_MMFilterEro(image, mask="StructuredElementL", L=3, platform=None):
     """
 
     pipeline = [mmero.MMFilterEro(mask=mask, L=L)]
-    stacks = runPipeline(image, pipeline, platform=platform)
-    return reconstruct_final_image(stacks)
+    return runPipeline(image, pipeline, platform=platform, session=session)
 
 
-def run_MMFilterClo(image, mask='StructuredElementL', L=3, platform=None):
+def run_MMFilterClo(image, mask='StructuredElementL', L=3, platform=None, session=None):
     """
     Performs closing filter on image
 
@@ -420,7 +957,8 @@ def run_MMFilterClo(image, mask='StructuredElementL', L=3, platform=None):
         3). A dictionary of pyopencl.Platform and int key/value pairs. The int values specify the maximum number of
             slices to be placed on the platform at any time (ex.: {platform1: 100} will assign a maximum of 100 slices to
             platform1)
-
+    session: pyF3D.F3DSession.F3DSession, optional
+        Session whose devices, contexts, compiled programs and buffers are reused. platform is ignored when given
 
     Returns
     -------
@@ -429,11 +967,10 @@ def run_MMFilterClo(image, mask='StructuredElementL', L=3, platform=None):
     """
 
     pipeline = [mmclo.MMFilterClo(mask=mask, L=L)]
-    stacks = runPipeline(image, pipeline, platform=platform)
-    return reconstruct_final_image(stacks)
+    return runPipeline(image, pipeline, platform=platform, session=session)
 
 
-def run_MMFilterOpe(image, mask='StructuredElementL', L=3, platform=None):
+def run_MMFilterOpe(image, mask='StructuredElementL', L=3, platform=None, session=None):
     """
     Performs opening filter on image
 
@@ -460,7 +997,8 @@ def run_MMFilterOpe(image, mask='StructuredElementL', L=3, platform=None):
         3). A dictionary of pyopencl.Platform and int key/value pairs. The int values specify the maximum number of
             slices to be placed on the platform at any time (ex.: {platform1: 100} will assign a maximum of 100 slices to
             platform1)
-
+    session: pyF3D.F3DSession.F3DSession, optional
+        Session whose devices, contexts, compiled programs and buffers are reused. platform is ignored when given
 
     Returns
     -------
@@ -469,44 +1007,30 @@ def run_MMFilterOpe(image, mask='StructuredElementL', L=3, platform=None):
     """
 
     pipeline = [mmope.MMFilterOpe(mask=mask, L=L)]
-    stacks = runPipeline(image, pipeline, platform=platform)
-    return reconstruct_final_image(stacks)
+    return runPipeline(image, pipeline, platform=platform, session=session)
 
 def reconstruct_final_image(stacks):
-        stacks = sorted(stacks)
-        image = stacks[0].stack
-        for stack in stacks[1:]:
-            image = np.append(image, stack.stack, axis=0)
-
-        return image
-
-load_lock = threading.Lock()
-def getNextRange(image, range, sliceCount, overlap):
-
-    global startIndex
+    """
+    Assembles portions of filtered data into a single volume
 
-    with load_lock:
-        endIndex = image.shape[0]
-        #endIndex = image.shape[2]
-        range[0] = max(0, startIndex)
-        range[1] = max(0, startIndex - overlap) + sliceCount - overlap
-        if range[1] >= endIndex or endIndex-range[1]<=20:
-            range[1] = endIndex
-        startIndex = range[1]
-        return startIndex
+    Parameters
+    ----------
+    stacks: list
+        StackRange objects, in any order
 
-result_lock = threading.Lock()
-def addResultStack(stacks, startRange, endRange, output, name, pipelineTime):
+    Returns
+    -------
+    ndarray
+        3D image
+    """
 
-    with result_lock:
-        sr = fc.StackRange()
-        sr.startRange = startRange
-        sr.endRange = endRange
-        sr.stack = output
-        sr.time = pipelineTime
-        sr.name = name
+    stacks = sorted(stacks)
+    first = stacks[0].stack
+    image = np.empty((stacks[-1].endRange - stacks[0].startRange,) + first.shape[1:], dtype=first.dtype)
+    for stack in stacks:
+        image[stack.startRange - stacks[0].startRange:stack.endRange - stacks[0].startRange] = stack.stack
 
-        stacks.append(sr)
+    return image
 
 def check_if_valid_platform(platform=None):
     if not platform:
@@ -540,33 +1064,35 @@ def check_if_valid_platform(platform=None):
 
 def setup_cl_prereqs(device=None):
     context = cl.Context([device])
-    queue = cl.CommandQueue(context, device)
+    queue = pr.createQueue(context, device)
 
     return device, context, queue
 
-def scale_to_uint8(data):
+def scale_to_uint8(data, output=None, percentiles=None, threadCount=None):
     """
-    Scales input array to np.uint8 type
+    Scales input array to np.uint8 type. The minimum and maximum (or percentiles) are found in a single streaming
+    pass, and the volume is converted chunk by chunk by a pool of threads, so that volumes larger than memory can be
+    scaled from disk into a memory-mapped output (see VolumeIO.scale_volume)
 
     Parameters
     ----------
-    data: np.ndarray
-        Input data. If not type np.ndarray, must be able to convert to np.ndarray
+    data: {np.ndarray, np.memmap, str}
+        Input data, of any type accepted by VolumeIO.open_volume. If not, must be able to convert to np.ndarray
+    output: {np.ndarray, np.memmap, str}, optional
+        Preallocated np.uint8 array of the shape of data, or path of the output, as accepted by VolumeIO.open_output
+    percentiles: tuple, optional
+        (low, high) percentiles, from 0 to 100, mapped to 0 and 255, e.g. (0.1, 99.9). Values outside are clipped.
+        Defaults to the minimum and maximum
+    threadCount: int, optional
+        Number of threads. Defaults to number of CPUs
 
     Returns
     -------
     np.ndarray
         data as type np.uint8 (8-bit)
     """
-    if type(data) is np.ndarray and data.dtype is np.dtype('uint8'):
+    data = vio.open_volume(data)
+    if data.dtype == np.uint8 and percentiles is None and output is None:
         return data
-    else:
-        if type(data) is not np.ndarray:
-            data = np.array(data)
-
-        a = float(255)/(float(np.max(data)) - float(np.min(data)))
-        b = (float(255)*float(np.min(data)))/(float(np.min(data)) - float(np.max(data)))
-
-        data = a*data + b
-        return (data).astype(np.uint8)
+    return vio.scale_volume(data, output, percentiles, threadCount)
 
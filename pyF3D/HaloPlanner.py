@@ -0,0 +1,125 @@
+class HaloPlan(object):
+    """
+    Halos of the stages of a pipeline run on slabs. Each filter reads voxels up to its halo (FilterInfo.overlapX/Y/Z)
+    away from the voxel it computes, so the halo a slab needs is the sum of the halos of all stages, not their
+    maximum. After each stage, the region of the slab whose values are exact shrinks by the halo of the stage, and
+    later stages only need to be run on that region
+
+    Parameters
+    ----------
+    pipeline: list
+        Filters of the pipeline, in order
+    """
+
+    def __init__(self, pipeline):
+        self.halos = []
+        for filter in pipeline:
+            info = filter.getInfo()
+            self.halos.append((info.overlapX, info.overlapY, info.overlapZ))
+        # halo added to each side of a slab, per axis (x, y, z)
+        self.total = tuple(sum(halo[axis] for halo in self.halos) for axis in range(3))
+
+    def windows(self, sliceCount, atStart, atEnd, axis=2):
+        """
+        Range [lo, hi) of the slices of a slab of sliceCount slices (along axis) on which each stage is run. Sides of
+        the slab at the start or at the end of the volume are not shrunk, so that stages see the border of the volume
+        there exactly as when filtering the whole volume
+
+        Parameters
+        ----------
+        sliceCount: int
+            Number of slices of the slab, including its halos
+        atStart: bool
+            True if the first slice of the slab is the first slice of the volume
+        atEnd: bool
+            True if the last slice of the slab is the last slice of the volume
+        axis: int, optional
+            Axis along which the slab is cut, 0 for x, 1 for y and 2 for z
+
+        Returns
+        -------
+        list
+            (lo, hi) range of each stage
+        """
+
+        lo = 0
+        hi = sliceCount
+        windows = []
+        for halo in self.halos:
+            windows.append((lo, hi))
+            if not atStart:
+                lo += halo[axis]
+            if not atEnd:
+                hi -= halo[axis]
+        return windows
+
+    def readVolume(self, shape, capacity, tileCounts, maxSliceCount=None):
+        """
+        Number of voxels read (including halos) to filter a volume of (slices, height, width) shape split into
+        (y, x) tileCounts bricks per slice, with slabs of at most capacity voxels and maxSliceCount slices. None if a
+        slab of a single slice and its halos does not fit
+        """
+
+        depth, height, width = shape
+        haloX, haloY, haloZ = self.total
+        tileHeight = -(-height // tileCounts[0]) + (2*haloY if tileCounts[0] > 1 else 0)
+        tileWidth = -(-width // tileCounts[1]) + (2*haloX if tileCounts[1] > 1 else 0)
+        sliceCount = capacity // (tileHeight*tileWidth)
+        if maxSliceCount:
+            sliceCount = min(sliceCount, maxSliceCount)
+        if sliceCount >= depth:
+            slabCount = 1
+        elif sliceCount - 2*haloZ < 1:
+            return None
+        else:
+            slabCount = -(-depth // (sliceCount - 2*haloZ))
+        return (width + 2*haloX*(tileCounts[1] - 1))*(height + 2*haloY*(tileCounts[0] - 1)) * \
+               (depth + 2*haloZ*(slabCount - 1))
+
+    def tiles(self, shape, capacity, maxTileCount=32, maxSliceCount=None):
+        """
+        Number of bricks (y, x) each slice of a volume of (slices, height, width) shape is split into, so that the
+        voxels read with the halos of the bricks and of the slabs are fewest. Slabs hold at most capacity voxels and
+        maxSliceCount slices. Splitting along y and x shortens the slices, so slabs hold more slices and fewer z-halos
+        are read, at the cost of the xy-halos of the bricks
+
+        Returns
+        -------
+        tuple
+            (1, 1) if slices are best not split
+        """
+
+        best = None
+        bestTiles = (1, 1)
+        for tileCountY in range(1, min(shape[1], maxTileCount) + 1):
+            for tileCountX in range(1, min(shape[2], maxTileCount) + 1):
+                volume = self.readVolume(shape, capacity, (tileCountY, tileCountX), maxSliceCount)
+                if volume is not None and (best is None or volume < best):
+                    best = volume
+                    bestTiles = (tileCountY, tileCountX)
+        return bestTiles
+
+    def bricks(self, shape, capacity, maxSliceCount=None):
+        """
+        xy-bricks of a volume of (slices, height, width) shape, see tiles
+
+        Returns
+        -------
+        list
+            ((y0, y1), (x0, x1)) range of the voxels of each brick that are part of the result, and ((y0, y1), (x0, x1))
+            range of the voxels read, including the halos
+        """
+
+        tileCounts = self.tiles(shape, capacity, maxSliceCount=maxSliceCount)
+        ranges = []
+        for axis, halo, count in [(1, self.total[1], tileCounts[0]), (2, self.total[0], tileCounts[1])]:
+            length = shape[axis]
+            bounds = [length*i // count for i in range(count + 1)]
+            ranges.append([((bounds[i], bounds[i + 1]), (max(0, bounds[i] - halo), min(length, bounds[i + 1] + halo)))
+                           for i in range(count)])
+
+        bricks = []
+        for yInner, yOuter in ranges[0]:
+            for xInner, xOuter in ranges[1]:
+                bricks.append(((yInner, xInner), (yOuter, xOuter)))
+        return bricks
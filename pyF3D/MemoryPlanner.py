@@ -0,0 +1,149 @@
+import os
+import threading
+import numpy as np
+
+# fraction of the global memory of a device left to the driver, other programs and buffers too small to be counted
+headroom = float(os.environ.get('PYF3D_MEMORY_HEADROOM', 0.1))
+
+_budgets = {}
+_lock = threading.Lock()
+
+def setMemoryHeadroom(fraction=0.1):
+    """
+    Sets the fraction of the global memory of each device that slabs are not allowed to use. Can also be set through
+    the PYF3D_MEMORY_HEADROOM environment variable
+
+    Parameters
+    ----------
+    fraction: float, optional
+        Between 0 and 1
+    """
+
+    global headroom
+    if not 0 <= fraction < 1:
+        raise ValueError('headroom must be between 0 and 1')
+    headroom = float(fraction)
+
+def pipelineBuffers(pipeline):
+    """
+    Device buffers needed by the filters of pipeline, besides the slab buffers (see FilterInfo.tmpBufferCount,
+    voxelBytes and fixedBytes). Filters run one after the other and temporary buffers are shared, so the largest need
+    of any filter is counted
+
+    Returns
+    -------
+    tuple
+        (number of temporary buffers of the size of a slab buffer, bytes of other buffers per voxel of the slab, bytes
+        of buffers not depending on the slab)
+    """
+
+    tmpBufferCount = 0
+    voxelBytes = 0
+    fixedBytes = 0
+    for filter in pipeline:
+        info = filter.getInfo()
+        tmpBufferCount = max(tmpBufferCount, info.tmpBufferCount)
+        voxelBytes = max(voxelBytes, info.voxelBytes)
+        fixedBytes = max(fixedBytes, info.fixedBytes)
+    return tmpBufferCount, voxelBytes, fixedBytes
+
+def planSlab(device, pipeline, width, height, dtype=np.uint8, overlap=0, bufferCount=1, maxSliceCount=None,
+             depth=None, bufferPool=None):
+    """
+    Largest slab of slices of width x height voxels whose buffers fit in the global memory of device, less the
+    headroom. Every buffer is counted: the input and output buffers of each of the bufferCount slots, the temporary
+    buffers of the pipeline, buffers sized by the slab (masks, transforms) and fixed buffers (structuring elements,
+    weights). No buffer may be larger than device.max_mem_alloc_size. The budget chosen is kept for memoryReport
+
+    Parameters
+    ----------
+    device: pyopencl.Device
+        Device the slabs are filtered on
+    pipeline: list
+        Filters run on each slab
+    width, height: int
+        Size of the slices
+    dtype: np.dtype, optional
+        Type of the voxels
+    overlap: int, optional
+        Halo added to each side of a slab, counted in the slices of the slab
+    bufferCount: int, optional
+        Number of slots of slab buffers, see run_f3d
+    maxSliceCount: int, optional
+        Limit set by the user, in slices
+    depth: int, optional
+        Number of slices of the volume, slabs are not made deeper
+    bufferPool: pyF3D.ClAttributes.BufferPool, optional
+        Pool the buffers are taken from, whose buffer sizes are rounded up (see BufferPool.bucketSize)
+
+    Returns
+    -------
+    dict
+        Budget: 'maxSliceCount' slices per slab including halos, 'resultSlices' slices per slab without halos,
+        'fits' False if a slab of one slice and its halos does not fit, and the bytes counted
+    """
+
+    tmpBufferCount, voxelBytes, fixedBytes = pipelineBuffers(pipeline)
+    slabBufferCount = 2*bufferCount + tmpBufferCount
+    itemSize = np.dtype(dtype).itemsize
+    sliceVoxels = width*height
+    usable = int(device.global_mem_size*(1 - headroom)) - fixedBytes
+
+    def bufferSize(size):
+        return bufferPool.bucketSize(size) if bufferPool is not None else size
+
+    def slabBytes(sliceCount):
+        return slabBufferCount*bufferSize(sliceCount*sliceVoxels*itemSize) + sliceCount*sliceVoxels*voxelBytes
+
+    # largest slice count whose buffers fit, by bisection as pool buckets make slabBytes a step function
+    low = 0
+    high = max(1, usable // max(1, sliceVoxels*(slabBufferCount*itemSize + voxelBytes)))
+    high = min(high, device.max_mem_alloc_size // (sliceVoxels*itemSize))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if slabBytes(middle) <= usable and bufferSize(middle*sliceVoxels*itemSize) <= device.max_mem_alloc_size:
+            low = middle
+        else:
+            high = middle - 1
+    sliceCount = low
+
+    if depth is not None:
+        sliceCount = min(sliceCount, depth)
+    if maxSliceCount:
+        sliceCount = min(sliceCount, maxSliceCount)
+    minSliceCount = 1 + 2*overlap if depth is None else min(depth, 1 + 2*overlap)
+    # a slab holding the whole depth has no halo
+    resultSlices = depth if depth is not None and sliceCount >= depth else max(0, sliceCount - 2*overlap)
+
+    budget = {'device': device.name, 'globalMemSize': device.global_mem_size, 'headroom': headroom,
+              'usableBytes': usable + fixedBytes, 'fixedBytes': fixedBytes, 'slabBuffers': 2*bufferCount,
+              'tmpBuffers': tmpBufferCount, 'voxelBytes': voxelBytes, 'maxSliceCount': sliceCount,
+              'resultSlices': resultSlices, 'totalBytes': slabBytes(sliceCount) + fixedBytes,
+              'fits': sliceCount >= minSliceCount}
+    with _lock:
+        _budgets[device.name] = budget
+    return budget
+
+def slabCapacity(device, pipeline, dtype=np.uint8, bufferCount=1):
+    """
+    Number of voxels of the largest slab that fits on device, whatever its shape, see planSlab
+    """
+
+    tmpBufferCount, voxelBytes, fixedBytes = pipelineBuffers(pipeline)
+    itemSize = np.dtype(dtype).itemsize
+    usable = int(device.global_mem_size*(1 - headroom)) - fixedBytes
+    capacity = usable // ((2*bufferCount + tmpBufferCount)*itemSize + voxelBytes)
+    return max(0, min(capacity, device.max_mem_alloc_size // itemSize))
+
+def memoryReport():
+    """
+    Memory budget chosen for the last slabs planned on each device, see planSlab
+
+    Returns
+    -------
+    dict
+        Device name and budget key/value pairs
+    """
+
+    with _lock:
+        return dict((name, dict(budget)) for name, budget in _budgets.items())
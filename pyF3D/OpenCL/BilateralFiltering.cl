@@ -1,28 +1,15 @@
-float dynamicKernel(float radius, int index)
+// TILE_RADIUS, the spatial radius, is set at build time for BilateralFilterTiled
+// Weighted sums are not contracted to fused multiply-adds, so that they round as those of CpuBackend: the rounded
+// passes of mode='fast' would otherwise carry the difference to other voxels
+#pragma OPENCL FP_CONTRACT OFF
+#include "Tiling.cl"
+#include "ZBlocking.cl"
+
+// Weight of a neighbour differing by diff from the center, read from the range kernel of rangeSize weights computed on
+// the host (see CpuBackend.rangeTable). rangeScale converts diff to an offset from the center of the kernel
+float rangeWeight(constant float* rangeKernel, VALUE diff, float rangeScale, int rangeSize)
 {
-    float x = (index + 1 - radius) / (radius * 2) / 0.2;
-    return (float)exp(-0.5 * x * x);
-}
-
-kernel void makeKernel(float radius, global float* output, const int output_size)
-{
-    size_t i = get_global_id(0);
-
-    if(i >= output_size) return;
-
-    output[i] = dynamicKernel(radius,i);
-}
-
-kernel void normalizeKernel(float total, global float* output, const int output_size)
-{
-    size_t i = get_global_id(0);
-
-    if(i >=  output_size) return;
-
-     if (total <= 0.0)
-        output[i] = 1.0f / output_size;
-     else if (total != 1.0)
-        output[i] /= total;
+    return rangeKernel[convert_int_rte(diff*rangeScale) + rangeSize/2];
 }
 
 bool isOutsideBounds(const int3 pos, const int3 sizes)
@@ -39,21 +26,21 @@ bool isOutsideBounds(const int3 pos, const int3 sizes)
     return false;
 }
 
-int getValue(global const uchar* buffer, const int3 pos, const int3 sizes)
+VALUE getValue(global const VOXEL* buffer, const int3 pos, const int3 sizes)
 {
      if(pos.x < 0 || pos.y < 0 || pos.z < 0 ||
         pos.x >= sizes.x || pos.y >= sizes.y || pos.z >= sizes.z)
-        return -1;
+        return VALUE_NONE;
 
     size_t index = pos.x + pos.y*sizes.x + pos.z*sizes.x*sizes.y;
 
     if(index >= sizes.x*sizes.y*sizes.z)
-        return -1;
+        return VALUE_NONE;
 
     return buffer[index];
 }
 
-void setValue(global uchar* buffer, const int3 pos, const int3 sizes, int value)
+void setValue(global VOXEL* buffer, const int3 pos, const int3 sizes, VOXEL value)
 {
     size_t index = pos.x + pos.y*sizes.x + pos.z*sizes.x*sizes.y;
     buffer[index] = value;
@@ -61,17 +48,18 @@ void setValue(global uchar* buffer, const int3 pos, const int3 sizes, int value)
 
 void DaniBilateralFilter3D(const int3 pos, 
                            const int3 sizes, 
-                           global const uchar* inputBuffer, 
-                           global uchar* outputBuffer, 
-                           global const float* spatialKernel, 
+                           global const VOXEL* inputBuffer, 
+                           global VOXEL* outputBuffer, 
+                           constant float* spatialKernel, 
                            const int spatialSize,
-                           global const float* rangeKernel, 
-                           const int rangeSize)
+                           constant float* rangeKernel, 
+                           const int rangeSize,
+                           const float rangeRadius,
+                           const float rangeScale)
 {
-    int v0 =  getValue(inputBuffer, pos, sizes);
+    VALUE v0 = getValue(inputBuffer, pos, sizes);
 
     int sc = (int)spatialSize / 2;
-    int rc = (int)rangeSize / 2;
     
     float v = 0;
     float total = 0;
@@ -85,30 +73,34 @@ void DaniBilateralFilter3D(const int3 pos,
                 int3 pos2 = { pos.x + n - sc, 
                               pos.y + m - sc, 
                               pos.z + k - sc };
-                int v1 = getValue(inputBuffer, pos2, sizes);
+                VALUE v1 = getValue(inputBuffer, pos2, sizes);
 
-                if(v1 < 0) continue;
-                if(abs(v1-v0) > rc) continue;
+                if(!HAS_VALUE(v1)) continue;
+                // also skips every neighbour of a NaN center of float volumes
+                if(!(v1 - v0 <= rangeRadius && v0 - v1 <= rangeRadius)) continue;
                 //if(isOutsideBounds(sizes, pos2)) continue;
 
-                float w = spatialKernel[m] * spatialKernel[n] * rangeKernel[v1 - v0 + rc];
+                float w = spatialKernel[m] * spatialKernel[n] *
+                          rangeWeight(rangeKernel, v1 - v0, rangeScale, rangeSize);
                 v += v1 * w;
                 total += w;
             }
         }
     }
-    setValue(outputBuffer, pos, sizes, (int)(v/total));
+    setValue(outputBuffer, pos, sizes, CONVERT_VOXEL(v/total));
 }
 
-kernel void BilateralFilter(global const uchar* inputBuffer, 
-                            global uchar* outputBuffer,  
+kernel void BilateralFilter(global const VOXEL* inputBuffer, 
+                            global VOXEL* outputBuffer,  
                             const int imageWidth, 
                             const int imageHeight, 
                             const int imageDepth,
-                            global const float* spatialKernel,  
+                            constant float* spatialKernel,  
                             const int spatialSize,
-                            global const float* rangeKernel, 
-                            const int rangeSize)
+                            constant float* rangeKernel, 
+                            const int rangeSize,
+                            const float rangeRadius,
+                            const float rangeScale)
 {
 
     const int3 sizes = { imageWidth, imageHeight, imageDepth };
@@ -116,7 +108,8 @@ kernel void BilateralFilter(global const uchar* inputBuffer,
     
     if(isOutsideBounds(pos, sizes)) return;
 
-    for(int i = 0; i < imageDepth; ++i)
+    int2 slices = sliceRange(imageDepth);
+    for(int i = slices.x; i < slices.y; ++i)
     {
         int3 pos = { get_global_id(0), get_global_id(1), i };
         DaniBilateralFilter3D(pos, 
@@ -126,6 +119,113 @@ kernel void BilateralFilter(global const uchar* inputBuffer,
                               spatialKernel, 
                               spatialSize, 
                               rangeKernel, 
-                              rangeSize);
+                              rangeSize,
+                              rangeRadius,
+                              rangeScale);
     }    
 }
+
+// Tiled variant of BilateralFilter, the neighbourhood is read from the local tile (see Tiling.cl). spatialSize must be
+// 2*TILE_RADIUS + 1
+kernel void BilateralFilterTiled(global const VOXEL* inputBuffer,
+                                 global VOXEL* outputBuffer,
+                                 const int imageWidth,
+                                 const int imageHeight,
+                                 const int imageDepth,
+                                 constant float* spatialKernel,
+                                 const int spatialSize,
+                                 constant float* rangeKernel,
+                                 const int rangeSize,
+                                 const float rangeRadius,
+                                 const float rangeScale,
+                                 local TILE_VALUE* tile)
+{
+    const int3 sizes = { imageWidth, imageHeight, imageDepth };
+    int3 pos = { get_global_id(0), get_global_id(1), 0 };
+    bool inside = !isOutsideBounds(pos, sizes);
+
+    int sc = (int)spatialSize / 2;
+
+    int2 slices = sliceRange(imageDepth);
+    startTile(inputBuffer, tile, sizes, slices.x);
+    for(int i = slices.x; i < slices.y; ++i)
+    {
+        advanceTile(inputBuffer, tile, sizes, i);
+        if(!inside)
+            continue;
+
+        VALUE v0 = tileValue(tile, 0, 0, i);
+        float v = 0;
+        float total = 0;
+
+        for (int n = 0; n < spatialSize; ++n)
+        {
+            for (int m = 0; m < spatialSize; ++m)
+            {
+                for (int k = 0; k < spatialSize; ++k)
+                {
+                    VALUE v1 = tileValue(tile, n - sc, m - sc, i + k - sc);
+
+                    if(!HAS_VALUE(v1)) continue;
+                    if(!(v1 - v0 <= rangeRadius && v0 - v1 <= rangeRadius)) continue;
+
+                    float w = spatialKernel[m] * spatialKernel[n] *
+                          rangeWeight(rangeKernel, v1 - v0, rangeScale, rangeSize);
+                    v += v1 * w;
+                    total += w;
+                }
+            }
+        }
+        pos.z = i;
+        setValue(outputBuffer, pos, sizes, CONVERT_VOXEL(v/total));
+    }
+}
+
+// One pass of the separable approximation of the bilateral filter (mode='fast'): a one-dimensional bilateral
+// filter along direction, whose components are 0 or 1. Running it along x, y then z costs 3*spatialSize reads per
+// voxel instead of spatialSize^3. Unlike BilateralFilter, the z offset is weighted by the spatial kernel as well.
+// Intermediate passes of integer volumes round to the nearest value, the last one truncates as BilateralFilter does
+kernel void BilateralFilterLine(global const VOXEL* inputBuffer,
+                                global VOXEL* outputBuffer,
+                                const int imageWidth,
+                                const int imageHeight,
+                                const int imageDepth,
+                                const int4 direction,
+                                constant float* spatialKernel,
+                                const int spatialSize,
+                                constant float* rangeKernel,
+                                const int rangeSize,
+                                const float rangeRadius,
+                                const float rangeScale,
+                                const int lastPass)
+{
+    const int3 sizes = { imageWidth, imageHeight, imageDepth };
+    int3 pos = { get_global_id(0), get_global_id(1), 0 };
+
+    if(isOutsideBounds(pos, sizes)) return;
+
+    int sc = (int)spatialSize / 2;
+    float rounding = lastPass || VOXEL_IS_FLOAT ? 0.0f : 0.5f;
+
+    int2 slices = sliceRange(imageDepth);
+    for(int i = slices.x; i < slices.y; ++i)
+    {
+        pos.z = i;
+        VALUE v0 = getValue(inputBuffer, pos, sizes);
+        float v = 0;
+        float total = 0;
+
+        for(int k = -sc; k <= sc; ++k)
+        {
+            VALUE v1 = getValue(inputBuffer, pos + k*direction.xyz, sizes);
+
+            if(!HAS_VALUE(v1)) continue;
+            if(!(v1 - v0 <= rangeRadius && v0 - v1 <= rangeRadius)) continue;
+
+            float w = spatialKernel[k + sc] * rangeWeight(rangeKernel, v1 - v0, rangeScale, rangeSize);
+            v += v1 * w;
+            total += w;
+        }
+        setValue(outputBuffer, pos, sizes, CONVERT_VOXEL(v/total + rounding));
+    }
+}
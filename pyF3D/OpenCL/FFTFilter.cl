@@ -1,137 +1,369 @@
-bool isOutsideBounds(const int3 pos, const int3 sizes)
-{
-     if(pos.x < 0 || pos.y < 0 || pos.z < 0 ||
-        pos.x >= sizes.x || pos.y >= sizes.y || pos.z >= sizes.z)
-        return true;
-
-    size_t index = pos.x + pos.y*sizes.x + pos.z*sizes.x*sizes.y;
-
-    if(index >= sizes.x*sizes.y*sizes.z)
-        return true;
-
-    return false;
-}
-#define PI2 6.2832
-/**!
- * One Dimensional FFT Filter : direction = 0 (X), 1 (Y), 2 (Z)
- */
-void FFTFilterZ(global const float* inputBuffer, 
-                global float* realBuffer, 
-                global float* imagBuffer,  
-                const int direction,   
-                const int3 sizes)
-{
-    int N = sizes.z;
-	int3 pos = { get_global_id(0), get_global_id(1), 0 };
-    if(isOutsideBounds(pos, sizes)) return;
-    
-    ///TODO: move DFT to FFT.	
-    for (int k=0 ; k < N ; ++k)
+// Mixed-radix FFT of complex volumes along one axis, and the frequency-domain operations of FFTFilter.
+//
+// Complex volumes are float2 buffers of sizes (width, height, depth), x varying fastest. A transform of length N along
+// an axis is a sequence of Stockham autosort passes (FFTStage), one per radix of N, reading from one buffer and
+// writing to the other. Each pass costs N/radix butterflies of O(radix^2) per line, so a transform costs
+// O(N * sum(radices)), that is O(N log N) for lengths made of small factors.
+
+#include "Voxel.cl"
+
+#ifndef MAX_RADIX
+#define MAX_RADIX 16
+#endif
+
+#define PI2 6.283185307179586f
+
+int lineLength(int axis, int3 sizes)
+{
+    return axis == 0 ? sizes.x : (axis == 1 ? sizes.y : sizes.z);
+}
+
+size_t lineStep(int axis, int3 sizes)
+{
+    return axis == 0 ? 1 : (axis == 1 ? (size_t)sizes.x : (size_t)sizes.x*sizes.y);
+}
+
+// first element of line, lines being enumerated along the other two axes
+size_t lineStart(size_t line, int axis, int3 sizes)
+{
+    if(axis == 0)
+        return line*sizes.x;
+    if(axis == 1)
+        return line % sizes.x + (line / sizes.x)*sizes.x*sizes.y;
+    return line;
+}
+
+float2 complexMultiply(float2 a, float2 b)
+{
+    return (float2)(a.x*b.x - a.y*b.y, a.x*b.y + a.y*b.x);
+}
+
+float2 unitRoot(float angle)
+{
+    float c;
+    float s = sincos(angle, &c);
+    return (float2)(c, s);
+}
+
+// Work-item of a pass of radix radix: butterfly j of a line. Sets the first element and step of the inputs of the
+// butterfly, the first element and step of its outputs, and the angle of its twiddle factors. False for padding
+// work-items
+bool stageButterfly(int3 sizes, int axis, int radix, int stride, float sign, size_t* input, size_t* inputStep,
+                    size_t* output, size_t* outputStep, float* angle)
+{
+    int N = lineLength(axis, sizes);
+    int butterflies = N / radix;
+    size_t lineCount = (size_t)sizes.x*sizes.y*sizes.z / N;
+
+    size_t id = get_global_id(0);
+    size_t line = id / butterflies;
+    int j = id % butterflies;
+    if(line >= lineCount)
+        return false;
+
+    size_t start = lineStart(line, axis, sizes);
+    size_t step = lineStep(axis, sizes);
+    int k = j % stride;
+    *input = start + j*step;
+    *inputStep = butterflies*step;
+    *output = start + ((j / stride)*stride*radix + k)*step;
+    *outputStep = stride*step;
+    *angle = sign*PI2*k / (stride*radix);
+    return true;
+}
+
+// One pass of radix radix, stride being the product of the radices of the previous passes. sign is -1 for forward
+// and 1 for inverse transforms; outputs are multiplied by scale. FFTStage2 and FFTStage4 are the same pass for radices
+// 2 and 4, whose butterflies need no trigonometry
+kernel void FFTStage(global const float2* input,
+                     global float2* output,
+                     int width,
+                     int height,
+                     int depth,
+                     int axis,
+                     int radix,
+                     int stride,
+                     float sign,
+                     float scale)
+{
+    size_t in, inStep, out, outStep;
+    float angle;
+    if(!stageButterfly((int3)(width, height, depth), axis, radix, stride, sign, &in, &inStep, &out, &outStep, &angle))
+        return;
+
+    float2 v[MAX_RADIX];
+    float2 roots[MAX_RADIX];
+    for(int r = 0; r < radix; ++r)
     {
-        size_t kindex = pos.x + pos.y*sizes.x + k*sizes.x*sizes.y;
-      
-        realBuffer[kindex] = imagBuffer[kindex] = 0;
-        
-        for (int n=0 ; n < 10 ; ++n)  {
-            size_t nindex = pos.x + pos.y*sizes.x + n*sizes.x*sizes.y;
-         	
-         	realBuffer[kindex] += inputBuffer[nindex] * cos(direction * n * k * PI2 / N);
-            imagBuffer[kindex] -= inputBuffer[nindex] * sin(direction * n * k * PI2 / N);
-        }
-        
-        if(direction == -1) {
-           realBuffer[kindex] /= N;
-           imagBuffer[kindex] /= N;
-        }
-        // Power at kth frequency bin
-        //realBuffer[kindex] = realBuffer[kindex]*realBuffer[kindex] + imagBuffer[kindex]*imagBuffer[kindex];
-    }           
-}
-
-void FFTFilterY(global const float* inputBuffer, 
-                global float* realBuffer, 
-                global float* imagBuffer,  
-                const int direction,   
-                const int3 sizes)
-{
-    int N = sizes.y;
-	int3 pos = { get_global_id(0), 0, get_global_id(1) };
-	if(isOutsideBounds(pos, sizes)) return;
-   
-    ///TODO: move DFT to FFT.     
-    for (int k=0 ; k < N ; ++k)
+        v[r] = complexMultiply(input[in + r*inStep], unitRoot(angle*r));
+        roots[r] = unitRoot(sign*PI2*r / radix);
+    }
+
+    for(int q = 0; q < radix; ++q)
     {
-        size_t kindex = pos.x + k*sizes.x + pos.z*sizes.x*sizes.y;
-      
-        realBuffer[kindex] = imagBuffer[kindex] = 0;
-        
-        for (int n=0 ; n < 10 ; ++n)  {
-            size_t nindex = pos.x + n*sizes.x + pos.z*sizes.x*sizes.y;
-         	
-         	realBuffer[kindex] += inputBuffer[nindex] * cos(direction * n * k * PI2 / N);
-            imagBuffer[kindex] -= inputBuffer[nindex] * sin(direction * n * k * PI2 / N);
-        }
-        
-        if(direction == -1) {
-           realBuffer[kindex] /= N;
-           imagBuffer[kindex] /= N;
-        }
-        
-        // Power at kth frequency bin
-        //realBuffer[kindex] = realBuffer[kindex]*realBuffer[kindex] + imagBuffer[kindex]*imagBuffer[kindex];
-    }       
-}
-
-void FFTFilterX(global const float* inputBuffer, 
-                global float* realBuffer, 
-                global float* imagBuffer,
-                const int direction,   
-                const int3 sizes)
-{
-    int N = sizes.x;
-    int3 pos = { 0, get_global_id(0), get_global_id(1)};
-    if(isOutsideBounds(pos, sizes)) return;
-    
-    ///TODO: move DFT to FFT.
-    for (int k=0 ; k < N ; ++k)
+        float2 sum = v[0];
+        for(int r = 1; r < radix; ++r)
+            sum += complexMultiply(v[r], roots[(r*q) % radix]);
+        output[out + q*outStep] = sum*scale;
+    }
+}
+
+kernel void FFTStage2(global const float2* input,
+                      global float2* output,
+                      int width,
+                      int height,
+                      int depth,
+                      int axis,
+                      int radix,
+                      int stride,
+                      float sign,
+                      float scale)
+{
+    size_t in, inStep, out, outStep;
+    float angle;
+    if(!stageButterfly((int3)(width, height, depth), axis, 2, stride, sign, &in, &inStep, &out, &outStep, &angle))
+        return;
+
+    float2 v0 = input[in];
+    float2 v1 = complexMultiply(input[in + inStep], unitRoot(angle));
+    output[out] = (v0 + v1)*scale;
+    output[out + outStep] = (v0 - v1)*scale;
+}
+
+kernel void FFTStage4(global const float2* input,
+                      global float2* output,
+                      int width,
+                      int height,
+                      int depth,
+                      int axis,
+                      int radix,
+                      int stride,
+                      float sign,
+                      float scale)
+{
+    size_t in, inStep, out, outStep;
+    float angle;
+    if(!stageButterfly((int3)(width, height, depth), axis, 4, stride, sign, &in, &inStep, &out, &outStep, &angle))
+        return;
+
+    float2 v0 = input[in];
+    float2 v1 = complexMultiply(input[in + inStep], unitRoot(angle));
+    float2 v2 = complexMultiply(input[in + 2*inStep], unitRoot(2.0f*angle));
+    float2 v3 = complexMultiply(input[in + 3*inStep], unitRoot(3.0f*angle));
+
+    float2 a0 = v0 + v2;
+    float2 a1 = v0 - v2;
+    float2 a2 = v1 + v3;
+    // (v1 - v3) times sign*i
+    float2 a3 = (float2)(v3.y - v1.y, v1.x - v3.x)*sign;
+    output[out] = (a0 + a2)*scale;
+    output[out + outStep] = (a1 + a3)*scale;
+    output[out + 2*outStep] = (a0 - a2)*scale;
+    output[out + 3*outStep] = (a1 - a3)*scale;
+}
+
+// index of the voxel read for position i of an axis of length n padded by reflection
+int reflectIndex(int i, int n)
+{
+    if(n == 1)
+        return 0;
+    int period = 2*(n - 1);
+    i = i % period;
+    return i < n ? i : period - i;
+}
+
+// Converts a slab to a complex volume of padded sizes, padding each axis by reflection
+kernel void FFTLoad(global const VOXEL* inputBuffer,
+                    global float2* output,
+                    int width,
+                    int height,
+                    int depth,
+                    int paddedWidth,
+                    int paddedHeight,
+                    int paddedDepth)
+{
+    size_t id = get_global_id(0);
+    if(id >= (size_t)paddedWidth*paddedHeight*paddedDepth)
+        return;
+
+    int x = reflectIndex(id % paddedWidth, width);
+    int y = reflectIndex((id / paddedWidth) % paddedHeight, height);
+    int z = reflectIndex(id / ((size_t)paddedWidth*paddedHeight), depth);
+    output[id] = (float2)(inputBuffer[x + y*width + (size_t)z*width*height], 0.0f);
+}
+
+// Writes the rounded real part of the (width, height, depth) corner of a complex volume of padded sizes to a slab
+kernel void FFTStore(global const float2* input,
+                     global VOXEL* outputBuffer,
+                     int width,
+                     int height,
+                     int depth,
+                     int paddedWidth,
+                     int paddedHeight)
+{
+    size_t id = get_global_id(0);
+    if(id >= (size_t)width*height*depth)
+        return;
+
+    int x = id % width;
+    int y = (id / width) % height;
+    int z = id / ((size_t)width*height);
+    float value = input[x + y*paddedWidth + (size_t)z*paddedWidth*paddedHeight].x;
+    outputBuffer[id] = CONVERT_VOXEL_RTE(value);
+}
+
+// frequency, in cycles per voxel, of index i of a transform of length n
+float frequency(int i, int n)
+{
+    return (i <= n / 2 ? i : i - n) / (float)n;
+}
+
+float butterworth(float f, float cutoff, int order)
+{
+    return 1.0f / (1.0f + pown(f / cutoff, 2*order));
+}
+
+// modes, as in FFTFilter.modes
+#define MODE_LOWPASS 0
+#define MODE_HIGHPASS 1
+#define MODE_BANDPASS 2
+#define MODE_STRIPES 3
+#define MODE_RINGS 4
+
+// Multiplies a spectrum by the transfer function of mode. axes has bit i set for each transformed axis i. Stripes
+// are constant along stripeAxis: they are in a band of half-width sigma around the zero frequency of stripeAxis,
+// above cutoff along the other axes. For rings, the spectrum is that of polar slices (angle along x, radius along y)
+// and only this band is kept, as an estimate of the rings
+kernel void FFTFilterSpectrum(global float2* data,
+                              int width,
+                              int height,
+                              int depth,
+                              int axes,
+                              int mode,
+                              float cutoff,
+                              float lowCutoff,
+                              float highCutoff,
+                              int order,
+                              float sigma,
+                              int stripeAxis)
+{
+    size_t id = get_global_id(0);
+    if(id >= (size_t)width*height*depth)
+        return;
+
+    int x = id % width;
+    int y = (id / width) % height;
+    int z = id / ((size_t)width*height);
+    float fx = axes & 1 ? frequency(x, width) : 0.0f;
+    float fy = axes & 2 ? frequency(y, height) : 0.0f;
+    float fz = axes & 4 ? frequency(z, depth) : 0.0f;
+
+    float squared = fx*fx + fy*fy + fz*fz;
+    float stripeFrequency = stripeAxis == 0 ? fx : (stripeAxis == 1 ? fy : fz);
+    float otherSquared = (stripeAxis == 0 ? 0.0f : fx*fx) + (stripeAxis == 1 ? 0.0f : fy*fy) +
+                         (stripeAxis == 2 ? 0.0f : fz*fz);
+    float f = sqrt(squared);
+
+    float gain = 1.0f;
+    if(mode == MODE_LOWPASS)
+        gain = butterworth(f, cutoff, order);
+    else if(mode == MODE_HIGHPASS)
+        gain = f == 0.0f ? 1.0f : 1.0f - butterworth(f, cutoff, order);
+    else if(mode == MODE_BANDPASS)
+        gain = f == 0.0f ? 1.0f : butterworth(f, highCutoff, order)*(1.0f - butterworth(f, lowCutoff, order));
+    else
     {
-        size_t kindex = k + pos.y*sizes.x + pos.z*sizes.x*sizes.y;
-      
-        realBuffer[kindex] = imagBuffer[kindex] = 0;
-        
-        for (int n=0 ; n < 10 /* N */ ; ++n)  {
-            size_t nindex = n + pos.y*sizes.x + pos.z*sizes.x*sizes.y;
-         	realBuffer[kindex] += inputBuffer[nindex] * cos(direction * n * k * PI2 / N);
-            imagBuffer[kindex] -= inputBuffer[nindex] * sin(direction * n * k * PI2 / N);
-        }
-        
-        if(direction == -1) {
-           realBuffer[kindex] /= N;
-           imagBuffer[kindex] /= N;
-        }
-        
-        // Power at kth frequency bin
-        //realBuffer[kindex] = realBuffer[kindex]*realBuffer[kindex] + imagBuffer[kindex]*imagBuffer[kindex];
-    }    
-}
-
-kernel void FFTFilter(global const float* inputBuffer, 
-                      global float* realBuffer,
-                      global float* imagBuffer,
-                      int direction,
-                      int imageWidth,
-                      int imageHeight,
-                      int imageDepth,   
-                      int dimension)
-{
-    const int3 sizes = { imageWidth, imageHeight, imageDepth };
-    
-     
-     if(dimension == 0) {
-       FFTFilterX(inputBuffer, realBuffer, imagBuffer, direction, sizes);
-     } else if(dimension == 1) {
-       FFTFilterY(inputBuffer, realBuffer, imagBuffer, direction, sizes);
-     } else {
-       FFTFilterZ(inputBuffer, realBuffer, imagBuffer, direction, sizes);
-     }
- }
+        float band = exp(-stripeFrequency*stripeFrequency / (2.0f*sigma*sigma))*
+                     (1.0f - butterworth(sqrt(otherSquared), cutoff, order));
+        gain = mode == MODE_STRIPES ? 1.0f - band : band;
+    }
+
+    data[id] *= gain;
+}
+
+float sampleSlice(global const VOXEL* buffer, int width, int height, size_t offset, float x, float y)
+{
+    x = clamp(x, 0.0f, width - 1.0f);
+    y = clamp(y, 0.0f, height - 1.0f);
+    int x0 = min((int)x, width - 2 < 0 ? 0 : width - 2);
+    int y0 = min((int)y, height - 2 < 0 ? 0 : height - 2);
+    int x1 = min(x0 + 1, width - 1);
+    int y1 = min(y0 + 1, height - 1);
+    float fx = x - x0;
+    float fy = y - y0;
+    float top = mix((float)buffer[offset + x0 + y0*width], (float)buffer[offset + x1 + y0*width], fx);
+    float bottom = mix((float)buffer[offset + x0 + y1*width], (float)buffer[offset + x1 + y1*width], fx);
+    return mix(top, bottom, fy);
+}
+
+// Resamples slices firstSlice to firstSlice + depth - 1 on polar grids of angles x radii centered on (centerX,
+// centerY), with bilinear interpolation. Radii are mirrored after samples - 1, so that the radial profiles are periodic
+// and their transforms free of wrap-around edges. Positions outside of the slice take the value of the closest edge
+kernel void FFTToPolar(global const VOXEL* inputBuffer,
+                       global float2* polar,
+                       int width,
+                       int height,
+                       int depth,
+                       int firstSlice,
+                       int angles,
+                       int radii,
+                       int samples,
+                       float centerX,
+                       float centerY)
+{
+    size_t id = get_global_id(0);
+    if(id >= (size_t)angles*radii*depth)
+        return;
+
+    int a = id % angles;
+    int r = reflectIndex((id / angles) % radii, samples);
+    size_t z = firstSlice + id / ((size_t)angles*radii);
+    float c;
+    float s = sincos(PI2*a / angles, &c);
+    float value = sampleSlice(inputBuffer, width, height, z*width*height, centerX + r*c, centerY + r*s);
+    polar[id] = (float2)(value, 0.0f);
+}
+
+// Subtracts from slices firstSlice to firstSlice + depth - 1 the rings estimated on the polar grids of FFTToPolar,
+// interpolated back at each voxel
+kernel void FFTRemoveRings(global const VOXEL* inputBuffer,
+                           global const float2* rings,
+                           global VOXEL* outputBuffer,
+                           int width,
+                           int height,
+                           int depth,
+                           int firstSlice,
+                           int angles,
+                           int radii,
+                           int samples,
+                           float centerX,
+                           float centerY)
+{
+    size_t id = get_global_id(0);
+    if(id >= (size_t)width*height*depth)
+        return;
+
+    int x = id % width;
+    int y = (id / width) % height;
+    size_t z = id / ((size_t)width*height);
+
+    float dx = x - centerX;
+    float dy = y - centerY;
+    float r = min(sqrt(dx*dx + dy*dy), samples - 1.0f);
+    float a = atan2(dy, dx) / PI2 * angles;
+    if(a < 0.0f)
+        a += angles;
+
+    int a0 = (int)a % angles;
+    int a1 = (a0 + 1) % angles;
+    int r0 = min((int)r, max(samples - 2, 0));
+    int r1 = min(r0 + 1, samples - 1);
+    float fa = a - (int)a;
+    float fr = r - r0;
+    size_t offset = z*angles*radii;
+    float inner = mix(rings[offset + a0 + r0*angles].x, rings[offset + a1 + r0*angles].x, fa);
+    float outer = mix(rings[offset + a0 + r1*angles].x, rings[offset + a1 + r1*angles].x, fa);
+
+    size_t voxel = id + (size_t)firstSlice*width*height;
+    outputBuffer[voxel] = CONVERT_VOXEL_RTE(inputBuffer[voxel] - mix(inner, outer, fr));
+}
@@ -1,3 +1,7 @@
+// TILE_RADIUS, the largest offset of the structuring elements, is set at build time for the tiled kernels
+#include "Tiling.cl"
+#include "ZBlocking.cl"
+
 bool isOutsideBounds(int3 sizes, int3 pos)
 {
      if(pos.x < 0 || pos.y < 0 || pos.z < 0 ||
@@ -12,7 +16,22 @@ bool isOutsideBounds(int3 sizes, int3 pos)
     return false;
 }
 
-int getValue(global const uchar* buffer, int3 sizes, int3 pos)
+VALUE getValue(global const VOXEL* buffer, int3 sizes, int3 pos)
+{
+     if(pos.x < 0 || pos.y < 0 || pos.z < 0 ||
+        pos.x >= sizes.x || pos.y >= sizes.y || pos.z >= sizes.z)
+        return VALUE_NONE;
+    
+    size_t index = pos.x + pos.y*sizes.x + pos.z*sizes.x*sizes.y;
+    
+    if(index >= sizes.x*sizes.y*sizes.z)
+        return VALUE_NONE;
+    
+    return buffer[index];
+}
+
+// structuring elements stay uchar whatever the type of the volume
+int getMaskValue(global const VOXEL* buffer, int3 sizes, int3 pos)
 {
      if(pos.x < 0 || pos.y < 0 || pos.z < 0 ||
         pos.x >= sizes.x || pos.y >= sizes.y || pos.z >= sizes.z)
@@ -26,24 +45,24 @@ int getValue(global const uchar* buffer, int3 sizes, int3 pos)
     return buffer[index];
 }
 
-void setValue(global uchar* buffer, int3 sizes, int3 pos, int value)
+void setValue(global VOXEL* buffer, int3 sizes, int3 pos, VALUE value)
 {
     size_t index = pos.x + pos.y*sizes.x + pos.z*sizes.x*sizes.y;
     buffer[index] = value;
 }
 
 
-kernel void MMdil3DInit(global const uchar* inputBuffer, global uchar* outputBuffer, int3 pos, int3 sizes, global const uchar* structElem, int3 structElemSizes)
+kernel void MMdil3DInit(global const VOXEL* inputBuffer, global VOXEL* outputBuffer, int3 pos, int3 sizes, global const uchar* structElem, int3 structElemSizes)
 {
 
     if(isOutsideBounds(sizes, pos)) return;
 
-    int v0 =  getValue(inputBuffer, sizes, pos);
+    VALUE v0 = getValue(inputBuffer, sizes, pos);
     int scw = (int)structElemSizes.x / 2;
     int sch = (int)structElemSizes.y / 2;
     int scd = (int)structElemSizes.z / 2;
     
-    int maxx = 0;
+    VALUE maxx = VOXEL_LOWEST;
     
 
     for (int n = 0; n < structElemSizes.z; ++n)
@@ -54,8 +73,8 @@ kernel void MMdil3DInit(global const uchar* inputBuffer, global uchar* outputBuf
             {
                 int3 pos2 = { pos.x + k - scw, pos.y + m - sch, pos.z + n - scd };
                 int3 pos3 = { k , m , n };
-                int v =  getValue(inputBuffer, sizes, pos2);
-                int w = getValue(structElem, structElemSizes, pos3) ;
+                VALUE v = getValue(inputBuffer, sizes, pos2);
+                int w = getMaskValue(structElem, structElemSizes, pos3) ;
                 if ((w>0)&&(maxx<v))             // dilation gets the max{f(x+s,y+t)} for s=t=structElem
                         maxx = v;
 
@@ -66,8 +85,8 @@ kernel void MMdil3DInit(global const uchar* inputBuffer, global uchar* outputBuf
     setValue(outputBuffer, sizes, pos, maxx);
 }
 
-kernel void MMdil3DFilterInit(global const uchar* inputBuffer, 
-                         global uchar* outputBuffer, 
+kernel void MMdil3DFilterInit(global const VOXEL* inputBuffer, 
+                         global VOXEL* outputBuffer, 
                          int imageWidth, 
                          int imageHeight, 
                          int imageDepth, 
@@ -81,7 +100,8 @@ kernel void MMdil3DFilterInit(global const uchar* inputBuffer,
     
     int3 sizes = { imageWidth, imageHeight, imageDepth};
     int3 structElemSizes = {structElemWidth,structElemHeight,structElemDepth};
-    for(int i = 0; i < imageDepth; ++i)
+    int2 slices = sliceRange(imageDepth);
+    for(int i = slices.x; i < slices.y; ++i)
     {
         int3 pos = { get_global_id(0), get_global_id(1), i };
         MMdil3DInit(inputBuffer, outputBuffer, pos, sizes, structElem, structElemSizes);
@@ -89,17 +109,17 @@ kernel void MMdil3DFilterInit(global const uchar* inputBuffer,
 }
 
 
-kernel void MMdil3D(global const uchar* inputBuffer, global const uchar* tmpBuffer, global uchar* outputBuffer, int3 pos, int3 sizes, global const uchar* structElem, int3 structElemSizes)
+kernel void MMdil3D(global const VOXEL* inputBuffer, global const VOXEL* tmpBuffer, global VOXEL* outputBuffer, int3 pos, int3 sizes, global const uchar* structElem, int3 structElemSizes)
 {
 
     if(isOutsideBounds(sizes, pos)) return;
 
-    int v0 =  getValue(inputBuffer, sizes, pos);
+    VALUE v0 = getValue(inputBuffer, sizes, pos);
     int scw = (int)structElemSizes.x / 2;
     int sch = (int)structElemSizes.y / 2;
     int scd = (int)structElemSizes.z / 2;
     
-    int maxx = 0;
+    VALUE maxx = VOXEL_LOWEST;
     
 
     for (int n = 0; n < structElemSizes.z; ++n)
@@ -110,8 +130,8 @@ kernel void MMdil3D(global const uchar* inputBuffer, global const uchar* tmpBuff
             {
                 int3 pos2 = { pos.x + k - scw, pos.y + m - sch, pos.z + n - scd };
                 int3 pos3 = { k , m , n };
-                int v =  getValue(inputBuffer, sizes, pos2);
-                int w = getValue(structElem, structElemSizes, pos3) ;
+                VALUE v = getValue(inputBuffer, sizes, pos2);
+                int w = getMaskValue(structElem, structElemSizes, pos3) ;
                 if ((w>0)&&(maxx<v))             // dilation gets the max{f(x+s,y+t)} for s=t=structElem
                         maxx = v;
 
@@ -119,16 +139,16 @@ kernel void MMdil3D(global const uchar* inputBuffer, global const uchar* tmpBuff
         }
     }
 
-    int tmpv = getValue(tmpBuffer, sizes, pos);
+    VALUE tmpv = getValue(tmpBuffer, sizes, pos);
     if(maxx < tmpv)
         maxx = tmpv;
 
     setValue(outputBuffer, sizes, pos, maxx);
 }
 
-kernel void MMdil3DFilter(global const uchar* inputBuffer, 
-                         global uchar* tmpBuffer, 
-                         global uchar* outputBuffer, 
+kernel void MMdil3DFilter(global const VOXEL* inputBuffer, 
+                         global VOXEL* tmpBuffer, 
+                         global VOXEL* outputBuffer, 
                          int imageWidth, 
                          int imageHeight, 
                          int imageDepth, 
@@ -142,10 +162,90 @@ kernel void MMdil3DFilter(global const uchar* inputBuffer,
     /// let depth go beyond buffer..
     int3 sizes = { imageWidth, imageHeight, imageDepth };
     int3 structElemSizes = {structElemWidth,structElemHeight,structElemDepth};
-    for(int i = 0; i < imageDepth; ++i)
+    int2 slices = sliceRange(imageDepth);
+    for(int i = slices.x; i < slices.y; ++i)
     {
         int3 pos = { get_global_id(0), get_global_id(1), i };
         MMdil3D(inputBuffer, tmpBuffer, outputBuffer, pos, sizes, structElem, structElemSizes);
     }
 }
 
+
+// All structuring elements in one launch. offsets holds the (x, y, z) offsets of the nonzero voxels of every
+// element, elements holds the (start, count) of each element in offsets
+kernel void MMdil3DFused(global const VOXEL* inputBuffer,
+                         global VOXEL* outputBuffer,
+                         int imageWidth,
+                         int imageHeight,
+                         int imageDepth,
+                         constant int4* offsets,
+                         constant int2* elements,
+                         int elementCount)
+{
+    int3 sizes = { imageWidth, imageHeight, imageDepth };
+    if(get_global_id(0) >= imageWidth || get_global_id(1) >= imageHeight) return;
+
+    int2 slices = sliceRange(imageDepth);
+    for(int i = slices.x; i < slices.y; ++i)
+    {
+        int3 pos = { get_global_id(0), get_global_id(1), i };
+        VALUE maxx = VOXEL_LOWEST;
+
+        for(int e = 0; e < elementCount; ++e)
+        {
+            int2 element = elements[e];
+            VALUE elementMax = VOXEL_LOWEST;
+            for(int j = element.x; j < element.x + element.y; ++j)
+            {
+                int3 pos2 = pos + offsets[j].xyz;
+                VALUE v = getValue(inputBuffer, sizes, pos2);
+                if(elementMax < v)
+                    elementMax = v;
+            }
+            if(maxx < elementMax)
+                maxx = elementMax;
+        }
+
+        setValue(outputBuffer, sizes, pos, maxx);
+    }
+}
+
+// Tiled variant of MMdil3DFused, the neighbourhood is read from the local tile (see Tiling.cl)
+kernel void MMdil3DFusedTiled(global const VOXEL* inputBuffer,
+                              global VOXEL* outputBuffer,
+                              int imageWidth,
+                              int imageHeight,
+                              int imageDepth,
+                              constant int4* offsets,
+                              constant int2* elements,
+                              int elementCount,
+                              local TILE_VALUE* tile)
+{
+    int3 sizes = { imageWidth, imageHeight, imageDepth };
+    bool inside = get_global_id(0) < imageWidth && get_global_id(1) < imageHeight;
+
+    int2 slices = sliceRange(imageDepth);
+    startTile(inputBuffer, tile, sizes, slices.x);
+    for(int i = slices.x; i < slices.y; ++i)
+    {
+        advanceTile(inputBuffer, tile, sizes, i);
+        if(!inside)
+            continue;
+
+        int3 pos = { get_global_id(0), get_global_id(1), i };
+        VALUE maxx = VOXEL_LOWEST;
+        for(int e = 0; e < elementCount; ++e)
+        {
+            int2 element = elements[e];
+            for(int j = element.x; j < element.x + element.y; ++j)
+            {
+                int4 offset = offsets[j];
+                VALUE v = tileValue(tile, offset.x, offset.y, i + offset.z);
+                if(maxx < v)
+                    maxx = v;
+            }
+        }
+
+        setValue(outputBuffer, sizes, pos, maxx);
+    }
+}
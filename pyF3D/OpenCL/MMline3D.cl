@@ -0,0 +1,130 @@
+// van Herk/Gil-Werman running max/min along straight lines of the volume.
+//
+// outputBuffer(p) = reduce { inputBuffer(p + origin + k*direction), k = 0..length-1 }
+//
+// One work-item filters one line of the volume parallel to direction, whose components are -1, 0 or 1. Values
+// outside of the volume are ignored. The cost per voxel does not depend on length: the line is split in blocks of
+// length voxels, suffix reductions of each block are stored in tmpBuffer by a backward sweep, then a forward sweep
+// combines them with the running prefix reductions.
+
+#include "Voxel.cl"
+
+VALUE reduceValues(VALUE a, VALUE b, int isMax)
+{
+    if(isMax)
+        return a > b ? a : b;
+    return a < b ? a : b;
+}
+
+VALUE lineValue(global const VOXEL* buffer, int3 sizes, int3 pos, VALUE identity)
+{
+    if(pos.x < 0 || pos.y < 0 || pos.z < 0 ||
+       pos.x >= sizes.x || pos.y >= sizes.y || pos.z >= sizes.z)
+        return identity;
+
+    return buffer[pos.x + pos.y*sizes.x + pos.z*sizes.x*sizes.y];
+}
+
+size_t lineIndex(int3 sizes, int3 pos)
+{
+    return pos.x + pos.y*sizes.x + pos.z*sizes.x*sizes.y;
+}
+
+void MMline3D(global const VOXEL* inputBuffer, global VOXEL* outputBuffer, global VOXEL* tmpBuffer,
+              int imageWidth, int imageHeight, int imageDepth, int4 direction, int4 origin, int length,
+              int accumulate, int isMax)
+{
+    int size[3] = { imageWidth, imageHeight, imageDepth };
+    int dir[3] = { direction.x, direction.y, direction.z };
+
+    // first axis along which the lines move, lines are identified by their coordinate along axes they do not move
+    // along, and by their shift relative to the first axis along the other ones
+    int first = dir[0] != 0 ? 0 : (dir[1] != 0 ? 1 : 2);
+    int id = get_global_id(0);
+    int shift[3] = { 0, 0, 0 };
+    int fixed[3] = { 0, 0, 0 };
+    for(int i = 0; i < 3; ++i)
+    {
+        if(i == first)
+            continue;
+        int count = dir[i] == 0 ? size[i] : size[first] + size[i] - 1;
+        int value = id % count;
+        id /= count;
+        if(dir[i] == 0)
+            fixed[i] = value;
+        else
+            shift[i] = value - (size[first] - 1);
+    }
+    if(id > 0)
+        return;
+
+    // range [t0, t1) of positions along the line that are inside the volume
+    int t0 = 0;
+    int t1 = size[first];
+    for(int i = 0; i < 3; ++i)
+    {
+        if(i == first || dir[i] == 0)
+            continue;
+        t0 = max(t0, -shift[i]);
+        t1 = min(t1, size[i] - shift[i]);
+    }
+    if(t0 >= t1)
+        return;
+
+    int start[3];
+    for(int i = 0; i < 3; ++i)
+    {
+        int q = i == first ? t0 : (dir[i] == 0 ? fixed[i] : t0 + shift[i]);
+        start[i] = dir[i] < 0 ? size[i] - 1 - q : q;
+    }
+
+    int3 sizes = { imageWidth, imageHeight, imageDepth };
+    int3 d = direction.xyz;
+    int3 p0 = { start[0], start[1], start[2] };
+    int3 q0 = p0 + origin.xyz;
+    int lineLength = t1 - t0;
+    int sweepLength = lineLength + length - 1;
+    VALUE identity = isMax ? VOXEL_LOWEST : VOXEL_HIGHEST;
+
+    // backward sweep: suffix reductions of each block, kept for the window starting at each voxel of the line
+    VALUE h = identity;
+    for(int m = sweepLength - 1; m >= 0; --m)
+    {
+        VALUE v = lineValue(inputBuffer, sizes, q0 + m*d, identity);
+        h = (m + 1) % length == 0 ? v : reduceValues(h, v, isMax);
+        if(m < lineLength)
+            tmpBuffer[lineIndex(sizes, p0 + m*d)] = h;
+    }
+
+    // forward sweep: prefix reductions of each block, combined with the suffix at the start of each window
+    VALUE g = identity;
+    for(int m = 0; m < sweepLength; ++m)
+    {
+        VALUE v = lineValue(inputBuffer, sizes, q0 + m*d, identity);
+        g = m % length == 0 ? v : reduceValues(g, v, isMax);
+        if(m >= length - 1)
+        {
+            size_t index = lineIndex(sizes, p0 + (m - length + 1)*d);
+            VALUE result = reduceValues(tmpBuffer[index], g, isMax);
+            if(accumulate)
+                result = reduceValues(outputBuffer[index], result, isMax);
+            outputBuffer[index] = result;
+        }
+    }
+}
+
+kernel void MMlineDil3D(global const VOXEL* inputBuffer, global VOXEL* outputBuffer, global VOXEL* tmpBuffer,
+                        int imageWidth, int imageHeight, int imageDepth, int4 direction, int4 origin, int length,
+                        int accumulate)
+{
+    MMline3D(inputBuffer, outputBuffer, tmpBuffer, imageWidth, imageHeight, imageDepth, direction, origin, length,
+             accumulate, 1);
+}
+
+kernel void MMlineEro3D(global const VOXEL* inputBuffer, global VOXEL* outputBuffer, global VOXEL* tmpBuffer,
+                        int imageWidth, int imageHeight, int imageDepth, int4 direction, int4 origin, int length,
+                        int accumulate)
+{
+    MMline3D(inputBuffer, outputBuffer, tmpBuffer, imageWidth, imageHeight, imageDepth, direction, origin, length,
+             accumulate, 0);
+}
@@ -6,11 +6,13 @@
  * Dani Ushizima
  */
 
+#include "Voxel.cl"
+
 //Core--------
 
-kernel void mask3D(global const uchar* inputBufferIntensities, 
+kernel void mask3D(global const VOXEL* inputBufferIntensities, 
 				   global const uchar* inputBufferBinary, 
-				   global uchar* outputBuffer,
+				   global VOXEL* outputBuffer,
                    int imageWidth, int imageHeight, int imageDepth)
 {
 
@@ -20,7 +22,7 @@ kernel void mask3D(global const uchar* inputBufferIntensities,
     if(pos > imageSize)
     	return;
     
-    outputBuffer[pos] = (uchar) (inputBufferIntensities[pos] * ((float)inputBufferBinary[pos]/255.0)); 
+    outputBuffer[pos] = CONVERT_VOXEL(inputBufferIntensities[pos] * ((float)inputBufferBinary[pos]/255.0));
     //outputBuffer[pos] = inputBufferIntensities[pos];  
     //outputBuffer[pos] = inputBufferBinary[pos]; 
 }
@@ -1,3 +1,28 @@
+// RADIUS is set at build time (-D RADIUS=r), the window is (2*RADIUS + 1)^3 voxels. Every kernel returns the
+// max(1, n/2)-th smallest of the n voxels of the window that are inside of the volume (and are not NaN for float
+// volumes), that is the WINDOW_SIZE/2-th smallest value away from the borders. Axes of length 1 of the volume then
+// do not count in the window size.
+//
+// Three methods select the value:
+// - forgetful selection, for windows of up to 27 voxels, keeps a private buffer of about half of the window
+// - radix selection, for larger windows of ushort and float volumes, counts the digits of the values in a histogram
+//   of 256 bins per work-item in local memory, one pass per byte of the values
+// - a sliding histogram (Huang/Perreault) of one bin per value, only built for uchar volumes (VOXEL_TYPE 0, see
+//   Voxel.cl), is swept along z by each work-item and also kept in local memory
+// Local histograms are interleaved, bin b of work-item i being at histograms[b*itemCount + i], so that the
+// work-items of a group do not access the same banks for the same bins.
+
+#ifndef RADIUS
+#define RADIUS 1
+#endif
+
+#define TILE_RADIUS RADIUS
+#include "Tiling.cl"
+#include "ZBlocking.cl"
+
+#define WINDOW_WIDTH (2*RADIUS + 1)
+#define WINDOW_SIZE (WINDOW_WIDTH*WINDOW_WIDTH*WINDOW_WIDTH)
+
 bool isOutsideBounds(const int3 pos, const int3 sizes)
 {
      if(pos.x < 0 || pos.y < 0 || pos.z < 0 ||
@@ -6,88 +31,415 @@ bool isOutsideBounds(const int3 pos, const int3 sizes)
     return false;
 }
 
-int getValue(global const uchar* buffer, const int3 pos, const int3 sizes)
+VALUE getValue(global const VOXEL* buffer, const int3 pos, const int3 sizes)
 {
      if(pos.x < 0 || pos.y < 0 || pos.z < 0 ||
         pos.x >= sizes.x || pos.y >= sizes.y || pos.z >= sizes.z)
-        return -1;
+        return VALUE_NONE;
 
     size_t index = pos.x + pos.y*sizes.x + pos.z*sizes.x*sizes.y;
 
     return buffer[index];
 }
 
-void setValue(global uchar* buffer, const int3 pos, const int3 sizes, int value)
+void setValue(global VOXEL* buffer, const int3 pos, const int3 sizes, VALUE value)
 {
     size_t index = pos.x + pos.y*sizes.x + pos.z*sizes.x*sizes.y;
     buffer[index] = value;
 }
 
-void DaniMedianFilter3D(global const uchar* inputBuffer, 
-                        global uchar* outputBuffer, 
-                        const int3 pos, 
-                        const int3 sizes, 
-                        int medianIndex)
+// n-th voxel of the window of pos, read from the local tile of tiled kernels (see Tiling.cl) or from global memory
+// when tile is 0. Kernels pass a constant tile, so the test is resolved when functions are inlined
+VALUE windowValue(global const VOXEL* inputBuffer, local const TILE_VALUE* tile, const int3 pos, const int3 sizes,
+                  int n)
+{
+    int dx = n % WINDOW_WIDTH - RADIUS;
+    int dy = (n / WINDOW_WIDTH) % WINDOW_WIDTH - RADIUS;
+    int dz = n / (WINDOW_WIDTH*WINDOW_WIDTH) - RADIUS;
+    if(tile)
+        return tileValue(tile, dx, dy, pos.z + dz);
+    int3 pos2 = { pos.x + dx, pos.y + dy, pos.z + dz };
+    return getValue(inputBuffer, pos2, sizes);
+}
+
+// Forgetful selection: the median of FORGET_COUNT values is found with a buffer of FORGET_SIZE values. Once the
+// buffer is full, its smallest and largest values are forgotten before each new value is added, as neither can be the
+// median, until 3 values are left. The window is preceded by 2 VOXEL_LOWEST values and its voxels without value are
+// replaced by VOXEL_HIGHEST and VOXEL_LOWEST in turn, which makes the max(1, n/2)-th of its n valid values the median
+// (except for n < 2). All loop bounds are known at build time, so the compiler can unroll them and keep the buffer in
+// registers
+#define FORGET_COUNT (WINDOW_SIZE + 2)
+#define FORGET_SIZE (FORGET_COUNT/2 + 2)
+
+typedef struct
+{
+    VALUE values[FORGET_SIZE];
+    int first;
+    int count;
+    int valid;
+    VALUE last;
+} Forgetful;
+
+void exchange(VALUE* a, VALUE* b)
+{
+    VALUE lower = min(*a, *b);
+    *b = max(*a, *b);
+    *a = lower;
+}
+
+// moves the smallest value of the buffer to values[first] and the largest to values[FORGET_SIZE - 1]
+void sortExtremes(Forgetful* f)
+{
+    exchange(&f->values[f->first], &f->values[FORGET_SIZE - 1]);
+    for(int i = f->first + 1; i < FORGET_SIZE - 1; ++i)
+    {
+        exchange(&f->values[f->first], &f->values[i]);
+        exchange(&f->values[i], &f->values[FORGET_SIZE - 1]);
+    }
+}
+
+void pushForgetful(Forgetful* f, VALUE value)
+{
+    if(f->count < FORGET_SIZE)
+    {
+        f->values[f->count++] = value;
+        return;
+    }
+    // the largest value is replaced by the new one
+    sortExtremes(f);
+    f->first++;
+    f->values[FORGET_SIZE - 1] = value;
+}
+
+void startForgetful(Forgetful* f)
+{
+    f->first = 0;
+    f->count = 0;
+    f->valid = 0;
+    f->last = VALUE_NONE;
+    pushForgetful(f, VOXEL_LOWEST);
+    pushForgetful(f, VOXEL_LOWEST);
+}
+
+void addForgetful(Forgetful* f, VALUE value, int n)
+{
+    if(HAS_VALUE(value))
+    {
+        f->valid++;
+        f->last = value;
+    }
+    else
+        value = (n - f->valid) % 2 ? VOXEL_LOWEST : VOXEL_HIGHEST;
+    pushForgetful(f, value);
+}
+
+VALUE forgetfulMedian(Forgetful* f)
 {
-    int sc = 1; ///shift by 1..
+    if(f->valid < 2)
+        return f->valid ? f->last : VALUE_NONE;
+    sortExtremes(f);
+    return f->values[f->first + 1];
+}
+
+VALUE selectMedian(global const VOXEL* inputBuffer, local const TILE_VALUE* tile, const int3 pos, const int3 sizes)
+{
+    Forgetful f;
+    startForgetful(&f);
+    for(int n = 0; n < WINDOW_SIZE; ++n)
+        addForgetful(&f, windowValue(inputBuffer, tile, pos, sizes, n), n);
+    return forgetfulMedian(&f);
+}
+
+kernel void MedianFilterSelect(global const VOXEL* inputBuffer,
+                               global VOXEL* outputBuffer,
+                               int imageWidth,
+                               int imageHeight,
+                               int imageDepth)
+{
+    int3 sizes = { imageWidth, imageHeight, imageDepth };
+    int3 pos = { get_global_id(0), get_global_id(1), 0 };
 
-	uchar median = 0;
-    uchar histogram[256];
-    
-    for(int i = 0; i < 256; ++i)
-    	histogram[i] = 0; //histogram of counts at each intensity
-    
-    for (int n = 0; n < 3; ++n)
+    if(isOutsideBounds(pos, sizes)) return;
+
+    int2 slices = sliceRange(imageDepth);
+    for(int i = slices.x; i < slices.y; ++i)
     {
-        for (int m = 0; m < 3; ++m)
+        pos.z = i;
+        setValue(outputBuffer, pos, sizes, selectMedian(inputBuffer, 0, pos, sizes));
+    }
+}
+
+// Tiled variants: the window is read from the local tile (see Tiling.cl) instead of global memory
+kernel void MedianFilterSelectTiled(global const VOXEL* inputBuffer,
+                                    global VOXEL* outputBuffer,
+                                    int imageWidth,
+                                    int imageHeight,
+                                    int imageDepth,
+                                    local TILE_VALUE* tile)
+{
+    int3 sizes = { imageWidth, imageHeight, imageDepth };
+    int3 pos = { get_global_id(0), get_global_id(1), 0 };
+    bool inside = !isOutsideBounds(pos, sizes);
+
+    int2 slices = sliceRange(imageDepth);
+    startTile(inputBuffer, tile, sizes, slices.x);
+    for(int i = slices.x; i < slices.y; ++i)
+    {
+        advanceTile(inputBuffer, tile, sizes, i);
+        if(!inside)
+            continue;
+
+        pos.z = i;
+        setValue(outputBuffer, pos, sizes, selectMedian(inputBuffer, tile, pos, sizes));
+    }
+}
+
+// Radix selection: values are mapped to keys of KEY_BITS bits ordered as the values, and the key of the median is
+// found one byte at a time, from the highest, by counting the bytes of the keys that start as the median does
+#if VOXEL_TYPE == 2
+#define KEY_BITS 32
+#elif VOXEL_TYPE == 1
+#define KEY_BITS 16
+#else
+#define KEY_BITS 8
+#endif
+
+int itemIndex()
+{
+    return get_local_id(1)*get_local_size(0) + get_local_id(0);
+}
+
+int itemCount()
+{
+    return get_local_size(0)*get_local_size(1);
+}
+
+uint radixKey(VALUE value)
+{
+#if VOXEL_IS_FLOAT
+    // the sign bit is flipped for positive values, all bits for negative ones
+    uint bits = as_uint(value);
+    return bits ^ ((bits >> 31) ? 0xFFFFFFFF : 0x80000000);
+#else
+    return (uint)value;
+#endif
+}
+
+VALUE radixValue(uint key)
+{
+#if VOXEL_IS_FLOAT
+    return as_float(key ^ ((key >> 31) ? 0x80000000 : 0xFFFFFFFF));
+#else
+    return (VALUE)key;
+#endif
+}
+
+VALUE radixMedian(global const VOXEL* inputBuffer, local const TILE_VALUE* tile, const int3 pos, const int3 sizes,
+                  local ushort* histogram)
+{
+    int stride = itemCount();
+    uint prefix = 0;
+    int rank = 0;
+    for(int shift = KEY_BITS - 8; shift >= 0; shift -= 8)
+    {
+        for(int b = 0; b < 256; ++b)
+            histogram[b*stride] = 0;
+
+        // bits of the keys above the byte counted
+        uint mask = shift + 8 < 32 ? ~0u << (shift + 8) : 0;
+        int count = 0;
+        for(int n = 0; n < WINDOW_SIZE; ++n)
         {
-            for (int k = 0; k < 3; ++k)
+            VALUE val = windowValue(inputBuffer, tile, pos, sizes, n);
+            uint key = radixKey(val);
+            if(HAS_VALUE(val) && (key & mask) == prefix)
             {
-                int3 pos2 = { pos.x + n - sc, 
-                              pos.y + m - sc, 
-                              pos.z + k - sc };
-                int val = getValue(inputBuffer, pos2, sizes);
-                if(val >= 0) histogram[val] += 1;
+                histogram[((key >> shift) & 255)*stride]++;
+                count++;
             }
         }
+
+        // all keys are counted by the first pass
+        if(rank == 0)
+        {
+            if(count == 0)
+                return VALUE_NONE;
+            rank = max(1, count/2);
+        }
+
+        uint digit = 0;
+        while(histogram[digit*stride] < rank)
+            rank -= histogram[digit++*stride];
+        prefix |= digit << shift;
     }
+    return radixValue(prefix);
+}
 
-	int x = 0;
-			
-	median = getValue(inputBuffer, pos, sizes);
+kernel void MedianFilterRadix(global const VOXEL* inputBuffer,
+                              global VOXEL* outputBuffer,
+                              int imageWidth,
+                              int imageHeight,
+                              int imageDepth,
+                              local ushort* histograms)
+{
+    int3 sizes = { imageWidth, imageHeight, imageDepth };
+    int3 pos = { get_global_id(0), get_global_id(1), 0 };
 
-    for(int i = 0; i < 256; ++i)
+    if(isOutsideBounds(pos, sizes)) return;
+
+    local ushort* histogram = histograms + itemIndex();
+    int2 slices = sliceRange(imageDepth);
+    for(int i = slices.x; i < slices.y; ++i)
     {
-    	if(histogram[i] >= 0) 
-    	{ 
-    		x += histogram[i];
-    		/// if x gets past median then we set the value..
-	        median = (uchar)i;
-	    	if(x >= medianIndex)
-	    		break;
-	   	}
+        pos.z = i;
+        setValue(outputBuffer, pos, sizes, radixMedian(inputBuffer, 0, pos, sizes, histogram));
     }
+}
+
+kernel void MedianFilterRadixTiled(global const VOXEL* inputBuffer,
+                                   global VOXEL* outputBuffer,
+                                   int imageWidth,
+                                   int imageHeight,
+                                   int imageDepth,
+                                   local ushort* histograms,
+                                   local TILE_VALUE* tile)
+{
+    int3 sizes = { imageWidth, imageHeight, imageDepth };
+    int3 pos = { get_global_id(0), get_global_id(1), 0 };
+    bool inside = !isOutsideBounds(pos, sizes);
+
+    local ushort* histogram = histograms + itemIndex();
+    int2 slices = sliceRange(imageDepth);
+    startTile(inputBuffer, tile, sizes, slices.x);
+    for(int i = slices.x; i < slices.y; ++i)
+    {
+        advanceTile(inputBuffer, tile, sizes, i);
+        if(!inside)
+            continue;
 
-	//median = getValue(inputBuffer, pos, sizes);
-	setValue(outputBuffer, pos, sizes, (int)median);
+        pos.z = i;
+        setValue(outputBuffer, pos, sizes, radixMedian(inputBuffer, tile, pos, sizes, histogram));
+    }
 }
 
-kernel void MedianFilter(global const uchar* inputBuffer,
-                         global uchar* outputBuffer, 
-                         int imageWidth,
-                         int imageHeight, 
-                         int imageDepth, 
-                         int medianIndex)
+#if VOXEL_TYPE == 0
+// Sliding histogram: each work-item sweeps its column along z, adding the plane entering the window and removing the
+// plane leaving it. Bins 256 to 271 are a coarse histogram of 16 bins which locates the median in at most 32 steps.
+// Planes outside of the volume are read as VALUE_NONE from the tile and skipped from global memory
+#define HISTOGRAM_BINS 272
+
+void addPlane(global const VOXEL* inputBuffer, local const TILE_VALUE* tile, const int3 pos, const int3 sizes, int z,
+              int delta, local ushort* histogram)
 {
+    if(!tile && (z < 0 || z >= sizes.z))
+        return;
 
+    int stride = itemCount();
+    for(int m = -RADIUS; m <= RADIUS; ++m)
+    {
+        for(int k = -RADIUS; k <= RADIUS; ++k)
+        {
+            int3 pos2 = { pos.x + k, pos.y + m, z };
+            int val = tile ? tileValue(tile, k, m, z) : getValue(inputBuffer, pos2, sizes);
+            if(val >= 0)
+            {
+                histogram[val*stride] += delta;
+                histogram[(256 + (val >> 4))*stride] += delta;
+            }
+        }
+    }
+}
+
+void clearHistogram(local ushort* histogram)
+{
+    int stride = itemCount();
+    for(int b = 0; b < HISTOGRAM_BINS; ++b)
+        histogram[b*stride] = 0;
+}
+
+int histogramMedian(local const ushort* histogram)
+{
+    int stride = itemCount();
+    int count = 0;
+    for(int bin = 0; bin < 16; ++bin)
+        count += histogram[(256 + bin)*stride];
+    if(count == 0)
+        return VOXEL_HIGHEST;
+
+    int remaining = max(1, count/2);
+    int bin = 0;
+    while(histogram[(256 + bin)*stride] < remaining)
+        remaining -= histogram[(256 + bin++)*stride];
+
+    int median = bin << 4;
+    while(histogram[median*stride] < remaining)
+        remaining -= histogram[median++*stride];
+    return median;
+}
+
+kernel void MedianFilterHistogram(global const VOXEL* inputBuffer,
+                                  global VOXEL* outputBuffer,
+                                  int imageWidth,
+                                  int imageHeight,
+                                  int imageDepth,
+                                  local ushort* histograms)
+{
     int3 sizes = { imageWidth, imageHeight, imageDepth };
     int3 pos = { get_global_id(0), get_global_id(1), 0 };
 
     if(isOutsideBounds(pos, sizes)) return;
-    
-    for(int i = 0; i < imageDepth; ++i)
+
+    local ushort* histogram = histograms + itemIndex();
+    clearHistogram(histogram);
+
+    int2 slices = sliceRange(imageDepth);
+    for(int z = slices.x - RADIUS; z < slices.x + RADIUS; ++z)
+        addPlane(inputBuffer, 0, pos, sizes, z, 1, histogram);
+
+    for(int i = slices.x; i < slices.y; ++i)
     {
-        int3 pos = { get_global_id(0), get_global_id(1), i };
-        DaniMedianFilter3D(inputBuffer, outputBuffer, pos, sizes, medianIndex);
+        pos.z = i;
+        addPlane(inputBuffer, 0, pos, sizes, i + RADIUS, 1, histogram);
+
+        setValue(outputBuffer, pos, sizes, histogramMedian(histogram));
+
+        addPlane(inputBuffer, 0, pos, sizes, i - RADIUS, -1, histogram);
+    }
+}
+
+kernel void MedianFilterHistogramTiled(global const VOXEL* inputBuffer,
+                                       global VOXEL* outputBuffer,
+                                       int imageWidth,
+                                       int imageHeight,
+                                       int imageDepth,
+                                       local ushort* histograms,
+                                       local TILE_VALUE* tile)
+{
+    int3 sizes = { imageWidth, imageHeight, imageDepth };
+    int3 pos = { get_global_id(0), get_global_id(1), 0 };
+    bool inside = !isOutsideBounds(pos, sizes);
+
+    local ushort* histogram = histograms + itemIndex();
+    clearHistogram(histogram);
+
+    int2 slices = sliceRange(imageDepth);
+    startTile(inputBuffer, tile, sizes, slices.x);
+    for(int z = slices.x - RADIUS; z < slices.x + RADIUS; ++z)
+        addPlane(inputBuffer, tile, pos, sizes, z, 1, histogram);
+
+    for(int i = slices.x; i < slices.y; ++i)
+    {
+        // the plane leaving the window is removed before its slot of the ring is overwritten
+        if(i > slices.x)
+            addPlane(inputBuffer, tile, pos, sizes, i - 1 - RADIUS, -1, histogram);
+        advanceTile(inputBuffer, tile, sizes, i);
+        addPlane(inputBuffer, tile, pos, sizes, i + RADIUS, 1, histogram);
+
+        if(inside)
+        {
+            pos.z = i;
+            setValue(outputBuffer, pos, sizes, histogramMedian(histogram));
+        }
     }
 }
+#endif
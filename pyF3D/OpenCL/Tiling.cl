@@ -0,0 +1,75 @@
+// Local memory tiling shared by the neighbourhood kernels. A work-group of get_local_size(0) x get_local_size(1)
+// work-items sweeps its columns of the volume along z. The XY tile of each plane, padded by TILE_RADIUS voxels on
+// every side, is loaded once into local memory by the whole group, and the last 2*TILE_RADIUS + 1 planes are kept in
+// a ring, so each voxel is read from global memory once per work-group instead of once per neighbour.
+//
+// The tile is a local buffer of tileBytes (see TiledStencil.py) of TILE_VALUE (see Voxel.cl) passed by the host.
+// Voxels outside of the volume are stored as VALUE_NONE, as returned by getValue. All work-items of the group must
+// call startTile and advanceTile, work-items outside of the volume skip their computation but not the sweep.
+
+#include "Voxel.cl"
+
+#ifndef TILE_RADIUS
+#define TILE_RADIUS 1
+#endif
+
+#define TILE_PLANES (2*TILE_RADIUS + 1)
+
+int tileWidth()
+{
+    return get_local_size(0) + 2*TILE_RADIUS;
+}
+
+int tileHeight()
+{
+    return get_local_size(1) + 2*TILE_RADIUS;
+}
+
+int tileSlot(int z)
+{
+    return ((z % TILE_PLANES) + TILE_PLANES) % TILE_PLANES;
+}
+
+void loadTilePlane(global const VOXEL* buffer, local TILE_VALUE* tile, const int3 sizes, int z)
+{
+    int w = tileWidth();
+    int count = w*tileHeight();
+    int x0 = get_group_id(0)*get_local_size(0) - TILE_RADIUS;
+    int y0 = get_group_id(1)*get_local_size(1) - TILE_RADIUS;
+    local TILE_VALUE* plane = tile + tileSlot(z)*count;
+    bool inside = z >= 0 && z < sizes.z;
+
+    for(int i = get_local_id(1)*get_local_size(0) + get_local_id(0); i < count;
+        i += get_local_size(0)*get_local_size(1))
+    {
+        int x = x0 + i % w;
+        int y = y0 + i / w;
+        TILE_VALUE value = VALUE_NONE;
+        if(inside && x >= 0 && y >= 0 && x < sizes.x && y < sizes.y)
+            value = buffer[x + y*sizes.x + (size_t)z*sizes.x*sizes.y];
+        plane[i] = value;
+    }
+}
+
+// loads the planes below plane start, before a sweep from start
+void startTile(global const VOXEL* buffer, local TILE_VALUE* tile, const int3 sizes, int start)
+{
+    for(int z = start - TILE_RADIUS; z < start + TILE_RADIUS; ++z)
+        loadTilePlane(buffer, tile, sizes, z);
+    barrier(CLK_LOCAL_MEM_FENCE);
+}
+
+// loads the plane entering the window of plane z, in place of the one that left it
+void advanceTile(global const VOXEL* buffer, local TILE_VALUE* tile, const int3 sizes, int z)
+{
+    barrier(CLK_LOCAL_MEM_FENCE);
+    loadTilePlane(buffer, tile, sizes, z + TILE_RADIUS);
+    barrier(CLK_LOCAL_MEM_FENCE);
+}
+
+// value at (dx, dy) from the voxel of the work-item in plane z, which must be within TILE_RADIUS of the current plane
+VALUE tileValue(local const TILE_VALUE* tile, int dx, int dy, int z)
+{
+    int w = tileWidth();
+    return tile[tileSlot(z)*w*tileHeight() + (get_local_id(1) + TILE_RADIUS + dy)*w + get_local_id(0) + TILE_RADIUS + dx];
+}
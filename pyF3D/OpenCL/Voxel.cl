@@ -0,0 +1,49 @@
+// Type of the voxels of slabs, set at build time by VOXEL_TYPE (-D VOXEL_TYPE=t, see VoxelTypes.py): 0 for uchar
+// (default), 1 for ushort, 2 for float. Voxels are read as VALUE, a type holding every voxel value and VALUE_NONE, the
+// value of voxels outside of the volume (HAS_VALUE is false for it). Local tiles hold TILE_VALUE. CONVERT_VOXEL
+// truncates to VOXEL and CONVERT_VOXEL_RTE rounds to the nearest value, both saturate for integer types.
+//
+// For float volumes VALUE_NONE is NaN, so NaN voxels are treated as outside of the volume.
+
+#ifndef VOXEL_CL
+#define VOXEL_CL
+
+#ifndef VOXEL_TYPE
+#define VOXEL_TYPE 0
+#endif
+
+#if VOXEL_TYPE == 0
+#define VOXEL uchar
+#define VALUE int
+#define TILE_VALUE short
+#define VOXEL_LOWEST 0
+#define VOXEL_HIGHEST 255
+#define VALUE_NONE (-1)
+#define HAS_VALUE(v) ((v) >= 0)
+#define CONVERT_VOXEL(x) convert_uchar_sat(x)
+#define CONVERT_VOXEL_RTE(x) convert_uchar_sat_rte(x)
+#elif VOXEL_TYPE == 1
+#define VOXEL ushort
+#define VALUE int
+#define TILE_VALUE int
+#define VOXEL_LOWEST 0
+#define VOXEL_HIGHEST 65535
+#define VALUE_NONE (-1)
+#define HAS_VALUE(v) ((v) >= 0)
+#define CONVERT_VOXEL(x) convert_ushort_sat(x)
+#define CONVERT_VOXEL_RTE(x) convert_ushort_sat_rte(x)
+#else
+#define VOXEL float
+#define VALUE float
+#define TILE_VALUE float
+#define VOXEL_LOWEST (-INFINITY)
+#define VOXEL_HIGHEST INFINITY
+#define VALUE_NONE NAN
+#define HAS_VALUE(v) (!isnan(v))
+#define CONVERT_VOXEL(x) convert_float(x)
+#define CONVERT_VOXEL_RTE(x) convert_float(x)
+#endif
+
+#define VOXEL_IS_FLOAT (VOXEL_TYPE == 2)
+
+#endif
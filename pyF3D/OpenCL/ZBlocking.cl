@@ -0,0 +1,10 @@
+// Slices filtered by a work-item. Launched over two dimensions, each work-item filters the whole depth of its
+// column. Launched over three dimensions (see ClAttributes.computeWorkingGroupSize), the depth is split into
+// get_global_size(2) blocks of consecutive slices, so that thin slabs still give enough work-items to fill the device.
+// Returns the range [x, y) of slices of the work-item
+int2 sliceRange(int imageDepth)
+{
+    int blockSize = (imageDepth + get_global_size(2) - 1) / get_global_size(2);
+    int start = min((int)get_global_id(2)*blockSize, imageDepth);
+    return (int2)(start, min(start + blockSize, imageDepth));
+}
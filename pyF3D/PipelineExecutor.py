@@ -0,0 +1,173 @@
+import pyopencl as cl
+import pyF3D.TiledStencil as ts
+import pyF3D.HaloPlanner as hp
+import pyF3D.Profiling as pr
+
+class PipelineExecutor(object):
+    """
+    Runs the filters of a pipeline one after the other on the slab loaded in a ClAttributes, keeping every
+    intermediate result on the device. Each filter reads clattr.inputBuffer, leaves its result in clattr.outputBuffer
+    and may overwrite its input. Between filters only the handles of the two buffers are swapped, so that no slab is
+    copied on the device. Temporary buffers are shared by all filters through ClAttributes.acquireTmpBuffer
+
+    Each filter is only run on the slices of the slab still needed by the following filters (see HaloPlan.windows),
+    through sub-buffers of the slab buffers
+
+    Parameters
+    ----------
+    pipeline: list
+        Filters to run, cloned for every slab
+    clattr: pyF3D.ClAttributes.ClAttributes
+        Device, queue and slab buffers
+    attr: pyF3D.FilterAttributes.FilteringAttributes
+        Attributes of the volume and of the current slab
+    index: int
+        Index of the device
+    plan: pyF3D.HaloPlanner.HaloPlan, optional
+        Halos of the stages of pipeline. Computed from pipeline if not given
+    """
+
+    # buffers swapped by filters, windowed together so that results stay at the same offset whichever holds them
+    bufferNames = ['inputBuffer', 'outputBuffer', 'outputTmpBuffer']
+
+    def __init__(self, pipeline, clattr, attr, index, plan=None):
+        self.pipeline = pipeline
+        self.clattr = clattr
+        self.attr = attr
+        self.index = index
+        self.plan = hp.HaloPlan(pipeline) if plan is None else plan
+        # buffer holding the result of the last filter run
+        self.resultBuffer = None
+        # (stage, event) of the work enqueued by the last run, see pyF3D.Profiling.record, and for each filter its
+        # name, stage and bytes of the slab it filtered
+        self.events = []
+        self.stages = []
+        self.filterTimes = None
+        self.totalTime = 0.
+
+    def run(self):
+        """
+        Enqueues every filter of the pipeline on the slab currently loaded in clattr.inputBuffer. The result is left
+        in clattr.outputBuffer. Filters are not waited for, so that the work of consecutive filters is queued on the
+        device without host synchronization; the time they take is known once it is complete, see elapsed. Returns
+        self
+        """
+
+        clattr = self.clattr
+        self.events = []
+        self.stages = []
+        self.filterTimes = None
+        clattr.stageEvents = self.events
+        try:
+            self.enqueueFilters()
+        finally:
+            clattr.stageEvents = None
+
+        self.resultBuffer = clattr.outputBuffer
+        return self
+
+    def enqueueFilters(self):
+        clattr = self.clattr
+        if not self.pipeline:
+            pr.record(clattr, cl.enqueue_copy(clattr.queue, clattr.outputBuffer, clattr.inputBuffer), 'copy', 'copy')
+
+        windows = self.plan.windows(clattr.sliceCount, clattr.sliceOffset == 0,
+                                    clattr.sliceOffset + clattr.sliceCount >= self.attr.slices)
+        for i in range(len(self.pipeline)):
+            if i > 0:
+                clattr.swapBuffers()
+
+            filter = self.pipeline[i].clone()
+            filter.setAttributes(clattr, self.attr, self.index)
+            if filter.getInfo().useTempBuffer and clattr.outputTmpBuffer is None:
+                clattr.initializeTmpBuffer()
+
+            window = self.enterWindow(*windows[i])
+            clattr.profileStage = '%d:%s' % (i, filter.getName())
+            try:
+                if not filter.loadKernel():
+                    raise Exception('could not load kernel of ' + filter.getName())
+                if not filter.runFilter():
+                    raise Exception('could not run ' + filter.getName())
+                self.stages.append((filter.getName(), clattr.profileStage,
+                                    2*clattr.slabBytes(self.attr.width, self.attr.height, clattr.sliceCount)))
+            finally:
+                clattr.profileStage = None
+                self.leaveWindow(window)
+
+    def elapsed(self):
+        """
+        Seconds taken on the device by the last run: the time of the kernels and copies enqueued by its filters, from
+        their OpenCL events, whose completion is waited for. Work done on the host by filters falling back to NumPy is
+        not counted. The first call also sets filterTimes, the (name, seconds) of each filter, and records the
+        bandwidth of each filter (see TiledStencil.recordBandwidth)
+        """
+
+        if self.filterTimes is None:
+            seconds = {}
+            for stage, event in self.events:
+                seconds[stage] = seconds.get(stage, 0.) + eventSeconds(event)
+            self.filterTimes = []
+            for name, stage, byteCount in self.stages:
+                self.filterTimes.append((name, seconds.get(stage, 0.)))
+                ts.recordBandwidth(name, byteCount, seconds.get(stage, 0.))
+            self.totalTime = sum(seconds.values())
+        return self.totalTime
+
+    def enterWindow(self, lo, hi):
+        """
+        Replaces the slab buffers of clattr by sub-buffers over slices [lo, hi) of the slab. lo is lowered to the
+        base address alignment of the device. Returns the state restored by leaveWindow, or None if the window is the
+        whole slab
+        """
+
+        clattr = self.clattr
+        sliceBytes = clattr.slabBytes(self.attr.width, self.attr.height, 1)
+        align = max(1, clattr.device.mem_base_addr_align // 8)
+        while lo > 0 and (lo*sliceBytes) % align != 0:
+            lo -= 1
+        if lo == 0 and hi == clattr.sliceCount:
+            return None
+
+        parents = []
+        for name in self.bufferNames:
+            buffer = getattr(clattr, name)
+            if buffer is None:
+                continue
+            subBuffer = buffer.get_sub_region(lo*sliceBytes, (hi - lo)*sliceBytes)
+            parents.append((subBuffer, buffer))
+            setattr(clattr, name, subBuffer)
+
+        state = (parents, clattr.sliceCount, clattr.sliceOffset)
+        clattr.sliceCount = hi - lo
+        clattr.sliceOffset += lo
+        return state
+
+    def leaveWindow(self, state):
+        """
+        Puts back the slab buffers replaced by enterWindow, following the swaps made by the filter
+        """
+
+        if state is None:
+            return
+
+        clattr = self.clattr
+        parents, clattr.sliceCount, clattr.sliceOffset = state
+        for name in self.bufferNames:
+            buffer = getattr(clattr, name)
+            for subBuffer, parent in parents:
+                if buffer is subBuffer:
+                    setattr(clattr, name, parent)
+        for subBuffer, parent in parents:
+            subBuffer.release()
+
+def eventSeconds(event):
+    """
+    Seconds event ran on the device, once complete. 0 if its queue has no profiling information
+    """
+
+    try:
+        event.wait()
+        return (event.profile.end - event.profile.start)*1e-9
+    except cl.Error:
+        return 0.
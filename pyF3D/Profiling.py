@@ -0,0 +1,215 @@
+import json
+import logging
+import os
+import threading
+import pyopencl as cl
+
+logger = logging.getLogger('pyF3D')
+
+# profiler collecting the events of the queues, see Profiler.start
+activeProfiler = None
+
+def setLogLevel(level='INFO'):
+    """
+    Sets the level of the messages of pyF3D, which are printed on standard error. Can also be set through the
+    PYF3D_LOG_LEVEL environment variable. Without it, only warnings and errors are printed
+
+    Parameters
+    ----------
+    level: {str, int}, optional
+        Name of the level ('DEBUG', 'INFO', 'WARNING', 'ERROR') or logging level
+    """
+
+    if not any(isinstance(handler, logging.StreamHandler) for handler in logger.handlers):
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(levelname)s %(name)s: %(message)s'))
+        logger.addHandler(handler)
+    logger.setLevel(level.upper() if isinstance(level, str) else level)
+
+if os.environ.get('PYF3D_LOG_LEVEL'):
+    setLogLevel(os.environ['PYF3D_LOG_LEVEL'])
+
+def createQueue(context, device):
+    """
+    Command queue of device, with profiling enabled: the time of pipeline stages is taken from the events of their
+    kernels and copies (see PipelineExecutor.elapsed), whether a Profiler is active or not
+    """
+
+    return cl.CommandQueue(context, device, properties=cl.command_queue_properties.PROFILING_ENABLE)
+
+def record(clattr, event, name, category='kernel', slab=None):
+    """
+    Gives event to the active Profiler, if any, attributed to the device of clattr, to slab (the slab of clattr by
+    default, see ClAttributes.profileSlab) and to the pipeline stage being run, and to the PipelineExecutor running
+    on clattr, if any (see ClAttributes.stageEvents). Returns event
+
+    Parameters
+    ----------
+    clattr: pyF3D.ClAttributes.ClAttributes
+        Device the event was enqueued on
+    event: pyopencl.Event
+        Event of a kernel launch or of a copy
+    name: str
+        Name of the kernel or of the copy
+    category: str, optional
+        'kernel', 'upload', 'download' or 'copy'
+    slab: tuple, optional
+        (start, end) range of the slices of the slab
+    """
+
+    if event is not None and clattr.stageEvents is not None:
+        clattr.stageEvents.append((clattr.profileStage, event))
+    profiler = activeProfiler
+    if profiler is not None and event is not None:
+        profiler.add(event, name, category, clattr.device.name.strip(), clattr.profileSlab if slab is None else slab,
+                     clattr.profileStage)
+    return event
+
+class Profiler(object):
+    """
+    Collects start and end times of the kernels and copies enqueued on the devices while active, from OpenCL events.
+    Events are attributed to device, slab and pipeline stage, and exported as a Chrome trace (chrome://tracing,
+    https://ui.perfetto.dev) or summed in a table
+
+    Examples
+    --------
+    >>> with Profiler() as profiler:
+    ...     result = run_f3d(image, pipeline)
+    >>> profiler.saveTrace('trace.json')
+    >>> print(profiler.summaryTable())
+    """
+
+    def __init__(self):
+        self.records = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        global activeProfiler
+        activeProfiler = self
+        return self
+
+    def stop(self):
+        global activeProfiler
+        if activeProfiler is self:
+            activeProfiler = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def add(self, event, name, category, device, slab, stage):
+        with self.lock:
+            self.records.append((event, name, category, device, slab, stage))
+
+    def events(self):
+        """
+        Events collected, waiting for those not complete yet. Events of queues without profiling enabled are left out
+
+        Returns
+        -------
+        list
+            One dict per event: 'name', 'category', 'device', 'slab', 'stage', and 'start' and 'end' in nanoseconds of
+            the clock of the device
+        """
+
+        with self.lock:
+            records = list(self.records)
+
+        events = []
+        for event, name, category, device, slab, stage in records:
+            try:
+                event.wait()
+                start = event.profile.start
+                end = event.profile.end
+            except cl.Error:
+                continue
+            events.append({'name': name, 'category': category, 'device': device, 'slab': slab, 'stage': stage,
+                           'start': start, 'end': end})
+        if records and not events:
+            logger.warning('No profiling information, queues must be created by pyF3D.Profiling.createQueue')
+        return events
+
+    def chromeTrace(self):
+        """
+        Events in the Chrome trace event format, with one process per device, kernels and transfers on two threads.
+        Times are in microseconds from the first event of each device, as devices have clocks of their own
+
+        Returns
+        -------
+        dict
+            JSON-serializable trace
+        """
+
+        events = self.events()
+        devices = []
+        for event in events:
+            if event['device'] not in devices:
+                devices.append(event['device'])
+        origins = dict((device, min(e['start'] for e in events if e['device'] == device)) for device in devices)
+
+        trace = []
+        for pid, device in enumerate(devices):
+            trace.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': device}})
+            for tid, thread in enumerate(['kernels', 'transfers']):
+                trace.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': thread}})
+
+        for event in events:
+            args = {}
+            if event['slab'] is not None:
+                args['slab'] = '{}-{}'.format(*event['slab'])
+            if event['stage'] is not None:
+                args['stage'] = event['stage']
+            trace.append({'name': event['name'], 'cat': event['category'], 'ph': 'X',
+                          'pid': devices.index(event['device']), 'tid': 0 if event['category'] == 'kernel' else 1,
+                          'ts': (event['start'] - origins[event['device']])/1000.,
+                          'dur': (event['end'] - event['start'])/1000., 'args': args})
+        return {'traceEvents': trace, 'displayTimeUnit': 'ms'}
+
+    def saveTrace(self, path):
+        """
+        Writes the Chrome trace of the events (see chromeTrace) to the JSON file path
+        """
+
+        with open(path, 'w') as f:
+            json.dump(self.chromeTrace(), f)
+
+    def summary(self):
+        """
+        Time spent per device, pipeline stage, category and kernel or copy, longest first
+
+        Returns
+        -------
+        list
+            One dict per row: 'device', 'stage', 'category', 'name', 'count', and 'totalMs', 'meanMs' and 'maxMs'
+        """
+
+        rows = {}
+        for event in self.events():
+            key = (event['device'], event['stage'] or '', event['category'], event['name'])
+            milliseconds = (event['end'] - event['start'])/1e6
+            row = rows.setdefault(key, [0, 0., 0.])
+            row[0] += 1
+            row[1] += milliseconds
+            row[2] = max(row[2], milliseconds)
+
+        summary = []
+        for (device, stage, category, name), (count, total, longest) in rows.items():
+            summary.append({'device': device, 'stage': stage, 'category': category, 'name': name, 'count': count,
+                            'totalMs': total, 'meanMs': total/count, 'maxMs': longest})
+        return sorted(summary, key=lambda row: -row['totalMs'])
+
+    def summaryTable(self):
+        """
+        summary as a text table
+        """
+
+        columns = ['device', 'stage', 'category', 'name', 'count', 'totalMs', 'meanMs', 'maxMs']
+        lines = [[str(row[c]) if c not in columns[5:] else '%.3f' % row[c] for c in columns] for row in self.summary()]
+        widths = [max([len(c)] + [len(line[i]) for line in lines]) for i, c in enumerate(columns)]
+        table = []
+        for line in [columns] + lines:
+            table.append('  '.join(value.ljust(width) if i < 4 else value.rjust(width)
+                                   for i, (value, width) in enumerate(zip(line, widths))))
+        return '\n'.join(table)
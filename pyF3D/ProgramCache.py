@@ -0,0 +1,173 @@
+import hashlib
+import os
+import re
+import threading
+import numpy as np
+import pkg_resources as pkg
+import pyopencl as cl
+
+# directory used to store compiled program binaries between processes. None disables the on-disk cache
+binaryCacheDir = os.environ.get('PYF3D_BINARY_CACHE')
+
+_sources = {}
+includePattern = re.compile(r'^[ \t]*#include[ \t]+"([^"]+)"[ \t]*$', re.M)
+_programs = {}
+_constants = {}
+_buildLocks = {}
+_lock = threading.Lock()
+
+def setBinaryCacheDir(path=None):
+    """
+    Sets directory used to store compiled OpenCL program binaries, so that a new process does not have to recompile
+    kernels. Can also be set through the PYF3D_BINARY_CACHE environment variable
+
+    Parameters
+    ----------
+    path: str, optional
+        Cache directory. Created if it does not exist. If None, on-disk caching is disabled
+    """
+
+    global binaryCacheDir
+    if path is not None and not os.path.isdir(path):
+        os.makedirs(path)
+    binaryCacheDir = path
+
+def clearProgramCache(context=None):
+    """
+    Removes compiled programs and constant buffers (see getConstantBuffer) from the in-memory cache
+
+    Parameters
+    ----------
+    context: pyopencl.Context, optional
+        Only programs and buffers of this context are removed. If None, the whole cache is cleared
+    """
+
+    with _lock:
+        if context is None:
+            _programs.clear()
+            _buildLocks.clear()
+            _constants.clear()
+        else:
+            for key in [k for k in _programs if k[0] == context]:
+                del _programs[key]
+                _buildLocks.pop(key, None)
+            for key in [k for k in _constants if k[0] == context]:
+                del _constants[key]
+
+def getSource(filename):
+    """
+    Returns source of an OpenCL file in pyF3D/OpenCL. The file is only read once per process. Lines of the form
+    #include "name.cl" are replaced by the source of that file, so that files do not depend on the compiler's
+    include path
+    """
+
+    with _lock:
+        if filename in _sources:
+            return _sources[filename]
+    source = pkg.resource_string(__name__, "OpenCL/" + filename).decode()
+    source = includePattern.sub(lambda match: getSource(match.group(1)), source)
+    with _lock:
+        _sources[filename] = source
+    return source
+
+def getProgram(context, filename, options=None, source=None):
+    """
+    Returns a built program for the OpenCL file, shared by every filter that runs on the same context. Programs are
+    keyed by context, source hash, build options and devices, so a program is compiled only once per context
+
+    Parameters
+    ----------
+    context: pyopencl.Context
+        Context the program is built for
+    filename: str
+        name of OpenCL file in pyF3D/OpenCL (ex.: 'MedianFilter.cl')
+    options: list, optional
+        build options passed to the OpenCL compiler
+    source: str, optional
+        Source code to build instead of the contents of filename (ex.: generated code). filename is then only used
+        to name the program
+
+    Returns
+    -------
+    pyopencl.Program
+    """
+
+    if source is None:
+        source = getSource(filename)
+    options = tuple(options) if options else ()
+    sourceHash = hashlib.sha1(source.encode()).hexdigest()
+    devices = tuple(context.devices)
+    key = (context, sourceHash, options, devices)
+
+    with _lock:
+        if key in _programs:
+            return _programs[key]
+        buildLock = _buildLocks.setdefault(key, threading.Lock())
+
+    # build outside of global lock so that other contexts are not blocked while compiling
+    with buildLock:
+        with _lock:
+            if key in _programs:
+                return _programs[key]
+
+        program = _loadBinary(context, sourceHash, options)
+        if program is None:
+            program = cl.Program(context, source).build(options=list(options))
+            _saveBinary(context, program, sourceHash, options)
+
+        with _lock:
+            _programs[key] = program
+        return program
+
+def getConstantBuffer(context, key, makeArray):
+    """
+    Returns a read-only buffer holding the array returned by makeArray, created and uploaded once per context and
+    key. Meant for tables that do not change between slabs, such as filter weights, to be passed as constant
+    arguments
+    """
+
+    with _lock:
+        buffer = _constants.get((context, key))
+    if buffer is None:
+        buffer = cl.Buffer(context, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+                           hostbuf=np.ascontiguousarray(makeArray()))
+        with _lock:
+            buffer = _constants.setdefault((context, key), buffer)
+    return buffer
+
+def _binaryPath(device, sourceHash, options):
+    deviceKey = "|".join([device.platform.name, device.name, device.version, device.driver_version,
+                          sourceHash, " ".join(options)])
+    return os.path.join(binaryCacheDir, hashlib.sha1(deviceKey.encode()).hexdigest() + ".bin")
+
+def _loadBinary(context, sourceHash, options):
+    if not binaryCacheDir:
+        return None
+
+    binaries = []
+    for device in context.devices:
+        path = _binaryPath(device, sourceHash, options)
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as f:
+            binaries.append(f.read())
+
+    try:
+        return cl.Program(context, context.devices, binaries).build(options=list(options))
+    except Exception:
+        # stale or incompatible binary, rebuild from source
+        return None
+
+def _saveBinary(context, program, sourceHash, options):
+    if not binaryCacheDir:
+        return
+
+    try:
+        for device, binary in zip(program.devices, program.binaries):
+            path = _binaryPath(device, sourceHash, options)
+            tmpPath = "{}.{}.tmp".format(path, os.getpid())
+            with open(tmpPath, 'wb') as f:
+                f.write(binary)
+            os.rename(tmpPath, path)
+    except (IOError, OSError):
+        pass
@@ -0,0 +1,122 @@
+import math
+import threading
+
+class SlabScheduler(object):
+    """
+    Hands out z-ranges of a volume to devices. Each device registers the maximum number of slices its buffers can
+    hold. Slab sizes are weighted by the throughput (slices per second) measured on each device, and shrink as the
+    remaining work shrinks, so that all devices finish at about the same time
+
+    Parameters
+    ----------
+    depth: int
+        number of slices of the volume
+    overlap: int
+        number of overlap slices added to each side of a slab
+    deviceCount: int, optional
+        number of devices expected to register
+    minSliceCount: int, optional
+        smallest slab handed out, except for the last one. Defaults to max(1, overlap)
+    tailFactor: float, optional
+        a device is given at most 1/tailFactor of its share of the remaining slices, so that the tail of the volume
+        is split in progressively smaller slabs
+    """
+
+    def __init__(self, depth, overlap, deviceCount=1, minSliceCount=None, tailFactor=2.):
+        self.depth = depth
+        self.overlap = overlap
+        self.deviceCount = deviceCount
+        self.minSliceCount = minSliceCount if minSliceCount else max(1, overlap)
+        self.tailFactor = tailFactor
+
+        self.startIndex = 0
+        self.maxSliceCounts = {}
+        self.slices = {}
+        self.times = {}
+        self.lock = threading.Lock()
+
+    def register(self, device, maxSliceCount):
+        """
+        Registers device (any hashable key) along with the number of slices, including overlap, that fit on it
+        """
+
+        with self.lock:
+            self.maxSliceCounts[device] = maxSliceCount
+            self.slices.setdefault(device, 0)
+            self.times.setdefault(device, 0.)
+
+    def recordTime(self, device, sliceCount, pipelineTime):
+        """
+        Records time taken by device to filter sliceCount slices
+        """
+
+        with self.lock:
+            self.slices[device] += sliceCount
+            self.times[device] += pipelineTime
+
+    def throughput(self, device):
+        """
+        Measured slices per second of device, or None if not measured yet
+        """
+
+        if self.slices.get(device, 0) <= 0 or self.times.get(device, 0) <= 0:
+            return None
+        return self.slices[device] / self.times[device]
+
+    def getNextRange(self, device, range):
+        """
+        Sets range to the next [start, end) z-range to be filtered by device
+
+        Returns
+        -------
+        bool
+            False if there are no slices left
+        """
+
+        with self.lock:
+            if self.startIndex >= self.depth:
+                return False
+
+            start = self.startIndex
+            remaining = self.depth - start
+            sliceCount = min(self.usableSliceCount(device, start), remaining)
+
+            if max(self.deviceCount, len(self.maxSliceCounts)) > 1:
+                share = self.shareOf(device, remaining)
+                sliceCount = min(sliceCount, max(self.minSliceCount, int(math.ceil(share / self.tailFactor))))
+
+            # do not leave a slab smaller than minSliceCount, if it fits in this one
+            if 0 < remaining - sliceCount < self.minSliceCount and \
+                    remaining <= self.usableSliceCount(device, start):
+                sliceCount = remaining
+
+            range[0] = start
+            range[1] = start + sliceCount
+            self.startIndex = range[1]
+            return True
+
+    def usableSliceCount(self, device, start):
+        """
+        Number of slices, without overlap, that fit on device for a slab starting at start
+        """
+
+        maxSliceCount = self.maxSliceCounts[device]
+        overlap = self.overlap if start > 0 else 0
+        return max(1, maxSliceCount - overlap - self.overlap)
+
+    def shareOf(self, device, remaining):
+        """
+        Share of the remaining slices that device should filter given the throughputs of all devices. Devices that
+        are not measured yet are assumed as fast as the average measured device
+        """
+
+        rate = self.throughput(device)
+        rates = [self.throughput(d) for d in self.maxSliceCounts]
+        measured = [r for r in rates if r is not None]
+        if not measured:
+            return float(remaining) / max(self.deviceCount, len(rates))
+
+        average = sum(measured) / len(measured)
+        rate = average if rate is None else rate
+        total = sum(average if r is None else r for r in rates)
+        return remaining * rate / total
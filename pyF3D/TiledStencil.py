@@ -0,0 +1,161 @@
+import os
+import threading
+import numpy as np
+import pyopencl as cl
+import pyF3D.Autotuner as at
+import pyF3D.VoxelTypes as vt
+
+# devices on which tiled kernels are used, when the tile fits in local memory: 'auto' on devices with dedicated local
+# memory, 'always' on every device, 'never' on none. See setTiledKernels and Tiling.cl
+tiledKernels = os.environ.get('PYF3D_TILED_KERNELS', 'auto')
+tiledKernelModes = ['auto', 'always', 'never']
+# fraction of the local memory of a device a tile may use, the rest is left to the compiler
+localMemoryFraction = 0.75
+
+_bandwidth = {}
+_lock = threading.Lock()
+
+def setTiledKernels(mode='auto'):
+    """
+    Sets the devices on which the median, bilateral, dilation and erosion filters read slabs through tiles kept in
+    local memory. Can also be set through the PYF3D_TILED_KERNELS environment variable
+
+    Parameters
+    ----------
+    mode: str, optional
+        'auto' (default) for devices with dedicated local memory (GPUs), 'always' for every device, 'never' to read
+        global memory on every device. Tiles are only used when they fit in local memory
+    """
+
+    global tiledKernels
+    if mode not in tiledKernelModes:
+        raise ValueError('mode must be one of ' + ', '.join(tiledKernelModes))
+    tiledKernels = mode
+
+def usesTiles(device):
+    """
+    True if tiled kernels are used on device, see setTiledKernels
+    """
+
+    if tiledKernels == 'auto':
+        return device.local_mem_type == cl.device_local_mem_type.LOCAL
+    return tiledKernels == 'always'
+
+def tileBytes(localSize, radius, dtype=np.uint8):
+    """
+    Local memory needed by the tile of a work-group of (x, y) localSize, for a neighbourhood of halo radius over a
+    volume of dtype voxels
+    """
+
+    return (2*radius + 1)*(localSize[0] + 2*radius)*(localSize[1] + 2*radius)*vt.tileItemSize(dtype)
+
+def tileWorkGroupSize(clattr, kernel, radius, sizes, itemBytes=0):
+    """
+    Work-group and global sizes of a tiled launch of kernel over (width, height, depth) sizes, for a neighbourhood of
+    halo radius. The largest square work-group whose tile, and itemBytes of local memory per work-item, fit in local
+    memory is used, and the depth is split in blocks as by ClAttributes.computeWorkingGroupSize
+
+    Returns
+    -------
+    tuple
+        localSize, globalSize and the size in bytes of the local buffers (see tileLocalMemory). None if tiled
+        kernels are not used on the device (see usesTiles) or if no work-group of at least 4x4 fits
+    """
+
+    device = clattr.device
+    if not usesTiles(device):
+        return None
+
+    maxGroupSize = min(device.max_work_group_size,
+                       kernel.get_work_group_info(cl.kernel_work_group_info.WORK_GROUP_SIZE, device))
+    side = min(int(np.sqrt(maxGroupSize)), 16)
+    while side >= 4:
+        localSize = [side, side]
+        size = tileLocalMemory(clattr, radius, itemBytes)(localSize)
+        if size is not None:
+            globalSize = [clattr.roundUp(side, sizes[0]), clattr.roundUp(side, sizes[1]),
+                          clattr.sliceBlockCount(sizes, 2*radius + 1)]
+            return localSize + [1], globalSize, size
+        side //= 2
+    return None
+
+def tileLocalMemory(clattr, radius, itemBytes=0):
+    """
+    Returns a function giving the local memory needed by the tile of a (x, y) work-group size, or None if it does not
+    fit in the local memory of the device. With itemBytes, kernels have a local buffer of itemBytes per work-item
+    before the tile, and the function gives the sizes of both buffers
+    """
+
+    available = clattr.device.local_mem_size*localMemoryFraction
+
+    def localMemory(localSize):
+        size = tileBytes(localSize, radius, clattr.dtype)
+        if not itemBytes:
+            return size if size <= available else None
+        sizes = [itemBytes*localSize[0]*localSize[1], size]
+        return sizes if sum(sizes) <= available else None
+    return localMemory
+
+def itemLocalMemory(clattr, itemBytes):
+    """
+    Returns a function giving the local memory of untiled kernels whose last argument is a local buffer of itemBytes
+    per work-item, for a (x, y) work-group size, or None if it does not fit in the local memory of the device
+    """
+
+    available = clattr.device.local_mem_size*localMemoryFraction
+
+    def localMemory(localSize):
+        size = itemBytes*localSize[0]*localSize[1]
+        return size if size <= available else None
+    return localMemory
+
+def runTiled(clattr, kernel, args, radius, sizes, itemBytes=0):
+    """
+    Launches a tiled kernel with args followed by its local tile, and by a local buffer of itemBytes per work-item
+    before the tile if itemBytes is given. Returns False without launching if they do not fit (see
+    tileWorkGroupSize), in which case the caller runs the untiled kernel
+    """
+
+    tiling = tileWorkGroupSize(clattr, kernel, radius, sizes, itemBytes)
+    if tiling is None:
+        return False
+
+    localSize, globalSize, size = tiling
+    kernel.set_args(*(list(args) + at.localBuffers(size)))
+    at.enqueue(clattr, kernel, globalSize, localSize, sizes, maskSize=radius, minBlock=2*radius + 1,
+               localMemory=tileLocalMemory(clattr, radius, itemBytes))
+    return True
+
+def recordBandwidth(name, byteCount, seconds):
+    """
+    Adds byteCount bytes moved in seconds to the statistics of filter name
+    """
+
+    with _lock:
+        stats = _bandwidth.setdefault(name, [0, 0.0, 0])
+        stats[0] += byteCount
+        stats[1] += seconds
+        stats[2] += 1
+
+def bandwidthReport():
+    """
+    Achieved bandwidth of each filter run on OpenCL devices since the last reset. Each run counts every voxel of the
+    slab read once and written once, the least traffic a filter needs, so GBps is the effective bandwidth and can be
+    compared with the peak bandwidth of the device
+
+    Returns
+    -------
+    dict
+        filter name and {'runs', 'bytes', 'seconds', 'GBps'} key/value pairs
+    """
+
+    with _lock:
+        report = {}
+        for name, (byteCount, seconds, runs) in _bandwidth.items():
+            report[name] = {'runs': runs, 'bytes': byteCount, 'seconds': seconds,
+                            'GBps': byteCount/seconds/1e9 if seconds > 0 else 0.0}
+        return report
+
+def resetBandwidthStats():
+    with _lock:
+        _bandwidth.clear()
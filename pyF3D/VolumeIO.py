@@ -0,0 +1,418 @@
+import os
+import multiprocessing
+import concurrent.futures as cf
+import numpy as np
+import tifffile
+
+tiffExtensions = ('.tif', '.tiff')
+
+class TiffSliceVolume(object):
+    """
+    Read-only 3D volume stored as a directory of 2D TIFF slices, one file per z index. Slices are only read from disk
+    when indexed, so only the requested slabs are held in memory
+
+    Parameters
+    ----------
+    path: str
+        Directory containing the TIFF slices. Files are ordered by name
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.files = sorted(os.path.join(path, f) for f in os.listdir(path) if f.lower().endswith(tiffExtensions))
+        if not self.files:
+            raise ValueError('No TIFF files found in {}'.format(path))
+
+        first = tifffile.imread(self.files[0])
+        if first.ndim != 2:
+            raise ValueError('TIFF slices must be 2D, found shape {}'.format(first.shape))
+        self.shape = (len(self.files),) + first.shape
+        self.dtype = first.dtype
+        self.ndim = 3
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        if not isinstance(key[0], slice):
+            return tifffile.imread(self.files[key[0]])[key[1:]]
+
+        indices = range(*key[0].indices(self.shape[0]))
+        data = np.empty((len(indices),) + self.shape[1:], dtype=self.dtype)
+        for i, z in enumerate(indices):
+            data[i] = tifffile.imread(self.files[z])
+        return data[(slice(None),) + key[1:]]
+
+class TiffSliceWriter(object):
+    """
+    Write-only 3D volume stored as a directory of 2D TIFF slices. Slabs assigned to z-ranges are written to disk
+    immediately, in any order
+
+    Parameters
+    ----------
+    path: str
+        Output directory. Created if it does not exist
+    shape: tuple
+        Shape of the volume
+    dtype: np.dtype, optional
+        Type of the volume
+    prefix: str, optional
+        Prefix of slice file names
+    """
+
+    def __init__(self, path, shape, dtype=np.uint8, prefix='slice'):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.ndim = 3
+        digits = max(5, len(str(self.shape[0] - 1)))
+        self.fileFormat = os.path.join(path, prefix + '_{:0' + str(digits) + 'd}.tif')
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __setitem__(self, key, value):
+        if not isinstance(key, slice):
+            key = slice(key, key + 1)
+        value = np.asarray(value, dtype=self.dtype).reshape((-1,) + self.shape[1:])
+
+        write = getattr(tifffile, 'imwrite', None) or tifffile.imsave
+        for i, z in enumerate(range(*key.indices(self.shape[0]))):
+            write(self.fileFormat.format(z), value[i])
+
+    def toVolume(self):
+        """
+        Returns the written slices as a TiffSliceVolume
+        """
+        return TiffSliceVolume(self.path)
+
+class ScaledVolume(object):
+    """
+    Read-only view of a volume that is scaled to np.uint8 slab by slab when indexed, instead of converting the whole
+    volume at once. Minimum and maximum (or percentiles) are found in a streaming pass over the volume, see
+    volumeRange
+
+    Parameters
+    ----------
+    volume: {ndarray, np.memmap, TiffSliceVolume}
+        3D image data
+    percentiles: tuple, optional
+        (low, high) percentiles, from 0 to 100, mapped to 0 and 255. Values outside are clipped. Defaults to the
+        minimum and maximum
+    threadCount: int, optional
+        Number of threads of the streaming pass. Defaults to number of CPUs
+    """
+
+    def __init__(self, volume, percentiles=None, threadCount=None):
+        self.volume = volume
+        self.shape = tuple(volume.shape)
+        self.dtype = np.dtype(np.uint8)
+        self.ndim = 3
+        self.low, self.high = volumeRange(volume, percentiles, threadCount)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        return scaleSlab(np.asarray(self.volume[key]), self.low, self.high)
+
+class BrickVolume(object):
+    """
+    Read-only view of the voxels of a volume in a (y, x) range of each slice. Only the voxels of the range are read
+    when indexed along z, as long as volume accepts (z, y, x) keys
+
+    Parameters
+    ----------
+    volume: {ndarray, np.memmap, TiffSliceVolume, ScaledVolume}
+        3D image data
+    yRange: tuple
+        [y0, y1) range of rows
+    xRange: tuple
+        [x0, x1) range of columns
+    """
+
+    def __init__(self, volume, yRange, xRange):
+        self.volume = volume
+        self.yRange = yRange
+        self.xRange = xRange
+        self.shape = (volume.shape[0], yRange[1] - yRange[0], xRange[1] - xRange[0])
+        self.dtype = np.dtype(volume.dtype)
+        self.ndim = 3
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        data = self.volume[key[0], self.yRange[0]:self.yRange[1], self.xRange[0]:self.xRange[1]]
+        if isinstance(key[0], slice):
+            return data[(slice(None),) + key[1:]]
+        return data[key[1:]]
+
+class BrickOutput(object):
+    """
+    Write-only view of a (y, x) range of each slice of an output volume. Slabs assigned to z-ranges cover the range
+    read by a brick, including its halos, and only their voxels in the inner range of the brick are written
+
+    Parameters
+    ----------
+    output: {ndarray, np.memmap}
+        Output volume
+    innerRange: tuple
+        ((y0, y1), (x0, x1)) ranges written into output
+    outerRange: tuple
+        ((y0, y1), (x0, x1)) ranges of the slabs assigned, containing innerRange
+    """
+
+    def __init__(self, output, innerRange, outerRange):
+        self.output = output
+        self.innerRange = innerRange
+        self.outerRange = outerRange
+        self.shape = (output.shape[0], outerRange[0][1] - outerRange[0][0], outerRange[1][1] - outerRange[1][0])
+        self.dtype = np.dtype(output.dtype)
+        self.ndim = 3
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __setitem__(self, key, value):
+        (y0, y1), (x0, x1) = self.innerRange
+        offsetY, offsetX = self.outerRange[0][0], self.outerRange[1][0]
+        self.output[key, y0:y1, x0:x1] = np.asarray(value)[..., y0 - offsetY:y1 - offsetY, x0 - offsetX:x1 - offsetX]
+
+def chunkSliceCount(volume, chunkBytes=64*1024*1024, itemSize=None):
+    """
+    Number of z slices of volume that fit in chunkBytes, for items of itemSize bytes (those of volume by default)
+    """
+
+    itemSize = np.dtype(volume.dtype).itemsize if itemSize is None else itemSize
+    sliceBytes = int(np.prod(volume.shape[1:]))*itemSize
+    return max(1, chunkBytes // sliceBytes)
+
+def chunkRanges(volume, chunkBytes=64*1024*1024, itemSize=None):
+    """
+    [start, end) z-ranges of the chunks of volume of at most chunkBytes, see chunkSliceCount
+    """
+
+    sliceCount = chunkSliceCount(volume, chunkBytes, itemSize)
+    return [(z, min(z + sliceCount, volume.shape[0])) for z in range(0, volume.shape[0], sliceCount)]
+
+def volumeRange(volume, percentiles=None, threadCount=None, binCount=65536):
+    """
+    Minimum and maximum of volume, found in a single pass over chunks of slices read by a pool of threads, so that
+    only a few chunks are in memory at any time. With percentiles, a histogram of binCount bins between the minimum
+    and the maximum is accumulated in a second pass. Percentiles of integer volumes whose values span at most binCount
+    values are exact, as numpy.percentile with method='lower', others are interpolated within their bin
+
+    Parameters
+    ----------
+    volume: {ndarray, np.memmap, TiffSliceVolume}
+        3D image data
+    percentiles: tuple, optional
+        (low, high) percentiles, from 0 to 100
+    threadCount: int, optional
+        Number of threads. Defaults to number of CPUs
+    binCount: int, optional
+        Number of bins of the histogram
+
+    Returns
+    -------
+    tuple
+        (low, high) values, the minimum and maximum if percentiles is None
+    """
+
+    if percentiles is not None and not 0 <= percentiles[0] <= percentiles[1] <= 100:
+        raise ValueError('percentiles must be (low, high) with 0 <= low <= high <= 100')
+    chunks = chunkRanges(volume)
+    if not threadCount:
+        threadCount = multiprocessing.cpu_count()
+
+    def chunkRange(chunk):
+        data = np.asarray(volume[chunk[0]:chunk[1]])
+        return data.min(), data.max()
+
+    with cf.ThreadPoolExecutor(threadCount) as e:
+        ranges = list(e.map(chunkRange, chunks))
+    dataMin = float(min(r[0] for r in ranges))
+    dataMax = float(max(r[1] for r in ranges))
+    if percentiles is None or dataMax == dataMin:
+        return dataMin, dataMax
+
+    exact = np.dtype(volume.dtype).kind in 'biu' and dataMax - dataMin < binCount
+    if exact:
+        binCount = int(dataMax - dataMin) + 1
+    binWidth = 1.0 if exact else (dataMax - dataMin)/binCount
+
+    def chunkHistogram(chunk):
+        data = np.asarray(volume[chunk[0]:chunk[1]])
+        if exact:
+            return np.bincount((data.astype(np.int64) - int(dataMin)).ravel(), minlength=binCount)
+        return np.histogram(data, bins=binCount, range=(dataMin, dataMax))[0]
+
+    with cf.ThreadPoolExecutor(threadCount) as e:
+        histogram = sum(e.map(chunkHistogram, chunks))
+    cumulative = np.cumsum(histogram)
+
+    def percentileValue(q):
+        if q in (0, 100):
+            return dataMin if q == 0 else dataMax
+        rank = q/100.*(cumulative[-1] - 1)
+        i = min(int(np.searchsorted(cumulative, rank, side='right')), binCount - 1)
+        if exact:
+            return dataMin + i
+        before = cumulative[i - 1] if i > 0 else 0
+        return min(dataMin + (i + (rank - before)/histogram[i])*binWidth, dataMax)
+
+    return percentileValue(percentiles[0]), percentileValue(percentiles[1])
+
+def scaleSlab(data, low, high, out=None):
+    """
+    Maps values of data from [low, high] to [0, 255], clipping values outside, and truncates to np.uint8. Computed in
+    float64, so data should be a slab rather than a whole volume
+
+    Parameters
+    ----------
+    out: ndarray, optional
+        np.uint8 array of the shape of data the result is written into. Allocated if not given
+    """
+
+    if out is None:
+        out = np.empty(np.shape(data), dtype=np.uint8)
+    if high == low:
+        out[...] = 0
+        return out
+
+    a = float(255)/(high - low)
+    b = (float(255)*low)/(low - high)
+    scaled = np.multiply(data, a, dtype=np.float64)
+    scaled += b
+    np.clip(scaled, 0, 255, out=scaled)
+    np.copyto(out, scaled, casting='unsafe')
+    return out
+
+def scale_volume(volume, output=None, percentiles=None, threadCount=None):
+    """
+    Scales a volume to np.uint8 chunk by chunk: the minimum and maximum (or percentiles) are found in a streaming pass
+    (see volumeRange), then chunks are scaled by a pool of threads directly into output. Memory use does not depend
+    on the size of the volume
+
+    Parameters
+    ----------
+    volume: {ndarray, np.memmap, str}
+        3D image data, of any type accepted by open_volume
+    output: {ndarray, np.memmap, str}, optional
+        Preallocated np.uint8 volume of the same shape as volume, or path, as accepted by open_output. Allocated in
+        memory if not given
+    percentiles: tuple, optional
+        (low, high) percentiles, from 0 to 100, mapped to 0 and 255. Values outside are clipped. Defaults to the
+        minimum and maximum
+    threadCount: int, optional
+        Number of threads. Defaults to number of CPUs
+
+    Returns
+    -------
+    {ndarray, np.memmap, TiffSliceVolume}
+        Scaled volume
+    """
+
+    volume = open_volume(volume)
+    output = open_output(output, volume.shape, np.uint8)
+    if output is None:
+        output = np.empty(volume.shape, dtype=np.uint8)
+    elif tuple(output.shape) != tuple(volume.shape) or output.dtype != np.uint8:
+        raise ValueError('output must be a np.uint8 volume of shape {}'.format(volume.shape))
+    if not threadCount:
+        threadCount = multiprocessing.cpu_count()
+
+    low, high = volumeRange(volume, percentiles, threadCount)
+
+    def scaleChunk(chunk):
+        data = np.asarray(volume[chunk[0]:chunk[1]])
+        if isinstance(output, np.ndarray):
+            scaleSlab(data, low, high, output[chunk[0]:chunk[1]])
+        else:
+            output[chunk[0]:chunk[1]] = scaleSlab(data, low, high)
+
+    # chunks small enough for the float64 temporary of each thread to stay at 16 MB
+    with cf.ThreadPoolExecutor(threadCount) as e:
+        list(e.map(scaleChunk, chunkRanges(volume, 16*1024*1024, np.dtype(np.float64).itemsize)))
+    if isinstance(output, TiffSliceWriter):
+        return output.toVolume()
+    return output
+
+def open_volume(image, shape=None, dtype=np.uint8):
+    """
+    Opens 3D image data without loading it into memory
+
+    Parameters
+    ----------
+    image: {ndarray, np.memmap, str}
+        3D image data. Can either be:
+
+        1). An ndarray or np.memmap, returned as is
+        2). Path to a directory of 2D TIFF slices
+        3). Path to a .npy file, which is memory-mapped
+        4). Path to a raw binary file, which is memory-mapped. shape must be given
+    shape: tuple, optional
+        Shape (slices, height, width) of raw file
+    dtype: np.dtype, optional
+        Type of raw file
+
+    Returns
+    -------
+    {ndarray, np.memmap, TiffSliceVolume}
+        3D image data
+    """
+
+    if not isinstance(image, str):
+        if isinstance(image, (np.ndarray, TiffSliceVolume, ScaledVolume)):
+            return image
+        return np.asarray(image)
+
+    if os.path.isdir(image):
+        return TiffSliceVolume(image)
+    if image.endswith('.npy'):
+        return np.load(image, mmap_mode='r')
+    if shape is None:
+        raise ValueError('shape must be given for raw file {}'.format(image))
+    return np.memmap(image, dtype=dtype, mode='r', shape=tuple(shape))
+
+def open_output(output, shape, dtype=np.uint8):
+    """
+    Creates volume that filtered slabs are written into
+
+    Parameters
+    ----------
+    output: {None, ndarray, np.memmap, str}
+        Can either be:
+
+        1). None, output is allocated in memory
+        2). An ndarray or np.memmap, returned as is
+        3). Path to a directory (existing, or without extension), to which one TIFF file per slice is written
+        4). Path to a .npy file, created as a memory-mapped file
+        5). Path to any other file, created as a memory-mapped raw binary file
+    shape: tuple
+        Shape of output volume
+    dtype: np.dtype, optional
+        Type of output volume
+
+    Returns
+    -------
+    {None, ndarray, np.memmap, TiffSliceWriter}
+    """
+
+    if not isinstance(output, str):
+        return output
+
+    if os.path.isdir(output) or not os.path.splitext(output)[1]:
+        return TiffSliceWriter(output, shape, dtype)
+    if output.endswith('.npy'):
+        return np.lib.format.open_memmap(output, mode='w+', dtype=dtype, shape=tuple(shape))
+    return np.memmap(output, dtype=dtype, mode='w+', shape=tuple(shape))
@@ -0,0 +1,66 @@
+import numpy as np
+
+# types of the volumes filtered without conversion, in the order of VOXEL_TYPE in Voxel.cl. Volumes of other types are
+# scaled to np.uint8
+voxelTypes = [np.dtype(np.uint8), np.dtype(np.uint16), np.dtype(np.float32)]
+# type of the local tiles of each voxel type (TILE_VALUE in Voxel.cl), which also hold the out-of-bounds marker
+tileTypes = [np.dtype(np.int16), np.dtype(np.int32), np.dtype(np.float32)]
+
+def isSupported(dtype):
+    return np.dtype(dtype) in voxelTypes
+
+def voxelType(dtype):
+    """
+    Index of dtype in voxelTypes, VOXEL_TYPE of the kernels built for volumes of that type
+    """
+
+    dtype = np.dtype(dtype)
+    if dtype not in voxelTypes:
+        raise TypeError('volumes of type {} must be converted to one of {}'.format(dtype, ', '.join(
+            str(t) for t in voxelTypes)))
+    return voxelTypes.index(dtype)
+
+def buildOptions(dtype):
+    """
+    Build options of kernels filtering volumes of type dtype
+    """
+
+    return ["-D", "VOXEL_TYPE=%d" % voxelType(dtype)]
+
+def tileItemSize(dtype):
+    return tileTypes[voxelType(dtype)].itemsize
+
+def isFloat(dtype):
+    return np.dtype(dtype).kind == 'f'
+
+def highest(dtype):
+    """
+    Largest value of dtype, given to voxels outside of the volume by the median filter and erosion
+    """
+
+    return np.inf if isFloat(dtype) else np.iinfo(dtype).max
+
+def fromUint8Levels(levels, dtype):
+    """
+    levels grey levels of np.uint8 in units of dtype: scaled to the range of integer types, and to [0, 1] for float
+    types
+    """
+
+    if isFloat(dtype):
+        return levels / 255.0
+    return levels * (np.iinfo(dtype).max // 255)
+
+def lowest(dtype):
+    return -np.inf if isFloat(dtype) else np.iinfo(dtype).min
+
+def toVoxel(data, dtype, rounding=False):
+    """
+    Converts float data to dtype as CONVERT_VOXEL (truncation) or, if rounding, CONVERT_VOXEL_RTE in Voxel.cl: integer
+    types saturate, float32 is kept as is
+    """
+
+    dtype = np.dtype(dtype)
+    if isFloat(dtype):
+        return data.astype(dtype)
+    data = np.rint(data) if rounding else np.trunc(data)
+    return np.clip(data, np.iinfo(dtype).min, np.iinfo(dtype).max).astype(dtype)
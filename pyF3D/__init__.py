@@ -1,10 +1,19 @@
 from .ClAttributes import create_cl_attributes, list_all_cl_platforms
+from .ProgramCache import setBinaryCacheDir, clearProgramCache
+from .VolumeIO import open_volume, TiffSliceVolume
+from .F3DSession import F3DSession
+from .TiledStencil import bandwidthReport, resetBandwidthStats, setTiledKernels
+from .Autotuner import autotune, setTuningFile, clearTuningCache
+from .MemoryPlanner import memoryReport, setMemoryHeadroom
+from .Profiling import Profiler, setLogLevel
+from .FFTEngine import fft3D
 # from FilterManager import run_f3d, run_MedianFilter, runPipeline, run_BilateralFilter, run_FFTFilter, run_MaskFilter, \
 #     run_MMFilterClo, run_MMFilterDil, run_MMFilterEro, run_MMFilterOpe
-from .FilterManager import run_f3d, run_MedianFilter, runPipeline, run_BilateralFilter, run_MaskFilter, run_MMFilterClo, \
-    run_MMFilterDil, run_MMFilterEro, run_MMFilterOpe
+from .FilterManager import run_f3d, run_f3d_batch, run_MedianFilter, runPipeline, runPipelineCPU, runBatch, \
+    run_BilateralFilter, compare_bilateral_modes, run_FFTFilter, run_MaskFilter, run_MMFilterClo, run_MMFilterDil, \
+    run_MMFilterEro, run_MMFilterOpe, scale_to_uint8
 from .filters.BilateralFilter import BilateralFilter
-# from filters.FFTFilter import FFTFilter
+from .filters.FFTFilter import FFTFilter
 from .filters.MaskFilter import MaskFilter
 from .filters.MedianFilter import MedianFilter
 from .filters.MMFilterClo import MMFilterClo
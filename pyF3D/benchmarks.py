@@ -0,0 +1,278 @@
+import argparse
+import json
+import platform as pf
+import sys
+import time
+
+import numpy as np
+import pyopencl as cl
+
+from . import FilterManager as fm
+from . import Profiling as pr
+from . import HaloPlanner as hp
+from . import VoxelTypes as vt
+from .filters import MedianFilter as mf
+from .filters import FFTFilter as fft
+from .filters import BilateralFilter as bf
+from .filters import MaskFilter as mskf
+from .filters import MMFilterDil as mmdil
+from .filters import MMFilterEro as mmero
+from .filters import MMFilterClo as mmclo
+from .filters import MMFilterOpe as mmope
+
+# one pipeline per filter class, with default parameters, and pipelines commonly run on tomography volumes. Functions
+# of the volume filtered (masks are of the shape of the volume), so that every run gets new filters
+benchmarkPipelines = [
+    ('MedianFilter', lambda image: [mf.MedianFilter()]),
+    ('BilateralFilter', lambda image: [bf.BilateralFilter()]),
+    ('FFTFilter', lambda image: [fft.FFTFilter()]),
+    ('MaskFilter', lambda image: [mskf.MaskFilter(mask=image > image.mean())]),
+    ('MMFilterDil', lambda image: [mmdil.MMFilterDil()]),
+    ('MMFilterEro', lambda image: [mmero.MMFilterEro()]),
+    ('MMFilterClo', lambda image: [mmclo.MMFilterClo()]),
+    ('MMFilterOpe', lambda image: [mmope.MMFilterOpe()]),
+    ('denoise', lambda image: [mf.MedianFilter(), bf.BilateralFilter(mode='fast')]),
+    ('morphology', lambda image: [mmope.MMFilterOpe(), mmclo.MMFilterClo()]),
+    ('median-dilation-erosion', lambda image: [mf.MedianFilter(), mmdil.MMFilterDil(), mmero.MMFilterEro()]),
+]
+
+def syntheticVolume(shape, dtype=np.uint8, seed=0):
+    """
+    Volume of shape (slices, height, width) and type dtype, made of smooth structures and noise, spanning the range
+    of integer types and [0, 1] for float32. The same seed always gives the same volume
+
+    Parameters
+    ----------
+    shape: tuple
+        (slices, height, width)
+    dtype: np.dtype, optional
+        np.uint8, np.uint16 or np.float32
+    seed: int, optional
+        Seed of the noise
+
+    Returns
+    -------
+    ndarray
+        Volume
+    """
+
+    vt.voxelType(dtype)
+    depth, height, width = shape
+    random = np.random.RandomState(seed)
+    y, x = np.ogrid[0:height, 0:width]
+    scale = 1. if vt.isFloat(dtype) else float(np.iinfo(dtype).max)
+
+    volume = np.empty(shape, dtype=dtype)
+    for z in range(depth):
+        smooth = 0.5 + 0.2*np.sin(x*0.11 + z*0.07)*np.cos(y*0.13 - z*0.05)
+        noise = 0.3*random.random_sample((height, width)) - 0.15
+        volume[z] = vt.toVoxel(np.clip(smooth + noise, 0, 1)*scale, dtype)
+    return volume
+
+def list_benchmark_devices():
+    """
+    Every OpenCL device of every platform, GPUs or not. Empty if OpenCL is not available
+    """
+
+    devices = []
+    try:
+        for p in cl.get_platforms():
+            devices += p.get_devices()
+    except cl.Error:
+        pass
+    return devices
+
+def timeDevice(image, pipeline, device, maxSliceCount=None, bufferCount=1):
+    """
+    Filters image on device alone. Time taken by kernels is summed over the slabs (StackRange.time), the rest of the
+    time is spent in transfers between host and device and in copies on the host
+
+    Returns
+    -------
+    tuple
+        (seconds, compute seconds, number of slabs)
+    """
+
+    devices = {device: maxSliceCount}
+    output = np.empty(image.shape, dtype=image.dtype)
+    jobs = fm.createJobs(image, pipeline, output, devices, bufferCount)
+    start = time.time()
+    fm.runJobs(jobs, devices, bufferCount)
+    seconds = time.time() - start
+    stacks = [sr for job in jobs for sr in job.stacks]
+    return seconds, sum(sr.time for sr in stacks), len(stacks)
+
+def timeCPU(image, pipeline, sliceCount=None, threadCount=None):
+    """
+    Filters image with the NumPy implementation of the filters
+
+    Returns
+    -------
+    tuple
+        (seconds, compute seconds, number of slabs)
+    """
+
+    output = np.empty(image.shape, dtype=image.dtype)
+    depth = image.shape[0]
+    start = time.time()
+    fm.runPipelineCPU(image, pipeline, output, sliceCount, threadCount)
+    seconds = time.time() - start
+    slabCount = -(-depth // sliceCount) if sliceCount else None
+    return seconds, seconds, slabCount
+
+def measure(run, repeat):
+    """
+    Best of repeat runs, after a first run that compiles kernels and fills caches. Returns the record of the run
+    """
+
+    run()
+    runs = [run() for i in range(max(1, repeat))]
+    seconds, compute, slabCount = min(runs, key=lambda r: r[0])
+    return {'seconds': seconds, 'computeSeconds': compute, 'transferSeconds': max(0., seconds - compute),
+            'slabCount': slabCount, 'allSeconds': [r[0] for r in runs]}
+
+def run_benchmarks(shape=(64, 256, 256), dtypes=(np.uint8,), pipelines=None, devices=None, cpu=True, repeat=3,
+                   slabCounts=(1, 2, 4, 8), bufferCount=1, threadCount=None, seed=0):
+    """
+    Runs every pipeline of benchmarkPipelines (or those named in pipelines) on synthetic volumes, on each OpenCL
+    device and on the CPU backend. Each pipeline is also run with slabs limited so that the volume is split into each
+    of slabCounts slabs, to show how throughput scales with the number of slabs. Failures are recorded with the
+    error, and do not stop the benchmarks
+
+    Parameters
+    ----------
+    shape: tuple, optional
+        (slices, height, width) of the volumes
+    dtypes: list, optional
+        Types of the volumes, among np.uint8, np.uint16 and np.float32
+    pipelines: list, optional
+        Names of the pipelines of benchmarkPipelines to run. All of them by default
+    devices: list, optional
+        pyopencl.Device objects. Every OpenCL device by default, none if empty
+    cpu: bool, optional
+        Also runs the NumPy implementation of the filters
+    repeat: int, optional
+        Number of timed runs, the fastest is kept
+    slabCounts: list, optional
+        Numbers of slabs the volume is split into for the scaling runs. None or empty to skip them
+    bufferCount: int, optional
+        Number of slab buffers per device, see run_f3d
+    threadCount: int, optional
+        Number of threads of the CPU backend. Defaults to number of CPUs
+    seed: int, optional
+        Seed of the synthetic volumes
+
+    Returns
+    -------
+    dict
+        JSON-serializable report: 'environment', 'results' with one record per dtype, pipeline and backend (seconds,
+        voxelsPerSecond, computeSeconds spent in kernels, transferSeconds spent in transfers and on the host, and
+        slabCount) and 'scaling' with the same records for each slab count
+    """
+
+    selected = [p for p in benchmarkPipelines if pipelines is None or p[0] in pipelines]
+    if pipelines is not None:
+        unknown = set(pipelines) - set(p[0] for p in benchmarkPipelines)
+        if unknown:
+            raise ValueError('unknown pipelines: ' + ', '.join(sorted(unknown)))
+    if devices is None:
+        devices = list_benchmark_devices()
+
+    backends = [('opencl', device) for device in devices]
+    if cpu:
+        backends.append(('cpu', None))
+
+    report = {'environment': {'python': pf.python_version(), 'numpy': np.__version__, 'pyopencl': cl.VERSION_TEXT,
+                              'machine': pf.machine(), 'devices': [d.name.strip() for d in devices]},
+              'shape': list(shape), 'repeat': repeat, 'bufferCount': bufferCount, 'results': [], 'scaling': []}
+    voxels = int(np.prod(shape))
+    depth = shape[0]
+
+    for dtype in dtypes:
+        image = syntheticVolume(shape, dtype, seed)
+        for name, newPipeline in selected:
+            overlap = hp.HaloPlan(newPipeline(image)).total[2]
+            for backend, device in backends:
+                base = {'pipeline': name, 'filters': [f.getName() for f in newPipeline(image)],
+                        'dtype': np.dtype(dtype).name, 'backend': backend,
+                        'device': device.name.strip() if device is not None else 'NumPy', 'voxels': voxels}
+
+                def run(slabCount=None):
+                    if backend == 'cpu':
+                        sliceCount = -(-depth // slabCount) if slabCount else None
+                        return timeCPU(image, newPipeline(image), sliceCount, threadCount)
+                    # slice limits include the halos of the slabs
+                    maxSliceCount = -(-depth // slabCount) + 2*overlap if slabCount else None
+                    return timeDevice(image, newPipeline(image), device, maxSliceCount, bufferCount)
+
+                for slabCount in [None] + list(slabCounts or []):
+                    record = dict(base)
+                    if slabCount is not None:
+                        record['requestedSlabCount'] = slabCount
+                    try:
+                        record.update(measure(lambda: run(slabCount), repeat))
+                        record['voxelsPerSecond'] = voxels/record['seconds'] if record['seconds'] > 0 else None
+                    except Exception as e:
+                        record['error'] = '{}: {}'.format(type(e).__name__, e)
+                    report['results' if slabCount is None else 'scaling'].append(record)
+    return report
+
+def main(args=None):
+    """
+    pyf3d-bench command: runs run_benchmarks and writes the report as JSON to standard output or to a file. Log
+    messages go to standard error. With --trace, the runs are profiled (see pyF3D.Profiling): the trace is written to
+    a file and the summary table to standard error
+    """
+
+    parser = argparse.ArgumentParser(prog='pyf3d-bench', description='Benchmarks pyF3D filters and pipelines on '
+                                     'synthetic volumes, on every OpenCL device and on the CPU backend')
+    parser.add_argument('--shape', type=int, nargs=3, default=[64, 256, 256], metavar=('SLICES', 'HEIGHT', 'WIDTH'))
+    parser.add_argument('--dtype', nargs='+', default=['uint8'], choices=[t.name for t in vt.voxelTypes])
+    parser.add_argument('--pipeline', nargs='+', default=None, choices=[p[0] for p in benchmarkPipelines],
+                        help='pipelines to run, all by default')
+    parser.add_argument('--device', nargs='+', default=None,
+                        help='run on the OpenCL devices whose name contains one of these strings')
+    parser.add_argument('--no-opencl', action='store_true', help='do not run on OpenCL devices')
+    parser.add_argument('--no-cpu', action='store_true', help='do not run the CPU backend')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--slab-counts', type=int, nargs='*', default=[1, 2, 4, 8])
+    parser.add_argument('--buffer-count', type=int, default=1, choices=[1, 2, 3])
+    parser.add_argument('--threads', type=int, default=None, help='threads of the CPU backend')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='JSON file to write, standard output by default')
+    parser.add_argument('--trace', default=None, help='Chrome trace file of the kernels and transfers to write')
+    parser.add_argument('--log-level', default=None, help='level of the messages of pyF3D, ex.: INFO')
+    options = parser.parse_args(args)
+
+    devices = [] if options.no_opencl else list_benchmark_devices()
+    if options.device:
+        devices = [d for d in devices if any(name in d.name for name in options.device)]
+
+    if options.log_level:
+        pr.setLogLevel(options.log_level)
+
+    profiler = pr.Profiler() if options.trace else None
+    if profiler is not None:
+        profiler.start()
+    try:
+        report = run_benchmarks(tuple(options.shape), [np.dtype(t) for t in options.dtype], options.pipeline, devices,
+                                not options.no_cpu, options.repeat, options.slab_counts, options.buffer_count,
+                                options.threads, options.seed)
+    finally:
+        if profiler is not None:
+            profiler.stop()
+
+    if profiler is not None:
+        profiler.saveTrace(options.trace)
+        sys.stderr.write(profiler.summaryTable() + '\n')
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        sys.stdout.write(text + '\n')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,12 @@
 import numpy as np
-import pkg_resources as pkg
 import pyopencl as cl
+from pyopencl import cltypes
 import pyF3D.FilterClasses as fc
+import pyF3D.ProgramCache as pc
+import pyF3D.CpuBackend as cpu
+import pyF3D.TiledStencil as ts
+import pyF3D.Autotuner as at
+import pyF3D.VoxelTypes as vt
 
 class BilateralFilter:
 
@@ -12,26 +17,42 @@ class BilateralFilter:
     ----------
     spatialRadius: int, optional
         Specifies spatial radius
-    rangeRadius: int, optional
-        Specifies range radius
+    rangeRadius: float, optional
+        Specifies range radius, in grey levels of the volume: neighbours differing from the center by more are ignored.
+        Defaults to 30 grey levels of np.uint8 in units of the type of the volume, that is 30 for np.uint8, 7710 for
+        np.uint16 and 30/255 for np.float32 volumes in [0, 1]
+    mode: str, optional
+        Either 'exact' (default), which weights every voxel of the (2*spatialRadius + 1)^3 neighbourhood, or 'fast',
+        which runs one-dimensional bilateral filters along x, y then z. 'fast' reads 3*(2*spatialRadius + 1) voxels
+        instead of (2*spatialRadius + 1)^3, and also weights z offsets by the spatial kernel. See
+        pyF3D.compare_bilateral_modes for its error
     """
 
-    def __init__(self, spatialRadius=3, rangeRadius=30):
+    modes = ['exact', 'fast']
+    # default rangeRadius, in grey levels of np.uint8
+    defaultRangeLevels = 30
+
+    def __init__(self, spatialRadius=3, rangeRadius=None, mode='exact'):
 
         self.name = 'BilateralFilter'
 
         self.spatialRadius = spatialRadius
         self.rangeRadius = rangeRadius
+        if mode not in self.modes:
+            raise ValueError('mode must be one of ' + ', '.join(self.modes))
+        self.mode = mode
         self.clattr = None
         self.atts = None
 
     def toJSONString(self):
         result = "{ \"Name\" : \"" + self.getName() + "\" , "
         result += "\"spatialRadius\" : \"" + str(self.spatialRadius) + "\" , "
-        result += "\"rangeRadius\" : \"" + str(self.rangeRadius) + "\" }"
+        result += "\"rangeRadius\" : \"" + str(self.rangeRadius) + "\" , "
+        result += "\"mode\" : \"" + self.mode + "\" }"
+        return result
 
     def clone(self):
-        return BilateralFilter(spatialRadius=self.spatialRadius, rangeRadius=self.rangeRadius)
+        return BilateralFilter(spatialRadius=self.spatialRadius, rangeRadius=self.rangeRadius, mode=self.mode)
 
     def setSpatialRadius(self, sRadius):
         try:
@@ -42,10 +63,10 @@ class BilateralFilter:
 
     def setRangeRadius(self, rRadius):
         try:
-            rRadius = int(rRadius)
+            rRadius = float(rRadius)
             self.rangeRadius = rRadius
         except ValueError:
-            raise ValueError('rangeRadius must be int')
+            raise ValueError('rangeRadius must be a number')
 
     def getSpatialRadius(self):
         return self.spatialRadius
@@ -53,6 +74,15 @@ class BilateralFilter:
     def getRangeRadius(self):
         return self.rangeRadius
 
+    def rangeRadiusFor(self, dtype):
+        """
+        Range radius in grey levels of dtype: rangeRadius if set, and otherwise defaultRangeLevels scaled to dtype
+        """
+
+        if self.rangeRadius is not None:
+            return self.rangeRadius
+        return vt.fromUint8Levels(self.defaultRangeLevels, dtype)
+
     # necessary?
     def getOptions(self):
         return "{}"
@@ -65,80 +95,106 @@ class BilateralFilter:
         info.overlapX = self.spatialRadius
         info.overlapY = self.spatialRadius
         info.overlapZ = self.spatialRadius
+        # spatial and range weights, the range kernel has at most 2*cpu.maxRangeTableRadius + 1 weights
+        info.fixedBytes = 4*(2*self.spatialRadius + 1 + 2*cpu.maxRangeTableRadius + 1)
         return info
 
 
     def getName(self):
         return "BilateralFilter"
 
-    def makeKernel(self, r):
-
-        radius = r + 1
-        minWorkingGroup = 256
-        if 'CPU' in self.clattr.device.name: minWorkingGroup = 64
-
-        bufferSize = radius**2 - 1
-        localSize = min(self.clattr.device.max_work_group_size, minWorkingGroup)
-        globalSize = self.clattr.roundUp(localSize, bufferSize)*np.float32(0).nbytes
-
-        buffer = cl.Buffer(self.clattr.context, cl.mem_flags.READ_WRITE, size = globalSize)
-        kernel = cl.Kernel(self.program, 'makeKernel')
-        kernel.set_args(np.float32(radius), buffer, np.int32(bufferSize))
-
-        globalSize = [int(globalSize)]
-        localSize = [int(localSize)]
-
-        cl.enqueue_nd_range_kernel(self.clattr.queue, kernel, globalSize, localSize)
-        output = np.empty(bufferSize).astype(np.float32)
-        cl.enqueue_copy(self.clattr.queue, output, buffer)
-        self.clattr.queue.finish()
-
-        total = np.float32(0)
-        for i in range(bufferSize):
-            total += output[i]
-
-        normalizeKernel = cl.Kernel(self.program, 'normalizeKernel')
-        normalizeKernel.set_args(np.float32(total), buffer, np.int32(bufferSize))
-        cl.enqueue_nd_range_kernel(self.clattr.queue, normalizeKernel, globalSize, localSize)
-
-
-        return buffer
-
+    def getWeights(self, radius):
+        """
+        Returns a constant buffer holding the 2*radius + 1 normalized weights of a kernel of radius, computed on the
+        host and uploaded once per context
+        """
+
+        return pc.getConstantBuffer(self.clattr.context, ('BilateralFilter', radius),
+                                    lambda: cpu.gaussianWeights(radius)[:2*radius + 1])
+
+    def loadRangeKernel(self):
+        """
+        Uploads the range kernel of cpu.rangeTable for the type of the volume, once per context, range radius and
+        kind of type. The kernels read it instead of computing a weight for each neighbour
+        """
+
+        dtype = self.clattr.dtype
+        self.rangeValue = self.rangeRadiusFor(dtype)
+        table, self.rangeScale = cpu.rangeTable(self.rangeValue, dtype)
+        self.rangeSize = len(table)
+        self.rangeKernel = pc.getConstantBuffer(self.clattr.context,
+                                                ('BilateralFilter', 'range', self.rangeValue, vt.isFloat(dtype)),
+                                                lambda: table)
 
     def loadKernel(self):
         try:
-            filename = "../OpenCL/BilateralFiltering.cl"
-            self.program = cl.Program(self.clattr.context, pkg.resource_string(__name__, filename).decode()).build()
+            self.program = pc.getProgram(self.clattr.context, "BilateralFiltering.cl",
+                                         options=["-D", "TILE_RADIUS=%d" % self.spatialRadius] +
+                                         vt.buildOptions(self.clattr.dtype))
         except Exception:
             return  False
 
-        self.spatialKernel = self.makeKernel(self.spatialRadius)
-        self.rangeKernel = self.makeKernel(self.rangeRadius)
+        self.spatialKernel = self.getWeights(self.spatialRadius)
+        self.loadRangeKernel()
+        if self.mode == 'fast':
+            self.lineKernel = cl.Kernel(self.program, 'BilateralFilterLine')
+            return True
+
         self.kernel = cl.Kernel(self.program, 'BilateralFilter')
+        self.tiledKernel = cl.Kernel(self.program, 'BilateralFilterTiled')
         return True
 
     def runFilter(self):
 
-        globalSize = [0, 0]
-        localSize = [0, 0]
-        self.clattr.computeWorkingGroupSize(localSize, globalSize, [self.atts.width, self.atts.height, 1])
+        sizes = [self.atts.width, self.atts.height, self.clattr.sliceCount]
+        globalSize = [0, 0, 0]
+        localSize = [0, 0, 0]
+        self.clattr.computeWorkingGroupSize(localSize, globalSize, sizes)
+
+        if self.mode == 'fast':
+            return self.runLineKernels(sizes, globalSize, localSize)
 
         try:
-            self.kernel.set_args(self.clattr.inputBuffer, self.clattr.outputBuffer, np.int32(self.atts.width),
-                                 np.int32(self.atts.height), np.int32(self.clattr.maxSliceCount + self.getInfo().overlapZ),
-                                 self.spatialKernel, np.int32((self.spatialRadius+1)*2 - 1),
-                                 self.rangeKernel, np.int32((self.rangeRadius+1)*2 - 1))
+            args = [self.clattr.inputBuffer, self.clattr.outputBuffer, np.int32(self.atts.width),
+                    np.int32(self.atts.height), np.int32(self.clattr.sliceCount),
+                    self.spatialKernel, np.int32((self.spatialRadius+1)*2 - 1),
+                    self.rangeKernel, np.int32(self.rangeSize), np.float32(self.rangeValue), self.rangeScale]
 
-            cl.enqueue_nd_range_kernel(self.clattr.queue, self.kernel, globalSize, localSize)
+            if not ts.runTiled(self.clattr, self.tiledKernel, args, self.spatialRadius, sizes):
+                self.kernel.set_args(*args)
+                at.enqueue(self.clattr, self.kernel, globalSize, localSize, sizes, maskSize=self.spatialRadius)
 
         except Exception as e:
             raise e
 
-        # write results
-        cl.enqueue_copy(self.clattr.queue, self.clattr.inputBuffer, self.clattr.outputBuffer)
-        self.clattr.queue.finish()
         return True
 
+    def runLineKernels(self, sizes, globalSize, localSize):
+        """
+        Runs BilateralFilterLine along x from inputBuffer to outputBuffer, along y back into inputBuffer, which is
+        no longer needed, then along z into outputBuffer
+        """
+
+        passes = [(self.clattr.inputBuffer, self.clattr.outputBuffer, (1, 0, 0, 0)),
+                  (self.clattr.outputBuffer, self.clattr.inputBuffer, (0, 1, 0, 0)),
+                  (self.clattr.inputBuffer, self.clattr.outputBuffer, (0, 0, 1, 0))]
+        for i, (source, dest, direction) in enumerate(passes):
+            self.lineKernel.set_args(source, dest, np.int32(sizes[0]), np.int32(sizes[1]), np.int32(sizes[2]),
+                                     cltypes.make_int4(*direction), self.spatialKernel,
+                                     np.int32(2*self.spatialRadius + 1), self.rangeKernel, np.int32(self.rangeSize),
+                                     np.float32(self.rangeValue), self.rangeScale, np.int32(i == len(passes) - 1))
+            at.enqueue(self.clattr, self.lineKernel, globalSize, localSize, sizes, maskSize=self.spatialRadius)
+        return True
+
+    def runCPU(self, data, sliceStart=0):
+        """
+        Filters slab with the NumPy backend. sliceStart is the index of the first slice of data in the volume
+        """
+        rangeRadius = self.rangeRadiusFor(data.dtype)
+        if self.mode == 'fast':
+            return cpu.bilateralSeparable3D(data, self.spatialRadius, rangeRadius)
+        return cpu.bilateral3D(data, self.spatialRadius, rangeRadius)
+
     def setAttributes(self, CLAttributes, atts, index):
         self.clattr = CLAttributes
         self.atts = atts
@@ -1,116 +1,319 @@
 import numpy as np
-import pkg_resources as pkg
 import pyopencl as cl
-import time
 import pyF3D.FilterClasses as fc
+import pyF3D.CpuBackend as cpu
+import pyF3D.FFTEngine as fe
+import pyF3D.Profiling as pr
+import logging
+
+logger = logging.getLogger(__name__)
+
+def checkFFTChoice(FFTChoice):
+    """
+    Rejects the FFTChoice parameter of former versions of FFTFilter, pointing to what replaces it
+    """
+
+    if FFTChoice is None:
+        return
+    if FFTChoice not in FFTFilter.FFTChoice:
+        raise ValueError("'FFTChoice' parameter must be either 'Forward' or 'Inverse'")
+    raise ValueError("'FFTChoice' is no longer supported: FFTFilter filters volumes in the frequency domain, see its "
+                     "'mode' parameter. The %s transform of a volume is given by pyF3D.fft3D(image, inverse=%s)" %
+                     (FFTChoice.lower(), FFTChoice == 'Inverse'))
 
 class FFTFilter:
 
     """
-    Class for a FFT filter of specified direction
+    Class for a frequency-domain filter. The volume is transformed along axes by a mixed-radix FFT (see
+    pyF3D.FFTEngine), multiplied by a transfer function and transformed back. Each axis is padded by reflection to the
+    next length made of factors 2, 3, 5 and 7, which also keeps the edges of the volume from wrapping around.
+    Frequencies are in cycles per voxel, from 0 to 0.5
+
+    Filters transforming along z need the whole depth of the volume: they are run on the whole volume at once instead
+    of on slabs (see FilterInfo.fullDepth), on the first OpenCL device if it fits in its memory, with NumPy otherwise
 
     Parameters
     ----------
+    mode: str, optional
+        One of:
+
+        1). 'lowpass' (default): Butterworth low-pass filter of cutoff frequency cutoff
+        2). 'highpass': Butterworth high-pass filter of cutoff frequency cutoff. The mean is kept
+        3). 'bandpass': Butterworth band-pass filter between lowCutoff and highCutoff. The mean is kept
+        4). 'stripes': removes stripes constant along stripeAxis, that is frequencies within sigma of 0 along
+            stripeAxis and above cutoff along the other axes
+        5). 'rings': removes rings around center from each slice. Slices are resampled on a polar grid, the rings
+            estimated as for 'stripes' with angles as stripeAxis and subtracted. axes and stripeAxis are ignored
+    axes: str, optional
+        Axes along which the volume is transformed, among 'x', 'y' and 'z'
+    cutoff: float, optional
+        Cutoff frequency of 'lowpass' and 'highpass'. For 'stripes' and 'rings', frequency along the other axes (radii
+        for 'rings') under which components are kept
+    lowCutoff, highCutoff: float, optional
+        Cutoff frequencies of 'bandpass'
+    order: int, optional
+        Order of the Butterworth filters. Higher orders give sharper cutoffs
+    sigma: float, optional
+        Width of the band of stripes along stripeAxis (angles for 'rings', in cycles per sample of the polar grid)
+    stripeAxis: str, optional
+        Axis along which stripes are constant, one of axes
+    center: tuple, optional
+        (x, y) center of the rings. Defaults to the center of the slices
     FFTChoice: str, optional
-        Must be either 'Foward' or 'Inverse', to specify the direction of the operation
+        Removed: 'Forward' or 'Inverse' selected the direction of a transform that former versions never implemented,
+        and now raise a ValueError. pyF3D.fft3D transforms volumes
     """
 
+    modes = ['lowpass', 'highpass', 'bandpass', 'stripes', 'rings']
+    # values of the removed FFTChoice parameter, see checkFFTChoice
     FFTChoice = ['Forward', 'Inverse']
 
-    def __init__(self, FFTChoice='Forward'):
-
-        import warnings
-        warnings.warn("FFT Filter not yet implemented", RuntimeWarning)
-
-        if FFTChoice not in self.FFTChoice:
-            raise ValueError("'FFTChoice' parameter must be either 'Forward' or 'Inverse'")
+    def __init__(self, mode='lowpass', axes='xy', cutoff=0.1, lowCutoff=0.05, highCutoff=0.25, order=2, sigma=0.01,
+                 stripeAxis='y', center=None, FFTChoice=None):
 
         self.name = 'FFTFilter'
-        self.selectedFFTChoice = FFTChoice
+        self.index = -1
+        # FFTFilter('Forward') of former versions
+        checkFFTChoice(mode if mode in self.FFTChoice else FFTChoice)
+        if mode not in self.modes:
+            raise ValueError('mode must be one of ' + ', '.join(self.modes))
+        self.mode = mode
+        self.axes = axes
+        self.axisIndices = fe.parseAxes(axes)
+        if not self.axisIndices:
+            raise ValueError('axes must contain at least one axis')
+        self.cutoff = float(cutoff)
+        self.lowCutoff = float(lowCutoff)
+        self.highCutoff = float(highCutoff)
+        self.order = int(order)
+        self.sigma = float(sigma)
+        self.stripeAxis = stripeAxis
+        self.center = center
+
+        if self.cutoff <= 0 or self.lowCutoff <= 0 or self.sigma <= 0 or self.order < 1:
+            raise ValueError('cutoff, lowCutoff and sigma must be positive and order at least 1')
+        if mode == 'bandpass' and self.lowCutoff >= self.highCutoff:
+            raise ValueError('lowCutoff must be lower than highCutoff')
+        if stripeAxis not in fe.axisNames or len(stripeAxis) != 1:
+            raise ValueError("stripeAxis must be 'x', 'y' or 'z'")
+        if mode == 'stripes' and fe.axisNames.index(stripeAxis) not in self.axisIndices:
+            raise ValueError('stripeAxis must be one of axes')
 
-        # load clattr from RunnablePOCLFilter
         self.clattr = None
-        self.atts = None #load attributes from RunnablePOCLFilter
+        self.atts = None
 
     def toJSONString(self):
-        result = "{ + \"Name\" : \"" + self.getName() + "\" , "
-        result += "\"fftChoice\" : \"" + str(self.selectedFFTChoice) +"\" , }"
+        result = "{ \"Name\" : \"" + self.getName() + "\" , "
+        result += "\"mode\" : \"" + self.mode + "\" , "
+        result += "\"axes\" : \"" + self.axes + "\" , "
+        result += "\"cutoff\" : \"" + str(self.cutoff) + "\" , "
+        result += "\"lowCutoff\" : \"" + str(self.lowCutoff) + "\" , "
+        result += "\"highCutoff\" : \"" + str(self.highCutoff) + "\" , "
+        result += "\"order\" : \"" + str(self.order) + "\" , "
+        result += "\"sigma\" : \"" + str(self.sigma) + "\" , "
+        result += "\"stripeAxis\" : \"" + self.stripeAxis + "\" }"
         return result
 
     def clone(self):
-        return FFTFilter(FFTChoice=self.selectedFFTChoice)
+        return FFTFilter(mode=self.mode, axes=self.axes, cutoff=self.cutoff, lowCutoff=self.lowCutoff,
+                         highCutoff=self.highCutoff, order=self.order, sigma=self.sigma, stripeAxis=self.stripeAxis,
+                         center=self.center)
 
     def getInfo(self):
         info = fc.FilterInfo()
         info.name = self.getName()
-        info.memtype = float
-        info.useTempBuffer = True
+        info.memtype = bytes
         info.overlapX = info.overlapY = info.overlapZ = 0
+        info.fullDepth = self.mode != 'rings' and 2 in self.axisIndices
+        info.fullPlane = self.mode == 'rings' or 0 in self.axisIndices or 1 in self.axisIndices
+        # complex transform and its scratch buffer, without padding. Rings are removed in batches of slices that fit
+        info.voxelBytes = 0 if self.mode == 'rings' else 2*np.dtype(np.complex64).itemsize
         return info
 
     def getName(self):
         return 'FFTFilter'
 
+    def paddedShape(self, shape):
+        """
+        Shape of the transformed volume for a slab of (slices, height, width) shape
+        """
+
+        return tuple(fe.fastLength(n) if 2 - i in self.axisIndices else n for i, n in enumerate(shape))
+
+    def ringGrid(self, width, height):
+        """
+        Polar grid of the 'rings' mode for slices of width x height voxels: angles, radii, the number of radii sampled
+        before mirroring, and the center
+        """
+
+        if self.center is not None:
+            centerX, centerY = float(self.center[0]), float(self.center[1])
+        else:
+            centerX, centerY = (width - 1)/2., (height - 1)/2.
+        maxRadius = max(np.hypot(x - centerX, y - centerY) for x in [0, width - 1] for y in [0, height - 1])
+        samples = int(np.ceil(maxRadius)) + 2
+        angles = fe.fastLength(max(8, int(np.ceil(np.pi*maxRadius))))
+        radii = fe.fastLength(2*(samples - 1))
+        return angles, radii, samples, centerX, centerY
+
     def loadKernel(self):
         try:
-            filename = "../OpenCL/FFTFilter.cl"
-            program = cl.Program(self.clattr.context, pkg.resource_string(__name__, filename).decode()).build()
+            self.engine = fe.FFTEngine(self.clattr)
         except Exception as e:
             raise e
 
-        self.kernel = cl.Kernel(program, "FFTFilter")
+        program = self.engine.program
+        self.loadDataKernel = cl.Kernel(program, "FFTLoad")
+        self.storeKernel = cl.Kernel(program, "FFTStore")
+        self.spectrumKernel = cl.Kernel(program, "FFTFilterSpectrum")
+        self.polarKernel = cl.Kernel(program, "FFTToPolar")
+        self.ringsKernel = cl.Kernel(program, "FFTRemoveRings")
         return True
 
-    def runFilter(self):
+    def fitsDevice(self, size, count=2):
+        """
+        Whether count complex buffers of size bytes can be allocated next to the slab buffers
+        """
 
-        direction = 1 if self.selectedFFTChoice == 'Forward' else -1
+        device = self.clattr.device
+        slabSize = self.clattr.inputBuffer.size + self.clattr.outputBuffer.size
+        return size <= device.max_mem_alloc_size and count*size + slabSize <= device.global_mem_size
 
+    def runFilter(self):
 
-        # FFT in x direction
-        globalSize = [0, 0]
-        localSize = [0, 0]
-        self.clattr.computeWorkingGroupSize(localSize, globalSize, [self.atts.height, self.atts.slices, 1])
+        sizes = [self.atts.width, self.atts.height, self.clattr.sliceCount]
         try:
-            self.kernel.set_args(self.clattr.inputBuffer, self.clattr.outputBuffer, self.clattr.outputTmpBuffer,
-                                 np.int32(direction), np.int32(self.atts.width), np.int32(self.atts.height),
-                                 np.int32(self.clattr.maxSliceCount), np.int32(0))
-            cl.enqueue_nd_range_kernel(self.clattr.queue, self.kernel, globalSize, localSize)
-            # cl.enqueue_copy(self.clattr.queue, self.clattr.inputBuffer, self.clattr.outputBuffer)
+            if self.mode == 'rings':
+                done = self.removeRings(sizes)
+            else:
+                done = self.filterSpectrum(sizes)
+            if not done:
+                self.runOnHost(sizes)
         except Exception as e:
             raise e
 
-        # FFT in y direction
-        # self.clattr.computeWorkingGroupSize(localSize, globalSize, [self.atts.width, self.atts.slices, 1])
-        # try:
-        #     self.kernel.set_args(self.clattr.inputBuffer, self.clattr.outputBuffer, self.clattr.outputTmpBuffer,
-        #                          np.int32(direction), np.int32(self.atts.width), np.int32(self.atts.height),
-        #                          np.int32(self.clattr.maxSliceCount), np.int32(1))
-        #     cl.enqueue_nd_range_kernel(self.clattr.queue, self.kernel, globalSize, localSize)
-        #     # cl.enqueue_copy(self.clattr.queue, self.clattr.inputBuffer, self.clattr.outputBuffer)
-        # except Exception as e:
-        #     raise e
-
-        # # FFT in z direction
-        # self.clattr.computeWorkingGroupSize(localSize, globalSize, [self.atts.width, self.atts.height, 1])
-        # try:
-        #     self.kernel.set_args(self.clattr.inputBuffer, self.clattr.outputBuffer, self.clattr.outputTmpBuffer,
-        #                          np.int32(direction), np.int32(self.atts.width), np.int32(self.atts.height),
-        #                          np.int32(self.clattr.maxSliceCount), np.int32(2))
-        #     cl.enqueue_nd_range_kernel(self.clattr.queue, self.kernel, globalSize, localSize)
-        # except Exception as e:
-        #     raise e
-
-        # write results
-        cl.enqueue_copy(self.clattr.queue, self.clattr.inputBuffer, self.clattr.outputBuffer)
-        self.clattr.queue.finish()
         return True
 
+    def filterSpectrum(self, sizes):
+        """
+        Filters the slab on the device. Returns False if its transform does not fit in device memory
+        """
+
+        padded = list(reversed(self.paddedShape(tuple(reversed(sizes)))))
+        count = padded[0]*padded[1]*padded[2]
+        size = count*np.dtype(np.complex64).itemsize
+        if not self.fitsDevice(size):
+            return False
+
+        buffer = self.clattr.allocateBuffer(size)
+        scratch = self.clattr.allocateBuffer(size)
+        try:
+            self.loadDataKernel.set_args(self.clattr.inputBuffer, buffer, np.int32(sizes[0]), np.int32(sizes[1]),
+                                     np.int32(sizes[2]), np.int32(padded[0]), np.int32(padded[1]),
+                                     np.int32(padded[2]))
+            self.engine.launch(self.loadDataKernel, count)
+
+            buffer, scratch = self.transform(buffer, scratch, padded, self.axisIndices, False)
+            self.setSpectrumArgs(buffer, padded, self.axisIndices, fe.axisNames.index(self.stripeAxis))
+            self.engine.launch(self.spectrumKernel, count)
+            buffer, scratch = self.transform(buffer, scratch, padded, self.axisIndices, True)
+
+            self.storeKernel.set_args(buffer, self.clattr.outputBuffer, np.int32(sizes[0]), np.int32(sizes[1]),
+                                      np.int32(sizes[2]), np.int32(padded[0]), np.int32(padded[1]))
+            self.engine.launch(self.storeKernel, sizes[0]*sizes[1]*sizes[2])
+            self.clattr.queue.finish()
+        finally:
+            self.clattr.freeBuffer(buffer)
+            self.clattr.freeBuffer(scratch)
+        return True
+
+    def removeRings(self, sizes):
+        """
+        Removes rings on the device, in batches of slices whose polar grids fit in device memory. Returns False if
+        the grid of one slice does not fit
+        """
+
+        angles, radii, samples, centerX, centerY = self.ringGrid(sizes[0], sizes[1])
+        sliceSize = angles*radii*np.dtype(np.complex64).itemsize
+        batch = sizes[2]
+        while batch > 1 and not self.fitsDevice(batch*sliceSize):
+            batch = (batch + 1) // 2
+        if not self.fitsDevice(batch*sliceSize):
+            return False
+
+        buffer = self.clattr.allocateBuffer(batch*sliceSize)
+        scratch = self.clattr.allocateBuffer(batch*sliceSize)
+        try:
+            for firstSlice in range(0, sizes[2], batch):
+                depth = min(batch, sizes[2] - firstSlice)
+                polarSizes = [angles, radii, depth]
+                self.polarKernel.set_args(self.clattr.inputBuffer, buffer, np.int32(sizes[0]), np.int32(sizes[1]),
+                                          np.int32(depth), np.int32(firstSlice), np.int32(angles), np.int32(radii),
+                                          np.int32(samples), np.float32(centerX), np.float32(centerY))
+                self.engine.launch(self.polarKernel, angles*radii*depth)
+
+                buffer, scratch = self.transform(buffer, scratch, polarSizes, [0, 1], False)
+                self.setSpectrumArgs(buffer, polarSizes, [0, 1], 0)
+                self.engine.launch(self.spectrumKernel, angles*radii*depth)
+                buffer, scratch = self.transform(buffer, scratch, polarSizes, [0, 1], True)
+
+                self.ringsKernel.set_args(self.clattr.inputBuffer, buffer, self.clattr.outputBuffer,
+                                          np.int32(sizes[0]), np.int32(sizes[1]), np.int32(depth),
+                                          np.int32(firstSlice), np.int32(angles), np.int32(radii), np.int32(samples),
+                                          np.float32(centerX), np.float32(centerY))
+                self.engine.launch(self.ringsKernel, sizes[0]*sizes[1]*depth)
+            self.clattr.queue.finish()
+        finally:
+            self.clattr.freeBuffer(buffer)
+            self.clattr.freeBuffer(scratch)
+        return True
 
+    def transform(self, buffer, scratch, sizes, axes, inverse):
+        """
+        Transforms buffer along axes. Returns the buffer holding the result, then the other one
+        """
+
+        for axis in axes:
+            if self.engine.transform(buffer, scratch, sizes, axis, inverse) is not buffer:
+                buffer, scratch = scratch, buffer
+        return buffer, scratch
+
+    def setSpectrumArgs(self, buffer, sizes, axes, stripeAxis):
+        axisMask = 0
+        for axis in axes:
+            axisMask |= 1 << axis
+        self.spectrumKernel.set_args(buffer, np.int32(sizes[0]), np.int32(sizes[1]), np.int32(sizes[2]),
+                                     np.int32(axisMask), np.int32(self.modes.index(self.mode)),
+                                     np.float32(self.cutoff), np.float32(self.lowCutoff),
+                                     np.float32(self.highCutoff), np.int32(self.order), np.float32(self.sigma),
+                                     np.int32(stripeAxis))
+
+    def runOnHost(self, sizes):
+        """
+        Filters the slab with NumPy, for transforms too large for the device
+        """
+
+        logger.warning("FFTFilter: transform too large for %s, filtering with NumPy", self.clattr.device.name)
+        data = np.empty((sizes[2], sizes[1], sizes[0]), dtype=self.clattr.dtype)
+        pr.record(self.clattr, cl.enqueue_copy(self.clattr.queue, data, self.clattr.inputBuffer), 'download',
+                  'download')
+        pr.record(self.clattr, cl.enqueue_copy(self.clattr.queue, self.clattr.outputBuffer,
+                                               self.runCPU(data, self.atts.sliceStart)), 'upload', 'upload')
+
+    def runCPU(self, data, sliceStart=0):
+        """
+        Filters slab with the NumPy backend. sliceStart is the index of the first slice of data in the volume
+        """
+
+        if self.mode == 'rings':
+            angles, radii, samples, centerX, centerY = self.ringGrid(data.shape[2], data.shape[1])
+            return cpu.removeRings3D(data, angles, radii, samples, centerX, centerY, self.cutoff, self.order,
+                                     self.sigma)
+        return cpu.fftFilter3D(data, self.paddedShape(data.shape), self.axisIndices, self.mode, self.cutoff,
+                               self.lowCutoff, self.highCutoff, self.order, self.sigma,
+                               fe.axisNames.index(self.stripeAxis))
 
     def setAttributes(self, CLAttributes, atts, index):
         self.clattr = CLAttributes
         self.atts = atts
         self.index = index
-
-
-
@@ -1,8 +1,18 @@
 import numpy as np
-import pkg_resources as pkg
 import pyopencl as cl
+from pyopencl import cltypes
 import pyF3D.FilterClasses as fc
+import pyF3D.FilterAttributes as fa
+import pyF3D.ProgramCache as pc
+import pyF3D.CpuBackend as cpu
+import pyF3D.VoxelTypes as vt
+import pyF3D.TiledStencil as ts
+import pyF3D.Autotuner as at
+import pyF3D.Profiling as pr
 import re
+import logging
+
+logger = logging.getLogger(__name__)
 
 class MMFilterEro:
 
@@ -59,12 +69,17 @@ class MMFilterEro:
         info = fc.FilterInfo()
         info.name = self.getName()
         info.memtype = bytes
-        info.overlapX = info.overlapY = info.overlapZ = self.overlapAmount()
+        info.useTempBuffer = True
+        atts = fa.FilteringAttributes()
+        maskImages = atts.getMaskImages(self.mask, self.L)
+        halo = atts.getStructElementHalo(maskImages)
+        info.overlapX, info.overlapY, info.overlapZ = halo
+        info.tmpBufferCount, info.fixedBytes = atts.getStructElementBuffers(maskImages)
         return info
 
     def overlapAmount(self):
 
-        if self.mask in self.allowedMasks:
+        if type(self.mask) is str:
             if self.mask.startswith('StructuredElement'):
                 return self.L
             else:
@@ -79,25 +94,35 @@ class MMFilterEro:
     def loadKernel(self):
 
         try:
-            filename = "../OpenCL/MMero3D.cl"
-            self.program = cl.Program(self.clattr.context, pkg.resource_string(__name__, filename).decode()).build()
-        except Exception as e:
-            print(e)
+            self.program = pc.getProgram(self.clattr.context, "MMero3D.cl", options=vt.buildOptions(self.clattr.dtype))
+        except cl.Error as e:
+            logger.error("Could not build erosion kernels: %s", e)
             return False
 
         if self.clattr.outputTmpBuffer is None:
-            self.clattr.outputTmpBuffer = cl.Buffer(self.clattr.context, cl.mem_flags.READ_WRITE,
-                                                    self.clattr.inputBuffer.size)
+            self.clattr.initializeTmpBuffer()
 
         self.kernel = cl.Kernel(self.program, "MMero3DFilterInit")
         self.kernel2 = cl.Kernel(self.program, "MMero3DFilter")
+        self.fusedKernel = cl.Kernel(self.program, "MMero3DFused")
         return True
 
     def runKernel(self, maskImages, overlapAmount):
 
-        globalSize = [0, 0]
-        localSize = [0, 0]
-        self.clattr.computeWorkingGroupSize(localSize, globalSize, [self.atts.width, self.atts.height, 1])
+        sizes = [self.atts.width, self.atts.height, self.clattr.sliceCount]
+        globalSize = [0, 0, 0]
+        localSize = [0, 0, 0]
+        self.clattr.computeWorkingGroupSize(localSize, globalSize, sizes)
+
+        # running max/min along lines when the elements are made of lines, its cost does not depend on their length
+        decomposition = self.atts.decomposeStructElements(maskImages)
+        if decomposition is not None and self.atts.useLineKernels(decomposition, maskImages):
+            return self.runLineKernels(decomposition)
+
+        # all structuring elements in one launch when they fit in constant memory
+        packed = self.atts.getPackedStructBuffers(self.clattr.context, self.clattr.device, maskImages)
+        if packed is not None:
+            return self.runFusedKernel(packed, maskImages, globalSize, localSize)
 
 
         for i in range(len(maskImages)):
@@ -124,7 +149,7 @@ class MMFilterEro:
 
 
             if self.clattr.outputTmpBuffer is None:
-                print("clattr.outputTmpBuffer is None!!")
+                logger.error("clattr.outputTmpBuffer is None")
 
 
 
@@ -132,7 +157,7 @@ class MMFilterEro:
                 self.kernel.set_args(self.clattr.inputBuffer, self.clattr.outputTmpBuffer,
                                      np.int32(self.atts.width),
                                      np.int32(self.atts.height),
-                                     np.int32(self.clattr.maxSliceCount + self.atts.overlap[self.index]),
+                                     np.int32(self.clattr.sliceCount),
                                      structElem, np.int32(size[0]), np.int32(size[1]), np.int32(size[2]),
                                      np.int32(startOffset), np.int32(endOffset))
             else:
@@ -141,18 +166,15 @@ class MMFilterEro:
 
                 self.kernel2.set_args(self.clattr.inputBuffer, tmpBuffer1, tmpBuffer2, np.int32(self.atts.width),
                                       np.int32(self.atts.height),
-                                      np.int32(self.clattr.maxSliceCount + self.atts.overlap[self.index]),
+                                      np.int32(self.clattr.sliceCount),
                                       structElem, np.int32(size[0]), np.int32(size[1]), np.int32(size[2]),
                                       np.int32(startOffset), np.int32(endOffset))
 
             try:
-                cl.enqueue_nd_range_kernel(self.clattr.queue, self.kernel if i == 0 else self.kernel2,
-                                           globalSize, localSize)
-            except Exception:
-                return False
-
-
-            structElem.release()
+                at.enqueue(self.clattr, self.kernel if i == 0 else self.kernel2, globalSize, localSize, sizes,
+                           maskSize=max(mask.shape) // 2)
+            finally:
+                structElem.release()
 
             if len(maskImages) % 2 != 0:
                 tmpBuffer = self.clattr.outputTmpBuffer
@@ -161,17 +183,79 @@ class MMFilterEro:
 
         return True
 
+    def runLineKernels(self, decomposition):
+        """
+        Runs the MMlineEro3D passes of each decomposed structuring element from inputBuffer, and reduces the results of all
+        elements into outputBuffer
+        """
+
+        program = pc.getProgram(self.clattr.context, "MMline3D.cl", options=vt.buildOptions(self.clattr.dtype))
+        kernel = cl.Kernel(program, "MMlineEro3D")
+
+        sizes = [self.atts.width, self.atts.height, self.clattr.sliceCount]
+        scratch = []
+        if max(len(segments) for segments in decomposition) > 1:
+            scratch = [self.clattr.acquireTmpBuffer() for i in range(2)]
+
+        try:
+            for i, segments in enumerate(decomposition):
+                source = self.clattr.inputBuffer
+                for j, (direction, origin, length) in enumerate(segments):
+                    last = j == len(segments) - 1
+                    dest = self.clattr.outputBuffer if last else scratch[j % 2]
+                    kernel.set_args(source, dest, self.clattr.outputTmpBuffer, np.int32(sizes[0]), np.int32(sizes[1]),
+                                    np.int32(sizes[2]), cltypes.make_int4(*(direction + (0,))),
+                                    cltypes.make_int4(*(origin + (0,))), np.int32(length), np.int32(last and i > 0))
+                    pr.record(self.clattr, cl.enqueue_nd_range_kernel(self.clattr.queue, kernel,
+                                                                      (self.atts.getLineCount(direction, sizes),),
+                                                                      None), kernel.function_name)
+                    source = dest
+        finally:
+            for buffer in scratch:
+                self.clattr.giveBackTmpBuffer(buffer)
+
+        return True
+
+    def runFusedKernel(self, packed, maskImages, globalSize, localSize):
+        """
+        Runs MMero3DFused, which reduces over all packed structuring elements at once, from inputBuffer to outputBuffer.
+        The tiled variant is used when the neighbourhood of maskImages fits in local memory
+        """
+
+        offsets, elements, elementCount = packed
+        sizes = [self.atts.width, self.atts.height, self.clattr.sliceCount]
+        args = [self.clattr.inputBuffer, self.clattr.outputBuffer, np.int32(self.atts.width),
+                np.int32(self.atts.height), np.int32(self.clattr.sliceCount), offsets, elements, np.int32(elementCount)]
+        try:
+            radius = self.atts.getStructElementRadius(maskImages)
+            program = pc.getProgram(self.clattr.context, "MMero3D.cl", options=["-D", "TILE_RADIUS=%d" % radius] +
+                                   vt.buildOptions(self.clattr.dtype))
+            if not ts.runTiled(self.clattr, cl.Kernel(program, "MMero3DFusedTiled"), args, radius, sizes):
+                self.fusedKernel.set_args(*args)
+                at.enqueue(self.clattr, self.fusedKernel, globalSize, localSize, sizes, maskSize=radius)
+        finally:
+            offsets.release()
+            elements.release()
+
+        return True
+
     def runFilter(self):
 
 
         maskImages = self.atts.getMaskImages(self.mask, self.L)
-        self.runKernel(maskImages, self.overlapAmount())
-
-        cl.enqueue_copy(self.clattr.queue, self.clattr.inputBuffer, self.clattr.outputBuffer)
+        if not self.runKernel(maskImages, self.overlapAmount()):
+            return False
 
         return True
 
 
+    def runCPU(self, data, sliceStart=0):
+        """
+        Filters slab with the NumPy backend. sliceStart is the index of the first slice of data in the volume
+        """
+        maskImages = fa.FilteringAttributes().getMaskImages(self.mask, self.L)
+        return cpu.erode3D(data, maskImages)
+
     def setAttributes(self, CLAttributes, atts, index):
             self.clattr = CLAttributes
             self.atts = atts
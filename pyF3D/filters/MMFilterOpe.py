@@ -1,9 +1,13 @@
 import numpy as np
 import pyopencl as cl
 import pyF3D.FilterClasses as fc
+import pyF3D.FilterAttributes as fa
 from . import MMFilterEro as mmero
 from . import MMFilterDil as mmdil
 import re
+import logging
+
+logger = logging.getLogger(__name__)
 
 class MMFilterOpe:
 
@@ -61,12 +65,17 @@ class MMFilterOpe:
         info.name = self.getName()
         info.memtype = bytes
         info.useTempBuffer = True        
-        info.overlapX = info.overlapY = info.overlapZ = self.overlapAmount()
+        # dilation and erosion each widen the halo by the reach of the structuring elements
+        atts = fa.FilteringAttributes()
+        maskImages = atts.getMaskImages(self.mask, self.L)
+        halo = atts.getStructElementHalo(maskImages)
+        info.overlapX, info.overlapY, info.overlapZ = [2*h for h in halo]
+        info.tmpBufferCount, info.fixedBytes = atts.getStructElementBuffers(maskImages)
         return info
 
     def overlapAmount(self):
 
-        if self.mask in self.allowedMasks:
+        if type(self.mask) is str:
             if self.mask.startswith('StructuredElement'):
                 return self.L
             else:
@@ -101,11 +110,11 @@ class MMFilterOpe:
         #print(maskImages[0])
         for mask in maskImages:
             if not self.atts.isValidStructElement(mask):
-                print("ERROR: Structure element size is too large...")
+                logger.error("Structure element size is too large")
                 return False
 
         if not self.erosion.runKernel(maskImages, self.overlapAmount()):
-            print("Problem running erosion!")
+            logger.error("Problem running erosion")
             return False
 
         # swap results to put output back to input
@@ -114,13 +123,19 @@ class MMFilterOpe:
         self.clattr.outputBuffer = tmpBuffer
 
         if not self.dilation.runKernel(maskImages, self.overlapAmount()):
-            print("Problem running dilation!")
+            logger.error("Problem running dilation")
             return False
 
-        cl.enqueue_copy(self.clattr.queue, self.clattr.inputBuffer, self.clattr.outputBuffer)
-
         return True
 
+    def runCPU(self, data, sliceStart=0):
+        """
+        Filters slab with the NumPy backend. sliceStart is the index of the first slice of data in the volume
+        """
+        dilation = mmdil.MMFilterDil(mask=self.mask, L=self.L)
+        erosion = mmero.MMFilterEro(mask=self.mask, L=self.L)
+        return dilation.runCPU(erosion.runCPU(data, sliceStart), sliceStart)
+
     def setAttributes(self, CLAttributes, atts, index):
             self.clattr = CLAttributes
             self.atts = atts
@@ -1,7 +1,14 @@
 import numpy as np
-import pkg_resources as pkg
 import pyopencl as cl
 import pyF3D.FilterClasses as fc
+import pyF3D.FilterAttributes as fa
+import pyF3D.ProgramCache as pc
+import pyF3D.CpuBackend as cpu
+import pyF3D.VoxelTypes as vt
+import pyF3D.Profiling as pr
+import logging
+
+logger = logging.getLogger(__name__)
 
 class MaskFilter:
 
@@ -69,12 +76,14 @@ class MaskFilter:
         info.name = self.getName()
         info.memtype = bytes
         info.overlapX = info.overlapY = info.overlapZ = 0
+        info.fullPlane = True
+        # slices of the mask under the slab
+        info.voxelBytes = 1
         return info
 
     def loadKernel(self):
         try:
-            filename = "../OpenCL/Mask3D.cl"
-            self.program = cl.Program(self.clattr.context, pkg.resource_string(__name__, filename).decode()).build()
+            self.program = pc.getProgram(self.clattr.context, "Mask3D.cl", options=vt.buildOptions(self.clattr.dtype))
         except Exception:
             return False
 
@@ -84,33 +93,45 @@ class MaskFilter:
     def runFilter(self):
         mask = self.atts.getMaskImages(self.mask, self.L)[0]
 
-        if self.atts.width*self.atts.height*self.atts.slices != np.product(mask.shape):
-            print("Mask dimensions not equal to original image's")
+        if self.atts.width*self.atts.height*self.atts.slices != np.prod(mask.shape):
+            logger.error("Mask dimensions not equal to original image's")
             return False
 
         globalSize = [0]
         localSize = [0]
 
         self.clattr.computeWorkingGroupSize(localSize, globalSize, [self.atts.width, self.atts.height,
-                                                self.clattr.maxSliceCount + self.atts.overlap[self.index]])
+                                                self.clattr.sliceCount])
+        # slices of the mask under the slices of the slab
+        mask = np.ascontiguousarray(mask[self.clattr.sliceOffset:self.clattr.sliceOffset + self.clattr.sliceCount])
         self.maskBuffer = self.atts.getStructElement(self.clattr.context, self.clattr.queue, mask, globalSize[0])
 
         try:
             self.kernel.set_args(self.clattr.inputBuffer, self.maskBuffer, self.clattr.outputBuffer,
                                  np.int32(self.atts.width), np.int32(self.atts.height),
-                                 np.int32(self.clattr.maxSliceCount + self.atts.overlap[self.index]))
+                                 np.int32(self.clattr.sliceCount))
 
-            cl.enqueue_nd_range_kernel(self.clattr.queue, self.kernel, globalSize, localSize)
+            pr.record(self.clattr, cl.enqueue_nd_range_kernel(self.clattr.queue, self.kernel, globalSize, localSize),
+                      self.maskChoice)
 
         except Exception as e:
             raise e
-
-            # write results
-        cl.enqueue_copy(self.clattr.queue, self.clattr.inputBuffer, self.clattr.outputBuffer)
-        self.clattr.queue.finish()
+        finally:
+            # released once the kernel has run
+            self.maskBuffer.release()
 
         return True
 
+    def runCPU(self, data, sliceStart=0):
+        """
+        Filters slab with the NumPy backend. sliceStart is the index of the first slice of data in the volume
+        """
+        mask = fa.FilteringAttributes().getMaskImages(self.mask, self.L)[0]
+
+        if mask.shape[1:] != data.shape[1:] or mask.shape[0] < sliceStart + data.shape[0]:
+            raise ValueError("Mask dimensions not equal to original image's")
+        return cpu.mask3D(data, mask[sliceStart:sliceStart + data.shape[0]])
+
     def setAttributes(self, CLAttributes, atts, index):
         self.clattr = CLAttributes
         self.atts = atts
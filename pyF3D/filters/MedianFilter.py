@@ -1,84 +1,155 @@
 import numpy as np
-import pkg_resources as pkg
 import pyopencl as cl
 import pyF3D.FilterClasses as fc
+import pyF3D.ProgramCache as pc
+import pyF3D.CpuBackend as cpu
+import pyF3D.TiledStencil as ts
+import pyF3D.Autotuner as at
+import pyF3D.VoxelTypes as vt
 import os
 import sys
 
 currdir = os.path.dirname(os.path.realpath(__file__))
 
+# bins of the local histogram of each work-item, see MedianFilter.cl
+histogramBins = 272
+radixBins = 256
+
 class MedianFilter:
     """
-    Class for a 3D median filter of radius 3 (no parameters)
+    Class for a 3D median filter over a (2*radius + 1)^3 window
+
+    Parameters
+    ----------
+    radius: int, optional
+        Radius of the window. Each voxel gets the max(1, n/2)-th smallest of the n voxels of its window inside of the
+        volume (and not NaN), so borders are filtered over the part of the window in the volume. Windows up to
+        selectionMaxRadius are filtered by forgetful selection kept in registers. Larger windows of np.uint8 volumes,
+        and all windows of np.uint8 volumes on CPU devices, are filtered by a sliding histogram swept along z, larger
+        windows of other types by radix selection
     """
 
-    def __init__(self):
+    selectionMaxRadius = 1
+
+    def __init__(self, radius=1):
         self.name = 'MedianFilter'
         self.index = -1
+        self.radius = int(radius)
+        if self.radius < 1:
+            raise ValueError('radius must be at least 1')
 
         self.clattr = None
         self.atts = None
         
     def clone(self):
-        return MedianFilter()
+        return MedianFilter(radius=self.radius)
 
     def toJSONString(self):
-        result = "{ \"Name\" : \"" + self.getName() + "\", " + "\" }"
+        result = "{ \"Name\" : \"" + self.getName() + "\" , "
+        result += "\"radius\" : \"" + str(self.radius) + "\" }"
         return result
 
     def getInfo(self):
         info = fc.FilterInfo()
         info.name = self.getName()
         info.memtype = bytes
-        info.overlapX = info.overlapY = info.overlapZ = 4
+        info.overlapX = info.overlapY = info.overlapZ = self.radius
         return info
 
+    def useSelection(self):
+        """
+        Whether forgetful selection is used. On CPU devices the histogram of np.uint8 volumes stays in cache and the
+        z-sweep is faster at any radius. The histogram has one bin per value, so it is only built for np.uint8
+        volumes
+        """
+
+        if self.radius > self.selectionMaxRadius:
+            return False
+        return self.clattr.dtype != np.uint8 or not self.clattr.device.type & cl.device_type.CPU
+
+    def useHistogram(self):
+        """
+        Whether the sliding histogram is used, when forgetful selection is not. Radix selection is used otherwise
+        """
+
+        return not self.useSelection() and self.clattr.dtype == np.uint8
+
+    def localBytes(self):
+        """
+        Local memory used by each work-item for its histogram, in bytes
+        """
+
+        if self.useSelection():
+            return 0
+        return histogramBins*2 if self.useHistogram() else radixBins*2
+
     def getName(self):
         return "MedianFilter"
 
     def loadKernel(self):
         try:
-            filename = "../OpenCL/MedianFilter.cl"
-            program = cl.Program(self.clattr.context, pkg.resource_string(__name__, filename).decode()).build()
+            program = pc.getProgram(self.clattr.context, "MedianFilter.cl",
+                                    options=["-D", "RADIUS=%d" % self.radius] + vt.buildOptions(self.clattr.dtype))
         except Exception as e:
             raise e
 
 
-        self.kernel = cl.Kernel(program, "MedianFilter")
+        if self.useSelection():
+            self.kernel = cl.Kernel(program, "MedianFilterSelect")
+            self.tiledKernel = cl.Kernel(program, "MedianFilterSelectTiled")
+        elif self.useHistogram():
+            self.kernel = cl.Kernel(program, "MedianFilterHistogram")
+            self.tiledKernel = cl.Kernel(program, "MedianFilterHistogramTiled")
+        else:
+            self.kernel = cl.Kernel(program, "MedianFilterRadix")
+            self.tiledKernel = cl.Kernel(program, "MedianFilterRadixTiled")
 
         return True
 
     def runFilter(self):
 
-        if self.atts.height == 1 and self.atts.slices == 1:
-            mid = 1
-        elif self.atts.slices == 1:
-            mid = 4
-        else: mid = 13
-
-        globalSize = [0, 0]
-        localSize = [0, 0]
-        self.clattr.computeWorkingGroupSize(localSize, globalSize, [self.atts.width, self.atts.height, 1])
+        # the sliding histogram re-reads the window for each block of slices
+        minBlock = 2*self.radius + 1 if self.useHistogram() else 1
+        itemBytes = self.localBytes()
+        sizes = [self.atts.width, self.atts.height, self.clattr.sliceCount]
+        globalSize = [0, 0, 0]
+        localSize = [0, 0, 0]
+        self.clattr.computeWorkingGroupSize(localSize, globalSize, sizes, minBlock=minBlock)
 
         try:
-            # set up parameters
-            self.kernel.set_args(self.clattr.inputBuffer, self.clattr.outputBuffer, np.int32(self.atts.width),
-                                           np.int32(self.atts.height), np.int32(self.clattr.maxSliceCount),
-                                            np.int32(mid))
-
-            # execute kernel
-            cl.enqueue_nd_range_kernel(self.clattr.queue, self.kernel, globalSize, localSize)
+            args = [self.clattr.inputBuffer, self.clattr.outputBuffer, np.int32(self.atts.width),
+                    np.int32(self.atts.height), np.int32(self.clattr.sliceCount)]
+
+            # window read from local memory when the tile fits, from global memory otherwise
+            if ts.runTiled(self.clattr, self.tiledKernel, args, self.radius, sizes, itemBytes):
+                return True
+
+            localMemory = None
+            if itemBytes:
+                # work-groups are made smaller until their histograms fit in local memory
+                localMemory = ts.itemLocalMemory(self.clattr, itemBytes)
+                while localMemory(localSize) is None and localSize[0]*localSize[1] > 1:
+                    localSize[localSize[0] < localSize[1]] //= 2
+                globalSize[0] = self.clattr.roundUp(localSize[0], sizes[0])
+                globalSize[1] = self.clattr.roundUp(localSize[1], sizes[1])
+                args += at.localBuffers(localMemory(localSize))
+            self.kernel.set_args(*args)
+            at.enqueue(self.clattr, self.kernel, globalSize, localSize, sizes, maskSize=self.radius,
+                       minBlock=minBlock, localMemory=localMemory)
 
         except Exception as e:
             raise e
 
-        # write results
-        cl.enqueue_copy(self.clattr.queue, self.clattr.inputBuffer, self.clattr.outputBuffer)
-        self.clattr.queue.finish()
         return True
 
 
 
+    def runCPU(self, data, sliceStart=0):
+        """
+        Filters slab with the NumPy backend. sliceStart is the index of the first slice of data in the volume
+        """
+        return cpu.median3D(data, self.radius)
+
     def setAttributes(self, CLAttributes, atts, index):
         self.clattr = CLAttributes
         self.atts = atts
@@ -28,5 +28,9 @@ setup(
 	'Programming Language :: Python :: 3.4'
     ],
 
-    install_requires=['pyopencl', 'numpy', 'futures', 'tifffile']
+    install_requires=['pyopencl', 'numpy', 'futures', 'tifffile'],
+
+    entry_points={
+        'console_scripts': ['pyf3d-bench=pyF3D.benchmarks:main'],
+    }
 )
@@ -0,0 +1,69 @@
+"""
+Tests of the work-group size autotuner. Run with python -m pytest tests
+"""
+
+import json
+import threading
+
+import numpy as np
+import pytest
+
+import pyF3D as f
+import pyF3D.Autotuner as at
+from pyF3D.benchmarks import syntheticVolume, list_benchmark_devices
+
+devices = list_benchmark_devices()
+device = devices[0] if devices else None
+
+pytestmark = pytest.mark.skipif(device is None, reason='no OpenCL device')
+
+shape = (8, 32, 32)
+
+@pytest.fixture
+def tuningFile(tmp_path):
+    path = str(tmp_path / 'tuning.json')
+    at.setTuningFile(path)
+    yield path
+    at.setTuningFile(None)
+
+def test_autotune(tuningFile):
+    entries = at.autotune([f.MedianFilter()], shape=shape, platform=device.platform)
+
+    assert entries and all(key.split('/')[-3].startswith('Median') for key in entries)
+    for entry in entries.values():
+        assert len(entry['localSize']) == 2 and 1 <= entry['sliceBlock'] <= shape[0] and entry['seconds'] > 0
+    with open(tuningFile) as file:
+        assert json.load(file) == entries
+
+    # tuned parameters are read back by a new process, and used by later runs
+    at.setTuningFile(tuningFile)
+    key = list(entries)[0]
+    assert at.lookup(key) == entries[key]
+    image = syntheticVolume(shape)
+    np.testing.assert_array_equal(f.run_f3d(image, [f.MedianFilter()], platform=device.platform),
+                                  f.run_f3d(image, [f.MedianFilter()], backend='cpu'))
+
+def test_autotune_only_tunes_its_jobs(tuningFile, monkeypatch):
+    """
+    A run going on while autotune tunes its kernels is not tuned
+    """
+
+    image = syntheticVolume(shape)
+    tuned = []
+    results = []
+    tune = at.tune
+    def recordTune(clattr, kernel, *args, **kwargs):
+        tuned.append(kernel.function_name)
+        if len(tuned) == 1:
+            # run from another thread, while the kernels of autotune are being tuned
+            other = threading.Thread(target=lambda: results.append(
+                f.run_f3d(image, [f.MMFilterDil()], platform=device.platform)))
+            other.start()
+            other.join()
+        return tune(clattr, kernel, *args, **kwargs)
+    monkeypatch.setattr(at, 'tune', recordTune)
+
+    at.autotune([f.MedianFilter()], shape=shape, platform=device.platform)
+
+    assert tuned and all(name.startswith('Median') for name in tuned)
+    np.testing.assert_array_equal(results[0], f.run_f3d(image, [f.MMFilterDil()], backend='cpu'))
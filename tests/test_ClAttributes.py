@@ -0,0 +1,57 @@
+"""
+Tests of the transfers of slabs between the host and the devices. Run with python -m pytest tests
+"""
+
+import warnings
+
+import numpy as np
+import pytest
+
+import pyF3D as f
+import pyF3D.ClAttributes as ca
+from pyF3D.benchmarks import syntheticVolume, list_benchmark_devices
+
+devices = list_benchmark_devices()
+device = devices[0] if devices else None
+
+pytestmark = pytest.mark.skipif(device is None, reason='no OpenCL device')
+
+pipeline = [f.MedianFilter(), f.MMFilterDil(L=1)]
+
+@pytest.mark.parametrize('preallocated', [False, True], ids=['returned', 'preallocated'])
+@pytest.mark.parametrize('bufferCount', [1, 2, 3])
+def test_streaming_slots(monkeypatch, bufferCount, preallocated):
+    """
+    Slabs are filtered in the slots of streaming in rotation, and the result is that of the NumPy backend whether
+    slabs are written to a preallocated output or returned
+    """
+
+    # slots used by each job, which starts streaming from the first slot
+    used = []
+    initializeStreaming = ca.ClAttributes.initializeStreaming
+    def recordJob(self, count):
+        used.append([])
+        return initializeStreaming(self, count)
+    useSlot = ca.ClAttributes.useSlot
+    def recordSlot(self, slot):
+        used[-1].append(slot)
+        useSlot(self, slot)
+    monkeypatch.setattr(ca.ClAttributes, 'initializeStreaming', recordJob)
+    monkeypatch.setattr(ca.ClAttributes, 'useSlot', recordSlot)
+
+    image = syntheticVolume((40, 24, 24), np.uint16)
+    output = np.zeros_like(image) if preallocated else None
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', DeprecationWarning)
+        result = f.run_f3d(image, pipeline, platform={device.platform: 12}, bufferCount=bufferCount, output=output)
+
+    np.testing.assert_array_equal(result, f.run_f3d(image, pipeline, backend='cpu'))
+    if preallocated:
+        assert result is output
+    if bufferCount == 1:
+        assert not used
+    else:
+        assert max(len(slots) for slots in used) > bufferCount
+        for slots in used:
+            assert len(set(id(slot) for slot in slots)) == min(len(slots), bufferCount)
+            assert all(slots[i] is slots[i % bufferCount] for i in range(len(slots)))
@@ -0,0 +1,76 @@
+"""
+Tests of the reuse of contexts, programs and buffers by sessions. Run with python -m pytest tests
+"""
+
+import numpy as np
+import pytest
+
+import pyF3D as f
+import pyF3D.ClAttributes as ca
+import pyF3D.ProgramCache as pc
+from pyF3D.benchmarks import syntheticVolume, list_benchmark_devices
+
+devices = list_benchmark_devices()
+device = devices[0] if devices else None
+
+pytestmark = pytest.mark.skipif(device is None, reason='no OpenCL device')
+
+shape = (16, 24, 20)
+pipeline = [f.MedianFilter(), f.MMFilterDil(L=1)]
+
+def contextPrograms(context):
+    return [key for key in pc._programs if key[0] == context]
+
+@pytest.fixture
+def allocations(monkeypatch):
+    """
+    Sizes of the buffers allocated by buffer pools, buffers reused from pools are not counted
+    """
+
+    sizes = []
+    acquire = ca.BufferPool.acquire
+    def recordAcquire(self, size):
+        if not self.free.get(self.bucketSize(size)):
+            sizes.append(size)
+        return acquire(self, size)
+    monkeypatch.setattr(ca.BufferPool, 'acquire', recordAcquire)
+    return sizes
+
+def test_session_reuse(allocations):
+    image = syntheticVolume(shape, np.uint16)
+    expected = f.run_f3d(image, pipeline, backend='cpu')
+
+    with f.F3DSession(platform={device.platform: 8}) as session:
+        assert list(session.devices) == [device]
+        context = session.deviceContext(device).context
+        np.testing.assert_array_equal(f.run_f3d(image, pipeline, session=session), expected)
+        programs = contextPrograms(context)
+        allocated = len(allocations)
+        assert programs and allocated and session.pooledSize() > 0
+
+        # later calls, on other volumes of the same shape, build no program and allocate no buffer
+        for seed in [1, 2]:
+            other = syntheticVolume(shape, np.uint16, seed=seed)
+            np.testing.assert_array_equal(f.run_f3d(other, pipeline, session=session),
+                                          f.run_f3d(other, pipeline, backend='cpu'))
+            batch = f.run_f3d_batch([image, other], pipeline, session=session)
+            np.testing.assert_array_equal(batch[0], expected)
+        assert contextPrograms(context) == programs
+        assert len(allocations) == allocated
+
+    # buffers and programs are released on exit, and built again if the session is used afterwards
+    assert session.pooledSize() == 0 and not contextPrograms(context)
+    np.testing.assert_array_equal(f.run_f3d(image, pipeline, session=session), expected)
+    assert contextPrograms(context) and len(allocations) > allocated
+    session.close()
+
+def test_no_session(allocations):
+    """
+    Without a session, each call creates its own context whose programs are not kept
+    """
+
+    image = syntheticVolume(shape)
+    before = set(pc._programs)
+    np.testing.assert_array_equal(f.run_f3d(image, pipeline, platform=device.platform),
+                                  f.run_f3d(image, pipeline, backend='cpu'))
+    assert set(pc._programs) == before and not allocations
@@ -0,0 +1,117 @@
+"""
+Tests of the run functions of FilterManager. Run with python -m pytest tests
+"""
+
+import concurrent.futures as cf
+
+import numpy as np
+import pytest
+
+import pyF3D as f
+import pyF3D.FilterClasses as fc
+import pyF3D.FilterManager as fm
+from pyF3D.benchmarks import syntheticVolume, list_benchmark_devices
+
+devices = list_benchmark_devices()
+device = devices[0] if devices else None
+
+requiresDevice = pytest.mark.skipif(device is None, reason='no OpenCL device')
+
+@pytest.mark.parametrize('dtype,peak', [(np.uint8, 255.), (np.uint16, 65535.), (np.float32, None)],
+                         ids=['uint8', 'uint16', 'float32'])
+def test_compare_bilateral_modes(dtype, peak):
+    image = syntheticVolume((6, 24, 20), dtype)
+    rangeRadius = 0.1 if dtype == np.float32 else np.iinfo(dtype).max // 10
+    report = f.compare_bilateral_modes(image, spatialRadius=2, rangeRadius=rangeRadius, backend='cpu')
+
+    exact = f.run_f3d(image, [f.BilateralFilter(spatialRadius=2, rangeRadius=rangeRadius)], backend='cpu')
+    fast = f.run_f3d(image, [f.BilateralFilter(spatialRadius=2, rangeRadius=rangeRadius, mode='fast')],
+                     backend='cpu')
+    difference = np.abs(exact.astype(np.float64) - fast)
+    if peak is None:
+        peak = float(exact.max()) - float(exact.min())
+
+    assert report['maxError'] == pytest.approx(difference.max())
+    assert report['meanError'] == pytest.approx(difference.mean())
+    rmse = np.sqrt(np.square(difference).mean())
+    assert report['rmse'] == pytest.approx(rmse)
+    assert report['psnr'] == pytest.approx(20*np.log10(peak/rmse))
+    # fast mode stays close to exact mode whatever the type
+    assert 0 < report['meanError'] < 0.05*peak
+    assert report['psnr'] > 20
+
+def batchVolumes():
+    images = [syntheticVolume((10 + i, 20, 24 - 2*i), dtype, seed=i)
+              for i, dtype in enumerate([np.uint8, np.uint16, np.float32, np.uint8])]
+    pipelines = [[f.MedianFilter()], [f.MMFilterDil(L=1)], [f.MedianFilter(), f.MMFilterEro(L=1)], [f.MMFilterClo()]]
+    return images, pipelines
+
+@requiresDevice
+def test_concurrent_runs():
+    """
+    Runs keep no state between calls, so that volumes can be filtered from several threads at once
+    """
+
+    images, pipelines = batchVolumes()
+    def run(volume):
+        return f.run_f3d(volume[0], volume[1], platform={device.platform: 8})
+    with cf.ThreadPoolExecutor(len(images)) as e:
+        results = list(e.map(run, zip(images, pipelines)))
+
+    for image, pipeline, result in zip(images, pipelines, results):
+        np.testing.assert_array_equal(result, f.run_f3d(image, pipeline, backend='cpu'))
+
+@requiresDevice
+@pytest.mark.parametrize('bufferCount', [1, 2])
+def test_batch(bufferCount):
+    images = batchVolumes()[0]
+    pipeline = [f.MedianFilter(), f.MMFilterDil(L=1)]
+    outputs = [None, np.empty_like(images[1]), None, None]
+    results = f.run_f3d_batch(images, pipeline, platform={device.platform: 8}, bufferCount=bufferCount,
+                              outputs=outputs)
+
+    assert results[1] is outputs[1]
+    for image, result in zip(images, results):
+        np.testing.assert_array_equal(result, f.run_f3d(image, pipeline, backend='cpu'))
+
+def test_batch_outputs():
+    with pytest.raises(ValueError):
+        f.run_f3d_batch(batchVolumes()[0], [f.MedianFilter()], outputs=[None], backend='cpu')
+
+@requiresDevice
+@pytest.mark.parametrize('bufferCount', [1, 2])
+def test_preallocated_output(tmp_path, bufferCount):
+    """
+    Slabs are written into the output given, here a np.memmap, which is returned
+    """
+
+    image = syntheticVolume((30, 24, 20), np.uint16)
+    pipeline = [f.MedianFilter(), f.MMFilterEro(L=1)]
+    output = np.memmap(str(tmp_path / 'output.raw'), dtype=image.dtype, mode='w+', shape=image.shape)
+    result = f.runPipeline(image, pipeline, platform={device.platform: 8}, bufferCount=bufferCount, output=output)
+
+    assert result is output
+    np.testing.assert_array_equal(output, f.run_f3d(image, pipeline, backend='cpu'))
+
+def test_allocate_output():
+    image = syntheticVolume((4, 6, 8), np.uint16)
+    output = fm.allocate_output(image)
+    assert output.shape == image.shape and output.dtype == image.dtype
+    assert fm.allocate_output(image, output) is output
+    with pytest.raises(ValueError):
+        fm.allocate_output(image, np.empty((4, 6, 9), dtype=np.uint16))
+    with pytest.raises(TypeError):
+        fm.allocate_output(image, np.empty(image.shape, dtype=np.uint8))
+    with pytest.raises(ValueError):
+        fm.allocate_output(image, np.empty((4, 6, 16), dtype=np.uint16)[:, :, ::2])
+
+def test_reconstruct_final_image():
+    image = syntheticVolume((10, 6, 8))
+    stacks = []
+    for start, end in [(6, 10), (0, 3), (3, 6)]:
+        sr = fc.StackRange()
+        sr.startRange = start
+        sr.endRange = end
+        sr.stack = image[start:end]
+        stacks.append(sr)
+    np.testing.assert_array_equal(fm.reconstruct_final_image(stacks), image)
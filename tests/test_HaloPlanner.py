@@ -0,0 +1,76 @@
+"""
+Tests of the halos of pipelines and of the windows their stages are run on. Run with python -m pytest tests
+"""
+
+import numpy as np
+import pytest
+
+import pyF3D as f
+import pyF3D.HaloPlanner as hp
+import pyF3D.PipelineExecutor as pe
+from pyF3D.benchmarks import syntheticVolume, list_benchmark_devices
+
+devices = list_benchmark_devices()
+device = devices[0] if devices else None
+
+requiresDevice = pytest.mark.skipif(device is None, reason='no OpenCL device')
+
+pipeline = [f.MedianFilter(), f.MedianFilter(radius=2), f.MMFilterDil()]
+
+def test_total_halo():
+    plan = hp.HaloPlan(pipeline)
+    assert plan.halos == [(1, 1, 1), (2, 2, 2), (1, 1, 1)]
+    # voxels read up to the sum of the halos away, not their maximum
+    assert plan.total == (4, 4, 4)
+    assert hp.HaloPlan([]).total == (0, 0, 0)
+
+def test_windows():
+    plan = hp.HaloPlan(pipeline)
+    assert plan.windows(20, False, False) == [(0, 20), (1, 19), (3, 17)]
+    # sides at the border of the volume are not shrunk
+    assert plan.windows(20, True, False) == [(0, 20), (0, 19), (0, 17)]
+    assert plan.windows(20, False, True) == [(0, 20), (1, 20), (3, 20)]
+    assert plan.windows(20, True, True) == [(0, 20)]*3
+
+def test_bricks():
+    plan = hp.HaloPlan(pipeline)
+    shape = (64, 100, 90)
+    assert plan.bricks(shape, shape[0]*shape[1]*shape[2]) == [(((0, 100), (0, 90)), ((0, 100), (0, 90)))]
+
+    # slabs of few whole slices read many z-halos, slices are split into bricks
+    bricks = plan.bricks(shape, shape[1]*shape[2]*10)
+    assert len(bricks) > 1
+    covered = np.zeros(shape[1:], dtype=int)
+    for (yInner, xInner), (yOuter, xOuter) in bricks:
+        covered[yInner[0]:yInner[1], xInner[0]:xInner[1]] += 1
+        assert yOuter == (max(0, yInner[0] - 4), min(shape[1], yInner[1] + 4))
+        assert xOuter == (max(0, xInner[0] - 4), min(shape[2], xInner[1] + 4))
+    assert (covered == 1).all()
+    assert plan.readVolume(shape, shape[1]*shape[2]*10, plan.tiles(shape, shape[1]*shape[2]*10)) < \
+           plan.readVolume(shape, shape[1]*shape[2]*10, (1, 1))
+
+@requiresDevice
+def test_stages_run_on_windows(monkeypatch):
+    """
+    Each stage is only run on the slices of the slab still needed by the following stages
+    """
+
+    windows = []
+    enterWindow = pe.PipelineExecutor.enterWindow
+    def recordWindow(self, lo, hi):
+        windows.append((lo, hi, self.clattr.sliceCount, self.clattr.sliceOffset))
+        return enterWindow(self, lo, hi)
+    monkeypatch.setattr(pe.PipelineExecutor, 'enterWindow', recordWindow)
+
+    image = syntheticVolume((40, 24, 24), np.uint16)
+    result = f.run_f3d(image, pipeline, platform={device.platform: 16})
+    np.testing.assert_array_equal(result, f.run_f3d(image, pipeline, backend='cpu'))
+
+    # windows of the stages of each slab, in order, only shrunk on the sides of slabs inside of the volume
+    plan = hp.HaloPlan(pipeline)
+    slabs = [windows[i:i + len(pipeline)] for i in range(0, len(windows), len(pipeline))]
+    for slab in slabs:
+        lo, hi, sliceCount, sliceOffset = slab[0]
+        expected = plan.windows(sliceCount, sliceOffset == 0, sliceOffset + sliceCount >= image.shape[0])
+        assert [window[:2] for window in slab] == expected
+    assert any(slab[-1][:2] == (3, slab[0][2] - 3) for slab in slabs)
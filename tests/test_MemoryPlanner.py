@@ -0,0 +1,86 @@
+"""
+Tests of the planning of slabs from the memory of devices. Run with python -m pytest tests
+"""
+
+import numpy as np
+import pytest
+
+import pyF3D as f
+import pyF3D.ClAttributes as ca
+import pyF3D.MemoryPlanner as mp
+
+class Device(object):
+    """
+    Memory sizes of a device, as read by MemoryPlanner
+    """
+
+    def __init__(self, name, globalMemSize, maxMemAllocSize=None):
+        self.name = name
+        self.global_mem_size = globalMemSize
+        self.max_mem_alloc_size = maxMemAllocSize or globalMemSize
+
+@pytest.fixture(autouse=True)
+def noHeadroom(monkeypatch):
+    monkeypatch.setattr(mp, 'headroom', 0.)
+
+pipeline = [f.MedianFilter(), f.BilateralFilter(spatialRadius=1)]
+
+def test_every_buffer_counted():
+    tmpBufferCount, voxelBytes, fixedBytes = mp.pipelineBuffers(pipeline)
+    assert fixedBytes > 0
+    sliceBytes = 100*80*2
+    for bufferCount in [1, 2, 3]:
+        perSlice = (2*bufferCount + tmpBufferCount)*sliceBytes + 100*80*voxelBytes
+        device = Device('device', fixedBytes + 10*perSlice + perSlice//2)
+        budget = mp.planSlab(device, pipeline, 100, 80, np.uint16, overlap=1, bufferCount=bufferCount)
+        assert budget['maxSliceCount'] == 10 and budget['resultSlices'] == 8 and budget['fits']
+        assert budget['totalBytes'] == fixedBytes + 10*perSlice <= device.global_mem_size
+        assert budget['slabBuffers'] == 2*bufferCount and budget['tmpBuffers'] == tmpBufferCount
+        assert mp.slabCapacity(device, pipeline, np.uint16, bufferCount) // (100*80) == 10
+
+def test_limits():
+    device = Device('device', 1 << 30, maxMemAllocSize=100*80*7)
+    # no buffer is larger than the largest allocation
+    assert mp.planSlab(device, pipeline, 100, 80)['maxSliceCount'] == 7
+    device = Device('device', 1 << 30)
+    assert mp.planSlab(device, pipeline, 100, 80, maxSliceCount=12)['maxSliceCount'] == 12
+    budget = mp.planSlab(device, pipeline, 100, 80, overlap=2, depth=9)
+    # a slab holding the whole depth has no halo
+    assert budget['maxSliceCount'] == budget['resultSlices'] == 9
+
+    tmpBufferCount, voxelBytes, fixedBytes = mp.pipelineBuffers(pipeline)
+    device = Device('device', fixedBytes + 4*100*80*(2 + tmpBufferCount + voxelBytes))
+    assert not mp.planSlab(device, pipeline, 100, 80, overlap=2)['fits']
+    assert mp.planSlab(device, pipeline, 100, 80, overlap=1)['fits']
+
+def test_pool_buckets():
+    tmpBufferCount, voxelBytes, fixedBytes = mp.pipelineBuffers(pipeline)
+    device = Device('device', 1 << 24)
+    pool = ca.BufferPool(None)
+    budget = mp.planSlab(device, pipeline, 60, 60, bufferPool=pool)
+    # buffers of the pool are rounded up to powers of 2
+    sliceCount = budget['maxSliceCount']
+    assert budget['totalBytes'] <= device.global_mem_size
+    assert sliceCount < mp.planSlab(device, pipeline, 60, 60)['maxSliceCount']
+    assert budget['totalBytes'] == (2 + tmpBufferCount)*pool.bucketSize(sliceCount*60*60) + \
+        sliceCount*60*60*voxelBytes + fixedBytes
+
+def test_memory_report(monkeypatch):
+    monkeypatch.setattr(mp, '_budgets', {})
+    budget = mp.planSlab(Device('first', 1 << 30), pipeline, 100, 80)
+    mp.planSlab(Device('second', 1 << 29), pipeline, 100, 80)
+    report = mp.memoryReport()
+    assert sorted(report) == ['first', 'second'] and report['first'] == budget
+    report['first']['maxSliceCount'] = 0
+    assert mp.memoryReport()['first'] == budget
+
+def test_headroom():
+    device = Device('device', 1 << 30)
+    sliceCount = mp.planSlab(device, pipeline, 100, 80)['maxSliceCount']
+    f.setMemoryHeadroom(0.5)
+    assert mp.headroom == 0.5
+    assert mp.planSlab(device, pipeline, 100, 80)['maxSliceCount'] < 0.51*sliceCount
+    for fraction in [-0.1, 1, 2]:
+        with pytest.raises(ValueError):
+            f.setMemoryHeadroom(fraction)
+    assert mp.headroom == 0.5
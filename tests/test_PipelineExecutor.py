@@ -0,0 +1,72 @@
+"""
+Tests of the running of pipelines on slabs. Run with python -m pytest tests
+"""
+
+import numpy as np
+import pyopencl as cl
+import pytest
+
+import pyF3D as f
+import pyF3D.FilterManager as fm
+import pyF3D.Profiling as pr
+from pyF3D.benchmarks import syntheticVolume, list_benchmark_devices
+
+devices = list_benchmark_devices()
+device = devices[0] if devices else None
+
+pytestmark = pytest.mark.skipif(device is None, reason='no OpenCL device')
+
+def runStacks(image, pipeline, maxSliceCount=None):
+    output = np.empty_like(image)
+    jobs = fm.createJobs(image, pipeline, output, {device: maxSliceCount})
+    fm.runJobs(jobs, {device: maxSliceCount})
+    return output, [sr for job in jobs for sr in job.stacks]
+
+@pytest.mark.parametrize('maxSliceCount', [None, 8])
+def test_stage_times_from_events(maxSliceCount):
+    image = syntheticVolume((16, 32, 32))
+    pipeline = [f.MedianFilter(), f.MMFilterDil(L=1), f.MMFilterEro(L=1)]
+    with pr.Profiler() as profiler:
+        output, stacks = runStacks(image, pipeline, maxSliceCount)
+
+    events = [e for e in profiler.events() if e['stage'] is not None]
+    assert set(e['stage'].split(':')[1] for e in events) == set(['MedianFilter', 'MMFilterDil', 'MMFilterEro'])
+    stageSeconds = sum(e['end'] - e['start'] for e in events)*1e-9
+    assert sum(sr.time for sr in stacks) == pytest.approx(stageSeconds)
+    assert all(sr.time > 0 for sr in stacks)
+    np.testing.assert_array_equal(output, f.run_f3d(image, pipeline, backend='cpu'))
+
+def test_no_synchronization_between_stages(monkeypatch):
+    calls = []
+    finish = cl.CommandQueue.finish
+    monkeypatch.setattr(cl.CommandQueue, 'finish', lambda queue: calls.append(queue) or finish(queue))
+
+    image = syntheticVolume((8, 24, 24))
+    runStacks(image, [f.MedianFilter()])
+    single = len(calls)
+    del calls[:]
+    runStacks(image, [f.MedianFilter(), f.MedianFilter(), f.MMFilterDil(L=1)])
+    assert len(calls) == single
+
+def test_stages_chained_on_device():
+    """
+    Intermediate results stay on the device: slabs are uploaded and downloaded once whatever the number of stages
+    """
+
+    image = syntheticVolume((16, 24, 24), np.uint16)
+    for pipeline in [[f.MedianFilter()], [f.MedianFilter(), f.MedianFilter(radius=2), f.MMFilterDil(L=1)]]:
+        with pr.Profiler() as profiler:
+            output, stacks = runStacks(image, pipeline, 8)
+        events = profiler.events()
+        categories = [e['category'] for e in events]
+        assert len(stacks) > 1 and 'copy' not in categories
+        assert categories.count('upload') == categories.count('download') == len(stacks)
+        assert len(set(e['stage'] for e in events if e['category'] == 'kernel')) == len(pipeline)
+        np.testing.assert_array_equal(output, f.run_f3d(image, pipeline, backend='cpu'))
+
+def test_empty_pipeline():
+    image = syntheticVolume((16, 24, 24), np.uint16)
+    with pr.Profiler() as profiler:
+        output, stacks = runStacks(image, [], 8)
+    np.testing.assert_array_equal(output, image)
+    assert len([e for e in profiler.events() if e['category'] == 'copy']) == len(stacks)
@@ -0,0 +1,80 @@
+"""
+Tests of the profiling of kernels and transfers, and of the trace and summary written. Run with python -m pytest tests
+"""
+
+import json
+import logging
+
+import numpy as np
+import pytest
+
+import pyF3D as f
+import pyF3D.Profiling as pr
+from pyF3D.benchmarks import syntheticVolume, list_benchmark_devices
+
+devices = list_benchmark_devices()
+device = devices[0] if devices else None
+
+pytestmark = pytest.mark.skipif(device is None, reason='no OpenCL device')
+
+pipeline = [f.MedianFilter(), f.MMFilterDil(L=1)]
+
+@pytest.fixture(scope='module')
+def profiler():
+    image = syntheticVolume((24, 24, 20), np.uint16)
+    with pr.Profiler() as profiler:
+        f.run_f3d(image, pipeline, platform={device.platform: 10})
+    return profiler
+
+def test_events(profiler):
+    events = profiler.events()
+    categories = set(e['category'] for e in events)
+    assert categories == set(['kernel', 'upload', 'download'])
+    assert all(e['device'] == device.name.strip() and e['end'] >= e['start'] for e in events)
+    # kernels are attributed to the slab and the stage they ran for
+    kernels = [e for e in events if e['category'] == 'kernel']
+    assert set(e['stage'] for e in kernels) == set(['0:MedianFilter', '1:MMFilterDil'])
+    slabs = sorted(set(e['slab'] for e in events))
+    assert len(slabs) > 1 and slabs[0][0] == 0 and slabs[-1][1] == 24
+
+    # nothing is recorded once stopped
+    count = len(profiler.records)
+    f.run_f3d(syntheticVolume((8, 24, 20)), pipeline, platform=device.platform)
+    assert len(profiler.records) == count and pr.activeProfiler is None
+
+def test_chrome_trace(profiler, tmp_path):
+    path = str(tmp_path / 'trace.json')
+    profiler.saveTrace(path)
+    with open(path) as file:
+        trace = json.load(file)
+
+    metadata = [e for e in trace['traceEvents'] if e['ph'] == 'M']
+    assert [e['args']['name'] for e in metadata] == [device.name.strip(), 'kernels', 'transfers']
+    complete = [e for e in trace['traceEvents'] if e['ph'] == 'X']
+    assert len(complete) == len(profiler.events())
+    assert min(e['ts'] for e in complete) == 0 and all(e['dur'] >= 0 for e in complete)
+    for event in complete:
+        assert event['tid'] == (0 if event['cat'] == 'kernel' else 1)
+        assert 'slab' in event['args']
+        assert ('stage' in event['args']) == (event['cat'] == 'kernel')
+
+def test_summary(profiler):
+    summary = profiler.summary()
+    events = profiler.events()
+    assert sum(row['count'] for row in summary) == len(events)
+    assert sum(row['totalMs'] for row in summary) == pytest.approx(sum(e['end'] - e['start'] for e in events)/1e6)
+    assert [row['totalMs'] for row in summary] == sorted((row['totalMs'] for row in summary), reverse=True)
+    for row in summary:
+        assert row['meanMs'] == pytest.approx(row['totalMs']/row['count']) and row['maxMs'] >= row['meanMs']
+    uploads = [row for row in summary if row['category'] == 'upload']
+    assert len(uploads) == 1 and uploads[0]['stage'] == ''
+
+    lines = profiler.summaryTable().split('\n')
+    assert lines[0].split() == ['device', 'stage', 'category', 'name', 'count', 'totalMs', 'meanMs', 'maxMs']
+    assert len(lines) == len(summary) + 1
+
+def test_log_messages(caplog):
+    caplog.set_level(logging.INFO, logger='pyF3D')
+    f.run_f3d(syntheticVolume((8, 24, 20)), pipeline, platform=device.platform)
+    # messages of the modules of pyF3D go through the 'pyF3D' logger set by setLogLevel
+    assert any(record.name.startswith('pyF3D.') and record.message.startswith('Device:') for record in caplog.records)
@@ -0,0 +1,78 @@
+"""
+Tests of the scheduling of slabs across devices. Run with python -m pytest tests
+"""
+
+import pyF3D.SlabScheduler as ss
+
+def takeAll(scheduler, devices):
+    """
+    Ranges handed out to devices taking slabs in turn, until none is left
+    """
+
+    ranges = []
+    active = list(devices)
+    while active:
+        for device in list(active):
+            stackRange = [0, 0]
+            if scheduler.getNextRange(device, stackRange):
+                ranges.append((device, stackRange[0], stackRange[1]))
+            else:
+                active.remove(device)
+    return ranges
+
+def assertCovers(ranges, depth):
+    bounds = sorted((start, end) for device, start, end in ranges)
+    assert bounds[0][0] == 0 and bounds[-1][1] == depth
+    assert all(end == start for (s, end), (start, e) in zip(bounds, bounds[1:]))
+
+def test_single_device():
+    scheduler = ss.SlabScheduler(100, 2)
+    scheduler.register('gpu', 20)
+    ranges = takeAll(scheduler, ['gpu'])
+
+    assertCovers(ranges, 100)
+    # slabs hold maxSliceCount slices with their overlap, the first slab has none before it
+    assert [end - start for device, start, end in ranges[:2]] == [18, 16]
+    assert all(end - start <= 16 for device, start, end in ranges[1:])
+
+def test_throughput_weighting():
+    scheduler = ss.SlabScheduler(1000, 1, deviceCount=2)
+    scheduler.register('fast', 500)
+    scheduler.register('slow', 500)
+    assert scheduler.throughput('fast') is None
+
+    # the first device is 3 times as fast as the second
+    scheduler.recordTime('fast', 30, 1.)
+    scheduler.recordTime('slow', 10, 1.)
+    assert scheduler.throughput('fast') == 30.
+    assert scheduler.shareOf('fast', 400) == 300.
+    assert scheduler.shareOf('slow', 400) == 100.
+
+    fast = [0, 0]
+    slow = [0, 0]
+    scheduler.getNextRange('fast', fast)
+    scheduler.getNextRange('slow', slow)
+    assert fast[1] - fast[0] > 2*(slow[1] - slow[0])
+
+def test_unmeasured_devices_share_equally():
+    scheduler = ss.SlabScheduler(400, 0, deviceCount=2)
+    scheduler.register('a', 1000)
+    scheduler.register('b', 1000)
+    assert scheduler.shareOf('a', 400) == scheduler.shareOf('b', 400) == 200.
+
+    # a device not measured yet is taken as fast as the average measured device
+    scheduler.recordTime('a', 10, 1.)
+    assert scheduler.shareOf('b', 400) == 200.
+
+def test_tail_shrinks():
+    scheduler = ss.SlabScheduler(1000, 2, deviceCount=2, minSliceCount=4)
+    for device in ['a', 'b']:
+        scheduler.register(device, 10000)
+        scheduler.recordTime(device, 10, 1.)
+    ranges = takeAll(scheduler, ['a', 'b'])
+
+    assertCovers(ranges, 1000)
+    sizes = [end - start for device, start, end in sorted(ranges, key=lambda r: r[1])]
+    assert sizes == sorted(sizes, reverse=True)
+    assert sizes[0] <= 250 and sizes[-1] < sizes[0]
+    assert all(size >= 4 for size in sizes[:-1])
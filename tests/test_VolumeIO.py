@@ -0,0 +1,143 @@
+"""
+Tests of the volumes read from and written to disk. Run with python -m pytest tests
+"""
+
+import os
+
+import numpy as np
+import pytest
+import tifffile
+
+import pyF3D as f
+import pyF3D.VolumeIO as vio
+from pyF3D.benchmarks import syntheticVolume, list_benchmark_devices
+
+devices = list_benchmark_devices()
+device = devices[0] if devices else None
+
+requiresDevice = pytest.mark.skipif(device is None, reason='no OpenCL device')
+
+shape = (14, 20, 18)
+pipeline = [f.MedianFilter(), f.MMFilterDil(L=1)]
+
+def writeSlices(path, image):
+    os.makedirs(path)
+    for z, data in enumerate(image):
+        tifffile.imwrite(os.path.join(path, 'slice_%03d.tif' % z), data)
+
+def test_open_volume(tmp_path):
+    image = syntheticVolume(shape, np.uint16)
+    np.save(str(tmp_path / 'image.npy'), image)
+    image.tofile(str(tmp_path / 'image.raw'))
+    writeSlices(str(tmp_path / 'slices'), image)
+
+    assert vio.open_volume(image) is image
+    volume = vio.open_volume(str(tmp_path / 'image.npy'))
+    assert isinstance(volume, np.memmap)
+    np.testing.assert_array_equal(volume, image)
+    volume = vio.open_volume(str(tmp_path / 'image.raw'), shape=shape, dtype=np.uint16)
+    assert isinstance(volume, np.memmap)
+    np.testing.assert_array_equal(volume, image)
+    with pytest.raises(ValueError):
+        vio.open_volume(str(tmp_path / 'image.raw'))
+
+    # slices are read when indexed
+    volume = vio.open_volume(str(tmp_path / 'slices'))
+    assert isinstance(volume, vio.TiffSliceVolume)
+    assert volume.shape == image.shape and volume.dtype == image.dtype
+    np.testing.assert_array_equal(volume[3], image[3])
+    np.testing.assert_array_equal(volume[2:9:3, 4:, :5], image[2:9:3, 4:, :5])
+
+def test_tiff_slice_writer(tmp_path):
+    image = syntheticVolume(shape)
+    writer = vio.open_output(str(tmp_path / 'slices'), shape)
+    assert isinstance(writer, vio.TiffSliceWriter)
+    # slabs are written in any order
+    writer[7:] = image[7:]
+    writer[:7] = image[:7]
+    assert len(os.listdir(str(tmp_path / 'slices'))) == shape[0]
+    np.testing.assert_array_equal(writer.toVolume()[:], image)
+
+@requiresDevice
+@pytest.mark.parametrize('source', ['npy', 'raw', 'slices'])
+@pytest.mark.parametrize('destination', ['npy', 'raw', 'slices'])
+def test_run_f3d_on_disk(tmp_path, source, destination):
+    image = syntheticVolume(shape, np.uint16)
+    np.save(str(tmp_path / 'image.npy'), image)
+    image.tofile(str(tmp_path / 'image.raw'))
+    writeSlices(str(tmp_path / 'image'), image)
+    paths = {'npy': 'image.npy', 'raw': 'image.raw', 'slices': 'image'}
+
+    output = str(tmp_path / ('filtered.' + destination if destination != 'slices' else 'filtered'))
+    result = f.run_f3d(str(tmp_path / paths[source]), pipeline, platform={device.platform: 8}, output=output,
+                       shape=shape, dtype=np.uint16)
+
+    expected = f.run_f3d(image, pipeline, backend='cpu')
+    np.testing.assert_array_equal(result[:], expected)
+    if destination == 'slices':
+        assert isinstance(result, vio.TiffSliceVolume)
+    else:
+        assert isinstance(result, np.memmap)
+        written = np.load(output) if destination == 'npy' else np.fromfile(output, dtype=np.uint16).reshape(shape)
+        np.testing.assert_array_equal(written, expected)
+
+@pytest.fixture
+def smallChunks(monkeypatch):
+    """
+    Volumes are read in chunks of 2 slices, so that streaming passes go through several chunks
+    """
+
+    chunkRanges = vio.chunkRanges
+    monkeypatch.setattr(vio, 'chunkRanges', lambda volume, chunkBytes=0, itemSize=None: chunkRanges(
+        volume, 2*volume.shape[1]*volume.shape[2]*(itemSize or np.dtype(volume.dtype).itemsize), itemSize))
+
+def test_volume_range(smallChunks):
+    image = syntheticVolume(shape, np.uint16).astype(np.int32)//2 - 30000
+    assert vio.volumeRange(image) == (image.min(), image.max())
+    # exact percentiles of integer volumes
+    low, high = vio.volumeRange(image, (1, 99))
+    assert (low, high) == tuple(np.percentile(image, [1, 99], method='lower'))
+
+    floatImage = image.astype(np.float64)/7
+    low, high = vio.volumeRange(floatImage, (1, 99))
+    # interpolated within their bin, between the values of the ranks around that of the percentile
+    binWidth = (floatImage.max() - floatImage.min())/65536
+    values = np.sort(floatImage, axis=None)
+    for q, value in [(1, low), (99, high)]:
+        rank = int(q/100.*(values.size - 1))
+        assert values[rank] - binWidth <= value <= values[rank + 1] + binWidth
+    with pytest.raises(ValueError):
+        vio.volumeRange(image, (99, 1))
+
+@pytest.mark.parametrize('percentiles', [None, (2, 98)])
+def test_scale_to_uint8(tmp_path, smallChunks, percentiles):
+    image = syntheticVolume(shape, np.float32).astype(np.float64)*1000 - 200
+    low, high = vio.volumeRange(image, percentiles)
+    expected = vio.scaleSlab(image, low, high)
+
+    scaled = vio.ScaledVolume(image, percentiles)
+    assert scaled.dtype == np.uint8 and scaled.shape == shape
+    np.testing.assert_array_equal(scaled[3:9], expected[3:9])
+
+    np.testing.assert_array_equal(f.scale_to_uint8(image, percentiles=percentiles), expected)
+    # streamed from disk into files
+    np.save(str(tmp_path / 'image.npy'), image)
+    for output in ['scaled.npy', 'scaled']:
+        result = f.scale_to_uint8(str(tmp_path / 'image.npy'), str(tmp_path / output), percentiles=percentiles)
+        np.testing.assert_array_equal(result[:], expected)
+    assert isinstance(result, vio.TiffSliceVolume)
+    np.testing.assert_array_equal(np.load(str(tmp_path / 'scaled.npy')), expected)
+    if percentiles is not None:
+        assert expected.min() == 0 and expected.max() == 255 and (image < low).any()
+
+@requiresDevice
+@pytest.mark.parametrize('dtype', [np.int32, np.float64], ids=lambda t: np.dtype(t).name)
+def test_run_f3d_scales_unsupported_types(smallChunks, dtype):
+    """
+    Volumes of types the filters do not support are scaled to np.uint8 slab by slab, as by scale_to_uint8
+    """
+
+    image = (syntheticVolume(shape, np.uint16).astype(dtype) - 20000)*3
+    result = f.run_f3d(image, pipeline, platform={device.platform: 8})
+    assert result.dtype == np.uint8
+    np.testing.assert_array_equal(result, f.run_f3d(f.scale_to_uint8(image), pipeline, backend='cpu'))
@@ -0,0 +1,77 @@
+"""
+Tests of the benchmark suite and of the pyf3d-bench command. Run with python -m pytest tests
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+import pyF3D.FilterManager as fm
+import pyF3D.benchmarks as bm
+
+devices = bm.list_benchmark_devices()
+device = devices[0] if devices else None
+
+requiresDevice = pytest.mark.skipif(device is None, reason='no OpenCL device')
+
+shape = ['8', '24', '20']
+
+def test_cpu_report(tmp_path):
+    path = str(tmp_path / 'report.json')
+    assert bm.main(['--shape'] + shape + ['--no-opencl', '--pipeline', 'MedianFilter', 'denoise', '--dtype', 'uint8',
+                    'float32', '--repeat', '2', '--slab-counts', '1', '4', '--output', path]) == 0
+    with open(path) as file:
+        report = json.load(file)
+
+    assert report['shape'] == [8, 24, 20] and report['environment']['devices'] == []
+    results = report['results']
+    assert [(r['dtype'], r['pipeline']) for r in results] == \
+           [('uint8', 'MedianFilter'), ('uint8', 'denoise'), ('float32', 'MedianFilter'), ('float32', 'denoise')]
+    for record in results:
+        assert record['backend'] == 'cpu' and record['voxels'] == 8*24*20 and 'error' not in record
+        assert len(record['allSeconds']) == 2 and record['seconds'] == min(record['allSeconds'])
+        assert record['voxelsPerSecond'] == pytest.approx(record['voxels']/record['seconds'])
+    assert results[1]['filters'] == ['MedianFilter', 'BilateralFilter']
+    assert [(r['requestedSlabCount'], r['slabCount']) for r in report['scaling']] == [(1, 1), (4, 4)]*4
+
+@requiresDevice
+def test_opencl_report(capsys):
+    assert bm.main(['--shape'] + shape + ['--no-cpu', '--pipeline', 'MMFilterDil', '--repeat', '1', '--slab-counts',
+                    '2', '--device', device.name[:8]]) == 0
+    report = json.loads(capsys.readouterr().out)
+
+    assert report['environment']['devices'] == [device.name.strip()]
+    record, = report['results']
+    assert record['backend'] == 'opencl' and record['device'] == device.name.strip() and 'error' not in record
+    assert record['seconds'] >= record['computeSeconds'] > 0
+    assert record['transferSeconds'] == pytest.approx(record['seconds'] - record['computeSeconds'])
+    scaling, = report['scaling']
+    assert scaling['requestedSlabCount'] == 2 and scaling['slabCount'] >= 2
+
+def test_failures_recorded(monkeypatch):
+    def fail(*args):
+        raise MemoryError('out of memory')
+    monkeypatch.setattr(fm, 'runPipelineCPU', fail)
+    report = bm.run_benchmarks((4, 8, 8), pipelines=['MedianFilter', 'MMFilterEro'], devices=[], repeat=1,
+                               slabCounts=None)
+    assert [r['error'] for r in report['results']] == ['MemoryError: out of memory']*2 and not report['scaling']
+    with pytest.raises(ValueError, match='unknown pipelines: Gaussian'):
+        bm.run_benchmarks((4, 8, 8), pipelines=['Gaussian'], devices=[])
+
+def test_module_command(tmp_path):
+    """
+    python -m pyF3D.benchmarks runs the pyf3d-bench command
+    """
+
+    path = str(tmp_path / 'report.json')
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.check_call([sys.executable, '-m', 'pyF3D.benchmarks', '--shape'] + shape + [
+        '--no-opencl', '--pipeline', 'MMFilterOpe', '--repeat', '1', '--slab-counts', '--output', path], cwd=root)
+    with open(path) as file:
+        report = json.load(file)
+    assert [r['pipeline'] for r in report['results']] == ['MMFilterOpe'] and report['scaling'] == []
+    assert np.isfinite(report['results'][0]['seconds'])
@@ -0,0 +1,215 @@
+"""
+Compares the OpenCL filters with their NumPy implementation (backend='cpu') for each voxel type, with kernels reading
+global memory, with tiled kernels forced on and with slices split into xy-bricks. Run with python -m pytest tests
+"""
+
+import numpy as np
+import pyopencl as cl
+import pytest
+
+import pyF3D as f
+import pyF3D.CpuBackend as cpu
+import pyF3D.FilterManager as fm
+import pyF3D.HaloPlanner as hp
+import pyF3D.MemoryPlanner as mp
+import pyF3D.TiledStencil as ts
+import pyF3D.VoxelTypes as vt
+from pyF3D.benchmarks import syntheticVolume, list_benchmark_devices
+
+devices = list_benchmark_devices()
+device = devices[0] if devices else None
+
+pytestmark = pytest.mark.skipif(device is None, reason='no OpenCL device')
+
+shape = (12, 40, 36)
+dtypes = [np.uint8, np.uint16, np.float32]
+
+# name, function of the volume returning the pipeline, and whether results are exactly those of NumPy. Filters
+# computing in floating point may round differently
+pipelines = [
+    ('median', lambda image: [f.MedianFilter()], True),
+    ('median-radius-2', lambda image: [f.MedianFilter(radius=2)], True),
+    ('bilateral', lambda image: [f.BilateralFilter(spatialRadius=2)], False),
+    ('bilateral-fast', lambda image: [f.BilateralFilter(mode='fast')], False),
+    ('bilateral-range',
+     lambda image: [f.BilateralFilter(spatialRadius=1, rangeRadius=vt.fromUint8Levels(90, image.dtype))], False),
+    ('fft', lambda image: [f.FFTFilter()], False),
+    ('mask', lambda image: [f.MaskFilter(mask=image > image.mean())], False),
+    ('dilation', lambda image: [f.MMFilterDil()], True),
+    ('dilation-diagonal', lambda image: [f.MMFilterDil(mask='Diagonal3x3x3')], True),
+    ('erosion', lambda image: [f.MMFilterEro()], True),
+    ('erosion-diagonal', lambda image: [f.MMFilterEro(mask='Diagonal3x3x3')], True),
+    ('closing', lambda image: [f.MMFilterClo()], True),
+    ('opening', lambda image: [f.MMFilterOpe()], True),
+    ('median-dilation', lambda image: [f.MedianFilter(), f.MMFilterDil(L=1)], True),
+]
+
+def assertMatches(result, expected, exact):
+    assert result.dtype == expected.dtype
+    if exact:
+        np.testing.assert_array_equal(result, expected)
+    else:
+        tolerance = 1e-5 if vt.isFloat(expected.dtype) else 1
+        np.testing.assert_allclose(result.astype(np.float64), expected.astype(np.float64), rtol=0, atol=tolerance)
+
+@pytest.fixture(params=['global', 'tiled', 'bricks'])
+def layout(request, monkeypatch):
+    """
+    'global' disables tiled kernels, 'tiled' uses them even on devices without dedicated local memory (see
+    setTiledKernels), 'bricks' limits device memory so that slices are split into xy-bricks (see limitMemory)
+    """
+
+    monkeypatch.setattr(ts, 'tiledKernels', ts.tiledKernels)
+    f.setTiledKernels('always' if request.param == 'tiled' else 'never')
+    return request.param
+
+def limitMemory(monkeypatch, pipeline, image, sliceCount):
+    """
+    Leaves device memory for the buffers of slabs of sliceCount whole slices of image only, see setMemoryHeadroom
+    """
+
+    tmpBufferCount, voxelBytes, fixedBytes = mp.pipelineBuffers(pipeline)
+    sliceBytes = image.shape[1]*image.shape[2]*((2 + tmpBufferCount)*image.itemsize + voxelBytes)
+    monkeypatch.setattr(mp, 'headroom', mp.headroom)
+    f.setMemoryHeadroom(1 - float(fixedBytes + sliceCount*sliceBytes)/device.global_mem_size)
+
+@pytest.mark.parametrize('dtype', dtypes, ids=lambda t: np.dtype(t).name)
+@pytest.mark.parametrize('name,newPipeline,exact', pipelines, ids=[p[0] for p in pipelines])
+def test_opencl_matches_cpu(layout, dtype, name, newPipeline, exact, monkeypatch):
+    image = syntheticVolume(shape, dtype)
+    expected = f.run_f3d(image, newPipeline(image), backend='cpu')
+
+    if layout == 'bricks':
+        # a slab of 2 slices and its halos
+        limitMemory(monkeypatch, newPipeline(image), image, 2*hp.HaloPlan(newPipeline(image)).total[2] + 2)
+        jobs = fm.createJobs(image, newPipeline(image), np.empty_like(image), {device: None})
+        if not any(filter.getInfo().fullPlane for filter in newPipeline(image)):
+            assert len(jobs) > 1
+
+    assertMatches(f.run_f3d(image, newPipeline(image), platform=device.platform, backend='opencl'), expected, exact)
+
+def medianReference(image, radius):
+    """
+    max(1, n/2)-th smallest of the n voxels of each window inside of the volume and not NaN
+    """
+
+    output = np.empty_like(image)
+    for z, y, x in np.ndindex(*image.shape):
+        window = image[max(0, z - radius):z + radius + 1, max(0, y - radius):y + radius + 1,
+                       max(0, x - radius):x + radius + 1].ravel()
+        window = np.sort(window[~np.isnan(window)]) if vt.isFloat(image.dtype) else np.sort(window)
+        output[z, y, x] = window[max(1, len(window)//2) - 1] if len(window) else np.nan
+    return output
+
+@pytest.mark.parametrize('radius', [1, 2])
+@pytest.mark.parametrize('dtype', dtypes, ids=lambda t: np.dtype(t).name)
+def test_median_borders(layout, dtype, radius):
+    image = syntheticVolume((6, 11, 9), dtype, seed=1)
+    if vt.isFloat(dtype):
+        image[0] = -image[0]
+        image[2, 3, 2:6] = np.nan
+    expected = medianReference(image, radius)
+
+    result = f.run_f3d(image, [f.MedianFilter(radius=radius)], platform=device.platform, backend='opencl')
+    np.testing.assert_array_equal(result, expected)
+    np.testing.assert_array_equal(f.run_f3d(image, [f.MedianFilter(radius=radius)], backend='cpu'), expected)
+    if vt.isFloat(dtype):
+        assert not np.isinf(result).any()
+
+@pytest.mark.parametrize('dtype', dtypes, ids=lambda t: np.dtype(t).name)
+def test_median_single_slice(dtype):
+    image = syntheticVolume((1, 20, 17), dtype, seed=2)
+    expected = medianReference(image, 1)
+    np.testing.assert_array_equal(f.run_f3d(image, [f.MedianFilter()], platform=device.platform), expected)
+    np.testing.assert_array_equal(f.run_f3d(image, [f.MedianFilter()], backend='cpu'), expected)
+
+@pytest.mark.parametrize('dtype', dtypes, ids=lambda t: np.dtype(t).name)
+def test_bilateral_default_range_radius(dtype):
+    """
+    The default range radius is 30 grey levels of np.uint8 in units of the type, so that volumes of every type are
+    smoothed alike
+    """
+
+    image = syntheticVolume(shape, dtype, seed=3)
+    result = f.run_f3d(image, [f.BilateralFilter(spatialRadius=1)], platform=device.platform)
+    scaled = vt.fromUint8Levels(30, dtype)
+    np.testing.assert_array_equal(result, f.run_f3d(image, [f.BilateralFilter(spatialRadius=1, rangeRadius=scaled)],
+                                                    platform=device.platform))
+
+    # relative to the range of the type, the filter changes volumes of every type as much as np.uint8 ones
+    levels = 255.0 if dtype == np.uint8 else vt.fromUint8Levels(255, dtype)
+    change = np.abs(result.astype(np.float64) - image).mean() / levels
+    uint8Image = syntheticVolume(shape, np.uint8, seed=3)
+    uint8Change = np.abs(f.run_f3d(uint8Image, [f.BilateralFilter(spatialRadius=1)], platform=device.platform)
+                         .astype(np.float64) - uint8Image).mean() / 255.0
+    assert change > 0.5*uint8Change > 0
+
+@pytest.mark.parametrize('dtype,rangeRadius', [(np.uint8, 30), (np.uint16, 7710), (np.float32, 0.1)],
+                         ids=['uint8', 'uint16', 'float32'])
+def test_range_table(dtype, rangeRadius):
+    """
+    Range kernels have at most 2*cpu.maxRangeTableRadius + 1 weights, whose gaussian spans the range radius
+    """
+
+    table, scale = cpu.rangeTable(rangeRadius, dtype)
+    assert len(table) % 2 == 1 and len(table) <= 2*cpu.maxRangeTableRadius + 1
+    assert np.isclose(len(table)//2 / scale, rangeRadius)
+    # weights relative to the center, the gaussian of CpuBackend.gaussianWeights at the offsets of the differences
+    radius = len(table)//2
+    offsets = np.rint(np.linspace(-rangeRadius, rangeRadius, 101)*scale).astype(int)
+    expected = np.exp(-0.5*(offsets/(0.4*(radius + 1)))**2)
+    np.testing.assert_allclose(table[offsets + radius] / table[radius], expected, rtol=1e-5)
+
+@pytest.mark.parametrize('choice', ['Forward', 'Inverse'])
+def test_fft_choice_removed(choice):
+    """
+    The FFTChoice parameter of former versions is rejected with a message pointing to fft3D, by keyword or position
+    """
+
+    for newFilter in [lambda: f.FFTFilter(FFTChoice=choice), lambda: f.FFTFilter(choice),
+                      lambda: f.run_FFTFilter(syntheticVolume(shape), FFTChoice=choice)]:
+        with pytest.raises(ValueError, match='fft3D'):
+            newFilter()
+    with pytest.raises(ValueError, match="'Forward' or 'Inverse'"):
+        f.FFTFilter(FFTChoice='Backward')
+
+def test_max_slice_count_of_bricks(monkeypatch):
+    """
+    The maximum slice count of a device limits the slices of the slabs of xy-bricks as those of whole slices, and
+    does not split slices into bricks by itself
+    """
+
+    image = syntheticVolume((24, 40, 36), np.uint16)
+    pipeline = [f.MedianFilter()]
+    expected = f.run_f3d(image, pipeline, backend='cpu')
+    assert len(fm.createJobs(image, pipeline, np.empty_like(image), {device: 4})) == 1
+
+    # slabs of 4 whole slices fit in memory, bricks hold more slices
+    limitMemory(monkeypatch, pipeline, image, 4)
+    for maxSliceCount in [None, 6]:
+        output = np.empty_like(image)
+        jobs = fm.createJobs(image, pipeline, output, {device: maxSliceCount})
+        fm.runJobs(jobs, {device: maxSliceCount})
+        assert len(jobs) > 1
+        np.testing.assert_array_equal(output, expected)
+
+        # slices of each slab without its halos of 1 slice, the first slab of a brick only has one
+        slabSlices = max(sr.endRange - sr.startRange for job in jobs for sr in job.stacks)
+        assert slabSlices > 4 if maxSliceCount is None else slabSlices == maxSliceCount - 1
+
+@pytest.mark.parametrize('mode', ts.tiledKernelModes)
+def test_tiled_kernels(monkeypatch, mode):
+    monkeypatch.setattr(ts, 'tiledKernels', ts.tiledKernels)
+    f.setTiledKernels(mode)
+    image = syntheticVolume(shape)
+    pipeline = [f.MedianFilter(), f.BilateralFilter(spatialRadius=1), f.MMFilterDil(), f.MMFilterEro()]
+    with f.Profiler() as profiler:
+        result = f.run_f3d(image, pipeline, platform=device.platform)
+
+    names = [e['name'] for e in profiler.events() if e['category'] == 'kernel']
+    tiled = [name for name in names if name.endswith('Tiled')]
+    usesTiles = mode == 'always' or (mode == 'auto' and device.local_mem_type == cl.device_local_mem_type.LOCAL)
+    assert len(set(tiled)) == (len(pipeline) if usesTiles else 0)
+    assertMatches(result, f.run_f3d(image, pipeline, backend='cpu'), False)
+    with pytest.raises(ValueError):
+        f.setTiledKernels('sometimes')